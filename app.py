@@ -1,242 +1,4427 @@
 import os
+import time
+
+# Профиль запуска: отсчёт с первых строк модуля
+STARTUP_STARTED = time.perf_counter()
+
 import logging
-import requests
 import re
-from flask import Flask, request, jsonify
-from bs4 import BeautifulSoup
+from flask import Flask, request, jsonify, redirect
 from datetime import datetime
 import threading
-import time
-from telegram import Bot
-from telegram.error import TelegramError
+import itertools
+import random
+import asyncio
+import base64
+import math
+import socket
+import sqlite3
+import hashlib
+import hmac
+import importlib.util
+import gzip
+import zlib
+import json
+import uuid
+import bisect
+import heapq
+from array import array
+from collections import namedtuple, OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, TimeoutError as FuturesTimeoutError
+from html import escape
+from html.parser import HTMLParser
+from urllib.parse import urlparse
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+app = Flask(__name__)
+
+# ==================== ПРОФИЛЬ ЗАПУСКА ====================
+
+# Этапы загрузки модуля: (этап, секунды). Виден в /health и в журнале
+STARTUP_PHASES = []
+_startup_mark = STARTUP_STARTED
+
+
+def startup_phase(name):
+    """Отмечает конец этапа загрузки модуля"""
+    global _startup_mark
+    now = time.perf_counter()
+    STARTUP_PHASES.append((name, now - _startup_mark))
+    _startup_mark = now
+
+
+def startup_profile():
+    phases = {name: round(seconds * 1000, 1) for name, seconds in STARTUP_PHASES}
+    return {'total_ms': round(sum(phases.values()), 1), 'phases_ms': phases}
+
+
+startup_phase('imports')
+
+# Конфигурация из переменных окружения
+TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '').strip()
+TELEGRAM_CHAT_ID = os.environ.get('TELEGRAM_CHAT_ID', '').strip()
+
+# Парсер карточек: 'stream' - потоковый разбор без DOM, 'soup' - BeautifulSoup
+PARSER_MODE = os.environ.get('PARSER_MODE', 'stream').strip().lower()
+# Сколько карточек обрабатываем за один проход (для скорости)
+MAX_CARDS_PER_PAGE = 15
+# Инкрементальный режим: полностью разбираем только новые/изменённые карточки,
+# ограничение MAX_CARDS_PER_PAGE при этом не действует
+INCREMENTAL_PARSE = os.environ.get('INCREMENTAL_PARSE', '1') == '1'
+
+# Хранилище состояния: 'sqlite' - общий файл для всех воркеров, 'memory' - только процесс
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'sqlite').strip().lower()
+STATE_DB_PATH = os.environ.get('STATE_DB_PATH', 'state.db').strip()
+PRICE_HISTORY_DAYS = float(os.environ.get('PRICE_HISTORY_DAYS', 30))
+
+# ==================== МЕТРИКИ ====================
+
+# Границы корзин гистограмм по умолчанию (секунды)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS = []
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_label_value(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """Счётчик в формате Prometheus (значения - на процесс-воркер)"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}' for key, value in values]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Counter):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            counts = entry[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            entry[1] += 1
+            entry[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        with self._lock:
+            values = [(key, list(counts), count, total) for key, (counts, count, total) in self._values.items()]
+        lines = []
+        for key, counts, count, total in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, [("le", f"{bound:g}")])} {cumulative}')
+            lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, [("le", "+Inf")])} {count}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}')
+        return lines
+
+
+def render_metrics():
+    """Все метрики в текстовом формате Prometheus 0.0.4"""
+    lines = []
+    for metric in METRICS:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+FETCH_SECONDS = Histogram('funpay_fetch_seconds', 'Время до заголовков ответа FunPay', ['category'])
+PARSE_SECONDS = Histogram('funpay_parse_seconds', 'Чтение тела и разбор страницы', ['category'])
+FETCH_RESPONSES = Counter('funpay_responses_total', 'Ответы FunPay по HTTP-коду (0 - сетевая ошибка)', ['category', 'status'])
+BYTES_DOWNLOADED = Counter('funpay_bytes_downloaded_total', 'Байт скачано с FunPay (до распаковки)', ['category'])
+CARDS_SEEN = Counter('funpay_cards_total', 'Карточек разобрано', ['category'])
+CARDS_CHANGED = Counter('funpay_cards_changed_total', 'Новых/изменённых карточек', ['category'])
+ITEMS_MATCHED = Counter('funpay_items_matched_total', 'Товаров, прошедших правила', ['category'])
+DEDUPE_HITS = Counter('monitor_dedupe_hits_total', 'Изменённых товаров, которые уже видели', ['category'])
+NEW_ITEMS = Counter('monitor_new_items_total', 'Новых товаров', ['category'])
+DEALS_FILTERED = Counter('monitor_deals_filtered_total', 'Новых товаров, отсеянных оценкой сделки')
+CYCLE_SECONDS = Histogram('monitor_cycle_seconds', 'Длительность цикла опроса', buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60))
+SCHEDULER_LAG = Histogram('monitor_scheduler_lag_seconds', 'Опоздание опроса относительно расписания', ['category'],
+                          buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300))
+TELEGRAM_SEND_SECONDS = Histogram('telegram_send_seconds', 'Время отправки сообщения в Telegram')
+TELEGRAM_FAILURES = Counter('telegram_send_failures_total', 'Неудачные попытки отправки в Telegram', ['reason'])
+TELEGRAM_SENT = Counter('telegram_messages_sent_total', 'Отправлено сообщений в Telegram')
+SEEN_SIZE = Gauge('monitor_seen_items', 'Ключей в памяти увиденных')
+SEEN_EVICTIONS = Gauge('monitor_seen_evictions', 'Вытеснено ключей из памяти увиденных')
+SEEN_MEMORY = Gauge('monitor_seen_memory_bytes', 'Оценка памяти увиденных')
+TELEGRAM_QUEUE = Gauge('telegram_queue_depth', 'Сообщений в очереди Telegram')
+MONITORING_UP = Gauge('monitor_active', 'Мониторинг включён (1/0)')
+
+# ==================== TELEGRAM ====================
+
+# Адрес Bot API (можно направить на локальный фейковый сервер для тестов)
+TELEGRAM_API_BASE_URL = os.environ.get('TELEGRAM_API_BASE_URL', 'https://api.telegram.org/bot').strip()
+# Сколько секунд копим всплеск оповещений, прежде чем отправить дайджест
+TELEGRAM_DIGEST_WINDOW = float(os.environ.get('TELEGRAM_DIGEST_WINDOW', 2))
+TELEGRAM_MAX_MESSAGE = 4096
+# Лимиты Telegram: ~1 сообщение в секунду в один чат и ~30 в секунду всего
+TELEGRAM_CHAT_INTERVAL = 1.0
+TELEGRAM_GLOBAL_INTERVAL = 1 / 25
+TELEGRAM_MAX_ATTEMPTS = 4
+TELEGRAM_QUEUE_SIZE = 1000
+
+# Сообщение в очереди. digest - можно склеить с соседними в дайджест
+OutgoingMessage = namedtuple('OutgoingMessage', ['chat_id', 'text', 'parse_mode', 'digest', 'queued_at'])
+
+
+class TelegramDispatcher:
+    """Фоновая отправка в Telegram.
+
+    Один Bot на всё время жизни, свой поток с asyncio-циклом, очередь.
+    Всплески оповещений склеиваются в дайджесты, соблюдаются лимиты на
+    чат и общий, на 429 ждём retry_after. Цикл мониторинга только кладёт
+    сообщения в очередь и никогда не ждёт Telegram.
+    """
+
+    def __init__(self, token, base_url=TELEGRAM_API_BASE_URL):
+        self.token = token
+        self.base_url = base_url
+        self._queue = None
+        self._loop = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._start_lock = threading.Lock()
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._chat_next = {}
+        self._global_next = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.dropped = 0
+        self.digests = 0
+
+    def enqueue(self, chat_id, text, parse_mode='HTML', digest=False):
+        """Ставит сообщение в очередь. False - очередь переполнена"""
+        self._ensure_started()
+        with self._pending_lock:
+            if self._pending >= TELEGRAM_QUEUE_SIZE:
+                self.dropped += 1
+                logger.error("❌ Очередь Telegram переполнена, сообщение отброшено")
+                return False
+            self._pending += 1
+        message = OutgoingMessage(str(chat_id), text, parse_mode, digest, time.time())
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, message)
+        return True
+
+    def flush(self, timeout=30):
+        """Ждёт, пока очередь опустеет (для тестов и остановки)"""
+        deadline = time.time() + timeout
+        while self._pending and time.time() < deadline:
+            time.sleep(0.05)
+        return not self._pending
+
+    def stats(self):
+        return {
+            'queued': self._pending,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retries': self.retries,
+            'dropped': self.dropped,
+            'digests': self.digests,
+        }
+
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if not (self._thread and self._thread.is_alive()):
+                self._ready.clear()
+                self._pending = 0
+                self._thread = threading.Thread(target=self._run, name='telegram', daemon=True)
+                self._thread.start()
+                self._ready.wait()
+
+    def _run(self):
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._ready.set()
+        from telegram import Bot
+        bot = Bot(token=self.token, base_url=self.base_url)
+        while True:
+            batch = [await self._queue.get()]
+            if batch[0].digest:
+                # Даём всплеску собраться, чтобы отправить его одним-двумя сообщениями
+                await asyncio.sleep(TELEGRAM_DIGEST_WINDOW)
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            try:
+                for chat_id, text, parse_mode in self._coalesce(batch):
+                    # Сбой одного сообщения не должен терять остальные сообщения пачки
+                    try:
+                        await self._send(bot, chat_id, text, parse_mode)
+                    except Exception as e:
+                        self.failed += 1
+                        TELEGRAM_FAILURES.inc(reason='error')
+                        logger.error(f"❌ Ошибка отправки в Telegram: {e}")
+            finally:
+                with self._pending_lock:
+                    self._pending -= len(batch)
+
+    def _coalesce(self, batch):
+        """Склеивает digest-сообщения одного чата в дайджесты до 4096 символов"""
+        digests = OrderedDict()
+        for message in batch:
+            if message.digest:
+                digests.setdefault((message.chat_id, message.parse_mode), []).append(message.text)
+            else:
+                yield message.chat_id, message.text, message.parse_mode
+
+        for (chat_id, parse_mode), texts in digests.items():
+            if len(texts) == 1:
+                yield chat_id, texts[0], parse_mode
+                continue
+            self.digests += 1
+            header = f"📬 <b>Новых предложений: {len(texts)}</b>\n\n"
+            chunk = header
+            for text in texts:
+                part = text + "\n\n"
+                if len(chunk) + len(part) > TELEGRAM_MAX_MESSAGE and chunk != header:
+                    yield chat_id, chunk.rstrip(), parse_mode
+                    chunk = ""
+                chunk += part
+            if chunk.strip():
+                yield chat_id, chunk.rstrip(), parse_mode
+
+    async def _wait_rate_limit(self, chat_id):
+        now = time.monotonic()
+        ready = max(self._chat_next.get(chat_id, 0.0), self._global_next)
+        if ready > now:
+            await asyncio.sleep(ready - now)
+            now = ready
+        self._chat_next[chat_id] = now + TELEGRAM_CHAT_INTERVAL
+        self._global_next = now + TELEGRAM_GLOBAL_INTERVAL
+
+    async def _send(self, bot, chat_id, text, parse_mode):
+        from telegram.error import TelegramError, RetryAfter, TimedOut, NetworkError, BadRequest, Forbidden
+        for attempt in range(1, TELEGRAM_MAX_ATTEMPTS + 1):
+            await self._wait_rate_limit(chat_id)
+            try:
+                with TELEGRAM_SEND_SECONDS.time():
+                    await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+                self.sent += 1
+                TELEGRAM_SENT.inc()
+                logger.info(f"📨 Отправлено в Telegram: {text[:50]}...")
+                return True
+            except RetryAfter as e:
+                # 429: Telegram сам говорит, сколько ждать
+                retry_after = e.retry_after
+                # Новые версии python-telegram-bot отдают timedelta, 20.x - секунды
+                delay = retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+                self._chat_next[chat_id] = time.monotonic() + delay
+                TELEGRAM_FAILURES.inc(reason='retry_after')
+                logger.warning(f"⏳ Telegram просит подождать {delay:.0f} сек")
+            except (BadRequest, Forbidden) as e:
+                # BadRequest - подкласс NetworkError, но повтор его не исправит:
+                # битая разметка, чат не найден, бот заблокирован
+                TELEGRAM_FAILURES.inc(reason='rejected')
+                logger.error(f"❌ Telegram отклонил сообщение: {e}")
+                break
+            except (TimedOut, NetworkError) as e:
+                TELEGRAM_FAILURES.inc(reason='network')
+                await asyncio.sleep(min(2 ** attempt, 30))
+                logger.warning(f"🌐 Сбой сети Telegram (попытка {attempt}): {e}")
+            except TelegramError as e:
+                TELEGRAM_FAILURES.inc(reason='api')
+                logger.error(f"❌ Ошибка Telegram: {e}")
+                break
+            self.retries += 1
+        self.failed += 1
+        return False
+
+
+telegram_dispatcher = TelegramDispatcher(TELEGRAM_BOT_TOKEN)
+
+
+def send_telegram_message(message, parse_mode='HTML', chat_id=None, digest=False):
+    """Отправка сообщения в Telegram (через фоновую очередь)"""
+    if not TELEGRAM_BOT_TOKEN or not (chat_id or TELEGRAM_CHAT_ID):
+        logger.warning("⚠️ Telegram не настроен, пропускаем отправку")
+        return False
+    
+    return telegram_dispatcher.enqueue(chat_id or TELEGRAM_CHAT_ID, message, parse_mode, digest)
+
+# ==================== HTTP-КЛИЕНТ ====================
+
+# urllib3 сам распаковывает brotli, если установлен пакет brotli (или brotlicffi)
+if any(importlib.util.find_spec(name) for name in ('brotli', 'brotlicffi')):
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+else:
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+HTTP_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Encoding': ACCEPT_ENCODING,
+}
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+
+
+def _make_http_session():
+    """Общая сессия: keep-alive и пул соединений вместо нового TLS на каждый опрос"""
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update(HTTP_HEADERS)
+    return session
+
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """Сессия создаётся при первом запросе: импорт requests не задерживает запуск воркера"""
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                _http_session = _make_http_session()
+    return _http_session
+
+# Валидаторы для условных запросов: url -> (ETag, Last-Modified, товары)
+_page_cache = {}
+_page_cache_lock = threading.Lock()
+
+
+def _release_unread(response):
+    """Дочитывает остаток ответа без разбора, чтобы соединение вернулось в пул"""
+    try:
+        response.raw.drain_conn()
+        response.raw.release_conn()
+    except Exception as e:
+        logger.debug(f"⚠️ Соединение не возвращено в пул: {e}")
+
+# ==================== ЗАГРУЗКА СТРАНИЦ ====================
+
+# Ответ больше этого не дочитываем: обрыв потока и ошибка too_large
+FETCH_MAX_BYTES = int(os.environ.get('FETCH_MAX_BYTES', 5 * 1024 * 1024))
+# Повтор сетевой ошибки/таймаута (через другой прокси), если он есть
+FETCH_RETRIES = int(os.environ.get('FETCH_RETRIES', 1))
+# Прокси через запятую; пустой элемент - прямое соединение
+HTTP_PROXIES = [proxy.strip() or None for proxy in os.environ.get('HTTP_PROXIES', '').split(',')]
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Safari/605.1.15',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0',
+]
+# Автомат: после стольких неудач подряд запросы к хосту/категории не отправляются
+BREAKER_FAILURES = int(os.environ.get('BREAKER_FAILURES', 5))
+BREAKER_COOLDOWN = 30
+BREAKER_MAX_COOLDOWN = 600
+
+FETCH_ERRORS = Counter('funpay_fetch_errors_total', 'Ошибки загрузки по видам', ['category', 'kind'])
+BREAKER_OPEN = Gauge('funpay_breaker_open', 'Автомат разомкнут (1/0)', ['key'])
+
+
+class FetchError(Exception):
+    """Загрузка не удалась. kind - вид ошибки для метрик и /health"""
+
+    kind = 'error'
+
+    def __init__(self, message, status=0):
+        super().__init__(message)
+        self.status = status
+
+
+class FetchTimeout(FetchError):
+    kind = 'timeout'
+
+
+class FetchNetworkError(FetchError):
+    kind = 'network'
+
+
+class FetchThrottled(FetchError):
+    """FunPay ограничивает нас (403/429/503)"""
+
+    kind = 'throttled'
+
+    def __init__(self, message, status=0, retry_after=None):
+        super().__init__(message, status)
+        self.retry_after = retry_after
+
+
+class FetchHTTPError(FetchError):
+    kind = 'http'
+
+
+class FetchTooLarge(FetchError):
+    kind = 'too_large'
+
+
+class CircuitOpen(FetchError):
+    kind = 'circuit_open'
+
+
+# Пояснения к видам ошибок для веб-страниц
+FETCH_ERROR_TEXTS = {
+    'throttled': 'FunPay ограничивает запросы (403/429/503)',
+    'circuit_open': 'Запросы приостановлены после серии ошибок',
+    'timeout': 'Таймаут запроса к FunPay',
+    'network': 'Ошибка сети',
+    'too_large': 'Ответ больше лимита размера',
+    'http': 'Неожиданный HTTP-код',
+    'parse': 'Ошибка разбора страницы',
+}
+
+
+class CircuitBreaker:
+    """Автомат: closed → open (после BREAKER_FAILURES неудач) → half_open (одна проба).
+
+    Каждое новое размыкание вдвое удлиняет паузу; Retry-After от сервера
+    важнее расчётной паузы.
+    """
+
+    def __init__(self, key, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN, clock=None):
+        self.key = key
+        self.max_failures = failures
+        self.base_cooldown = cooldown
+        # Часы берём при создании, а не при импорте: replay.py подменяет их виртуальными
+        self.clock = clock or time.time
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        self._probing = False
+        self._probe_started = 0.0
+
+    def allow(self):
+        with self._lock:
+            now = self.clock()
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and now >= self.open_until:
+                self.state = 'half_open'
+                self._probing = False
+            # Проба, не сообщившая исход (запрос не ушёл), не держит автомат вечно
+            if self.state == 'half_open' and (not self._probing or now - self._probe_started > self.base_cooldown):
+                self._probing = True
+                self._probe_started = now
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            if self.state != 'closed':
+                logger.info(f"🔌 Автомат {self.key} снова замкнут")
+                BREAKER_OPEN.set(0, key=self.key)
+            self.state = 'closed'
+            self.failures = 0
+            self.trips = 0
+            self._probing = False
+
+    def failure(self, retry_after=None):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == 'half_open' or self.failures >= self.max_failures or retry_after:
+                self.trips += 1
+                cooldown = min(self.base_cooldown * 2 ** (self.trips - 1), BREAKER_MAX_COOLDOWN)
+                if retry_after:
+                    cooldown = min(retry_after, BREAKER_MAX_COOLDOWN)
+                self.state = 'open'
+                self.open_until = self.clock() + cooldown
+                BREAKER_OPEN.set(1, key=self.key)
+                logger.warning(f"🔌 Автомат {self.key} разомкнут на {cooldown:.0f} сек")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'open_for': round(max(self.open_until - self.clock(), 0), 1) if self.state == 'open' else 0,
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(key):
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = _breakers[key] = CircuitBreaker(key)
+        return breaker
+
+
+class RotatingPool:
+    """Пул вариантов (прокси, User-Agent) с оценкой здоровья.
+
+    Оценка - скользящее среднее успехов (0..1); выбор случайный с весом
+    оценки, так что больной вариант пробуется редко, но не забывается.
+    Ограничение (throttled) штрафует сильнее сетевой ошибки.
+    """
+
+    def __init__(self, options, min_weight=0.05):
+        self.scores = {option: 1.0 for option in options}
+        self.min_weight = min_weight
+        self._lock = threading.Lock()
+
+    def choose(self, exclude=()):
+        with self._lock:
+            options = [option for option in self.scores if option not in exclude] or list(self.scores)
+            weights = [max(self.scores[option], self.min_weight) for option in options]
+        return random.choices(options, weights)[0]
+
+    def report(self, option, ok, penalty=0.5):
+        with self._lock:
+            if option in self.scores:
+                target = 1.0 if ok else 0.0
+                alpha = 0.2 if ok else penalty
+                self.scores[option] += alpha * (target - self.scores[option])
+
+    def stats(self):
+        with self._lock:
+            return {str(option or 'direct'): round(score, 2) for option, score in self.scores.items()}
+
+
+proxy_pool = RotatingPool(HTTP_PROXIES)
+agent_pool = RotatingPool(USER_AGENTS)
+
+
+def _retry_after(response):
+    value = response.headers.get('Retry-After', '')
+    return float(value) if value.isdigit() else None
+
+
+def fetch(url, category, headers=None, timeout=10, max_bytes=None):
+    """Загрузка через автоматы, пул прокси и User-Agent.
+
+    Возвращает потоковый ответ 200/304 (тело читать через iter_body).
+    Иначе - исключение FetchError нужного вида; оно же попадает в метрики.
+    """
+    import requests
+    session = get_http_session()
+    host_breaker = breaker_for(urlparse(url).netloc)
+    page_breaker = breaker_for(f"category:{category}")
+    tried = []
+    for attempt in range(FETCH_RETRIES + 1):
+        if not host_breaker.allow() or not page_breaker.allow():
+            error = CircuitOpen(f"автомат разомкнут для {category}")
+            FETCH_ERRORS.inc(category=category, kind=error.kind)
+            raise error
+        proxy = proxy_pool.choose(exclude=tried)
+        agent = agent_pool.choose()
+        tried.append(proxy)
+        request_headers = dict(headers or {}, **{'User-Agent': agent})
+        proxies = {'http': proxy, 'https': proxy} if proxy else None
+        try:
+            with FETCH_SECONDS.time(category=category):
+                response = session.get(url, headers=request_headers, timeout=timeout,
+                                       stream=True, proxies=proxies)
+        except requests.exceptions.RequestException as e:
+            error = (FetchTimeout if isinstance(e, requests.exceptions.Timeout) else FetchNetworkError)(str(e))
+            FETCH_RESPONSES.inc(category=category, status=0)
+            FETCH_ERRORS.inc(category=category, kind=error.kind)
+            proxy_pool.report(proxy, False)
+            host_breaker.failure()
+            if attempt < FETCH_RETRIES:
+                logger.warning(f"🔁 Повтор {category}: {e}")
+                continue
+            raise error
+        
+        FETCH_RESPONSES.inc(category=category, status=response.status_code)
+        status = response.status_code
+        if status in (200, 304):
+            length = response.headers.get('Content-Length', '')
+            if max_bytes and length.isdigit() and int(length) > max_bytes:
+                response.close()
+                page_breaker.failure()
+                error = FetchTooLarge(f"ответ {length} байт больше лимита {max_bytes}", status)
+                FETCH_ERRORS.inc(category=category, kind=error.kind)
+                raise error
+            proxy_pool.report(proxy, True)
+            agent_pool.report(agent, True)
+            host_breaker.success()
+            page_breaker.success()
+            return response
+        
+        _release_unread(response)
+        response.close()
+        if status in THROTTLE_STATUSES:
+            proxy_pool.report(proxy, False, penalty=0.8)
+            agent_pool.report(agent, False)
+            host_breaker.failure(_retry_after(response))
+            error = FetchThrottled(f"FunPay ограничивает запросы (HTTP {status})", status, _retry_after(response))
+        else:
+            page_breaker.failure()
+            error = FetchHTTPError(f"HTTP {status}", status)
+        FETCH_ERRORS.inc(category=category, kind=error.kind)
+        raise error
+
+
+def iter_body(response, category, max_bytes=None, decode_unicode=True):
+    """Тело ответа по кускам; за пределом max_bytes поток обрывается (FetchTooLarge).
+
+    Считаются и байты из сети, и длина распакованных кусков: маленький
+    gzip/br-ответ не должен разворачиваться в сотни мегабайт.
+    Обрыв соединения посреди тела - FetchNetworkError, как и при запросе.
+    """
+    import requests
+    max_bytes = max_bytes or FETCH_MAX_BYTES
+    if decode_unicode and response.encoding is None:
+        response.encoding = 'utf-8'
+    chunks = response.iter_content(chunk_size=16384, decode_unicode=decode_unicode)
+    decoded = 0
+    while True:
+        try:
+            chunk = next(chunks, None)
+        except requests.exceptions.RequestException as e:
+            FETCH_ERRORS.inc(category=category, kind='network')
+            raise FetchNetworkError(str(e))
+        if chunk is None:
+            return
+        decoded += len(chunk)
+        if decoded > max_bytes or response.raw.tell() > max_bytes:
+            response.close()
+            breaker_for(f"category:{category}").failure()
+            error = FetchTooLarge(f"ответ больше лимита {max_bytes} байт")
+            FETCH_ERRORS.inc(category=category, kind=error.kind)
+            raise error
+        yield chunk
+
+
+def fetch_stats():
+    with _breakers_lock:
+        breakers = {key: breaker.stats() for key, breaker in _breakers.items()}
+    return {'breakers': breakers, 'proxies': proxy_pool.stats(), 'user_agents': len(USER_AGENTS)}
+
+
+# ==================== ЗАПИСЬ СТРАНИЦ ====================
+
+# Архив опросов для replay.py: страницы категорий со временем загрузки (gzip JSONL).
+# Пусто - запись выключена
+CAPTURE_PATH = os.environ.get('CAPTURE_PATH', '').strip()
+
+
+class PageRecorder:
+    """Пишет опросы категорий в сжатый архив.
+
+    Строки архива:
+      {"t": "body", "hash": ..., "html": ...} - тело страницы, один раз на содержимое;
+      {"t": "page", "ts": ..., "category": ..., "url": ..., "status": ..., "hash": ...} - опрос.
+    Одинаковые тела между опросами хранятся один раз, 304 и ошибки - без тела.
+    Gzip дописывается новыми членами, так что перезапуск процесса архив не портит.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        self._hashes = set()
+        self.pages = 0
+        self.bodies = 0
+
+    def _write(self, record):
+        if self._file is None:
+            self._file = gzip.open(self.path, 'at', encoding='utf-8')
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def record(self, url, category, status, html=None, error=None, partial=False):
+        page = {'t': 'page', 'ts': round(time.time(), 3), 'category': category, 'url': url, 'status': status}
+        try:
+            with self._lock:
+                if html is not None:
+                    digest = hashlib.blake2b(html.encode('utf-8'), digest_size=12).hexdigest()
+                    if digest not in self._hashes:
+                        self._write({'t': 'body', 'hash': digest, 'html': html})
+                        self._hashes.add(digest)
+                        self.bodies += 1
+                    page['hash'] = digest
+                if error:
+                    page['error'] = error
+                if partial:
+                    page['partial'] = True
+                self._write(page)
+                # Тела крупные, сброс на каждый опрос почти не портит сжатие, зато падение не теряет хвост
+                self._file.flush()
+                self.pages += 1
+        except Exception as e:
+            logger.error(f"💥 Запись архива {self.path}: {e}")
+
+    def tee(self, url, category, body):
+        """Пропускает куски тела дальше и записывает страницу, когда поток закончился"""
+        chunks = []
+        try:
+            for chunk in body:
+                chunks.append(chunk)
+                yield chunk
+        except GeneratorExit:
+            # Оборванный islice-ом разбор тоже пишем, но с пометкой partial
+            self.record(url, category, 200, ''.join(chunks), partial=True)
+            raise
+        self.record(url, category, 200, ''.join(chunks))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def stats(self):
+        return {'path': self.path, 'pages': self.pages, 'bodies': self.bodies}
+
+
+def read_capture(path):
+    """Читает архив: (тела по хэшу, опросы по времени)"""
+    bodies = {}
+    pages = []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Хвост, оборванный падением процесса
+                    continue
+                if record.get('t') == 'body':
+                    bodies[record['hash']] = record['html']
+                elif record.get('t') == 'page':
+                    pages.append(record)
+        except EOFError:
+            # Архив ещё пишется (или процесс упал): всё до последнего сброса уже прочитано
+            pass
+    pages.sort(key=lambda page: page['ts'])
+    return bodies, pages
+
+
+page_recorder = PageRecorder(CAPTURE_PATH) if CAPTURE_PATH else None
+
+
+# ==================== ПАРСИНГ КАРТОЧЕК ====================
+
+CARD_CLASS = 'tc-item'
+TITLE_CLASS = 'tc-desc-text'
+PRICE_CLASS = 'tc-price'
+AMOUNT_CLASS = 'tc-amount'
+SELLER_CLASS = 'media-user-name'
+STATUS_CLASSES = ('media-user-status', 'online-status', 'status')
+TITLE_FALLBACK_TAGS = frozenset(['div', 'span', 'h3', 'h4'])
+# Запасной разбор: класс заголовка переименовали, но похожий остался (tc-desc-title)
+TITLE_HINTS = ('desc', 'title')
+VOID_TAGS = frozenset([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+    'link', 'meta', 'param', 'source', 'track', 'wbr',
+])
+PRICE_DIGITS_RE = re.compile(r'\d+')
+# Класс tc-item, а не tc-item-* / my-tc-item
+CARD_TOKEN_RE = re.compile(r'[\w-]')
+# Имя тега в начале карточки: по нему ищется её закрывающий тег
+TAG_NAME_RE = re.compile(r'<([a-zA-Z][\w-]*)')
+
+# Компактная запись карточки - всё, что нужно для сборки товара.
+# fingerprint - отпечаток исходной разметки карточки (blake2b)
+CardRecord = namedtuple('CardRecord', ['tag', 'title', 'price_text', 'amount_text', 'href', 'status_texts',
+                                       'seller', 'fingerprint'])
+
+
+def _fingerprint_hasher():
+    return hashlib.blake2b(digest_size=8)
+
+
+def _class_tokens(attrs):
+    """Классы элемента из списка атрибутов HTMLParser"""
+    for name, value in attrs:
+        if name == 'class' and value:
+            return value.split()
+    return ()
+
+
+class PageLayout:
+    """Структурный отпечаток страницы: классы внутри карточек и найденные поля.
+
+    Цифры в классах сглажены (rating-5 → rating-#), чтобы отпечаток зависел
+    от вёрстки, а не от данных.
+    """
+
+    # Ключи (тег, класс) → ключ отпечатка, общие для всех страниц. Классы
+    # с данными внутри раздували бы кэш - переполненный он сбрасывается
+    _keys = {}
+    _keys_max = 4096
+
+    def __init__(self):
+        self.cards = 0
+        # Карточки, пропущенные инкрементальным разбором: их разметка не изменилась
+        self.skipped = 0
+        self.classes = {}
+        self.fields = {}
+
+    def add_tag(self, tag, classes):
+        counts = self.classes
+        for token in classes:
+            key = self._keys.get((tag, token))
+            if key is None:
+                if len(self._keys) >= self._keys_max:
+                    self._keys.clear()
+                key = self._keys[(tag, token)] = f"{tag}.{re.sub(r'[0-9]+', '#', token)}"
+            counts[key] = counts.get(key, 0) + 1
+
+    def add_card(self, found):
+        self.cards += 1
+        for field in found:
+            self.fields[field] = self.fields.get(field, 0) + 1
+
+    def rates(self):
+        """Доля карточек с каждым полем"""
+        return {field: count / self.cards for field, count in self.fields.items()} if self.cards else {}
+
+    def vector(self):
+        return {key: count / self.cards for key, count in self.classes.items()} if self.cards else {}
+
+
+class CardStreamParser(HTMLParser):
+    """Потоковый извлекатель карточек .tc-item.
+
+    Не строит DOM: держит только стек тегов текущей карточки и текст
+    нужных полей. Готовые записи копятся в self.cards до pop_cards().
+    strict=True - без запасных путей (заголовок из первого попавшегося
+    элемента, запасные классы статуса): ими пользуются при смене вёрстки.
+    """
+
+    def __init__(self, strict=False, layout=None):
+        super().__init__(convert_charrefs=True)
+        self.strict = strict
+        self.layout = layout
+        self.status_classes = STATUS_CLASSES[:1] if strict else STATUS_CLASSES
+        self.cards = []
+        self._stack = []
+        self._text = []
+        self._reset_card()
+
+    def _reset_card(self):
+        self._tag = None
+        self._href = None
+        self._href_seen = False
+        self._fields = {}
+        self._open = {}
+        self._title_seen = False
+        self._fallback_title = ''
+        self._hasher = None
+
+    def pop_cards(self):
+        cards, self.cards = self.cards, []
+        return cards
+
+    def _open_field(self, field, opened):
+        self._open[field] = []
+        opened.append(field)
+
+    def _flush_text(self):
+        # Текстовый узел может прийти несколькими кусками (граница chunk),
+        # поэтому strip делаем по целому узлу, как get_text(strip=True)
+        text = ''.join(self._text).strip()
+        self._text = []
+        if text:
+            for parts in self._open.values():
+                parts.append(text)
+
+    def handle_starttag(self, tag, attrs):
+        if self._text:
+            self._flush_text()
+        classes = _class_tokens(attrs)
+
+        if not self._stack:
+            if CARD_CLASS not in classes:
+                return
+            self._tag = tag
+            self._hasher = _fingerprint_hasher()
+        self._hasher.update(self.get_starttag_text().encode('utf-8'))
+        if self.layout is not None and classes:
+            self.layout.add_tag(tag, classes)
+        if tag in VOID_TAGS:
+            return
+
+        opened = []
+
+        if tag == 'a' and not self._href_seen:
+            self._href_seen = True
+            self._href = dict(attrs).get('href')
+
+        if tag == 'div':
+            if TITLE_CLASS in classes and not self._title_seen:
+                self._title_seen = True
+                self._open_field('title', opened)
+            if PRICE_CLASS in classes and 'price' not in self._fields and 'price' not in self._open:
+                self._open_field('price', opened)
+            if AMOUNT_CLASS in classes and 'amount' not in self._fields and 'amount' not in self._open:
+                self._open_field('amount', opened)
+            if SELLER_CLASS in classes and 'seller' not in self._fields and 'seller' not in self._open:
+                self._open_field('seller', opened)
+            for status_class in self.status_classes:
+                if status_class in classes and status_class not in self._fields and status_class not in self._open:
+                    self._open_field(status_class, opened)
+
+        if (not self.strict and not self._title_seen and 'hinted' not in self._fields and 'hinted' not in self._open
+                and any(hint in token for token in classes for hint in TITLE_HINTS)):
+            self._open_field('hinted', opened)
+
+        if (not self.strict and self._stack and tag in TITLE_FALLBACK_TAGS
+                and not self._fallback_title and 'fallback' not in self._open):
+            self._open_field('fallback', opened)
+
+        self._stack.append((tag, opened))
+
+    def handle_endtag(self, tag):
+        if self._text:
+            self._flush_text()
+        if not self._stack or tag in VOID_TAGS:
+            return
+        self._hasher.update(f'</{tag}>'.encode('utf-8'))
+        if not any(open_tag == tag for open_tag, _ in self._stack):
+            return
+
+        while self._stack:
+            open_tag, opened = self._stack.pop()
+            for field in opened:
+                text = ''.join(self._open.pop(field))
+                if field == 'fallback':
+                    self._fallback_title = text
+                else:
+                    self._fields[field] = text
+            if open_tag == tag:
+                break
+
+        if not self._stack:
+            self._finish_card()
+
+    def handle_data(self, data):
+        if self._stack:
+            self._hasher.update(data.encode('utf-8'))
+            if self._open:
+                self._text.append(data)
+
+    def handle_comment(self, data):
+        if self._text:
+            self._flush_text()
+
+    def _finish_card(self):
+        fields = self._fields
+        title = fields.get('title', '') if self._title_seen else fields.get('hinted') or self._fallback_title
+        if self.layout is not None:
+            found = [field for field in ('price', 'amount', 'seller') if fields.get(field)]
+            if self._title_seen and title:
+                found.append('title')
+            if self._href:
+                found.append('href')
+            if STATUS_CLASSES[0] in fields:
+                found.append('status')
+            self.layout.add_card(found)
+        self.cards.append(CardRecord(
+            tag=self._tag,
+            title=title,
+            price_text=fields.get('price'),
+            amount_text=fields.get('amount'),
+            href=self._href,
+            status_texts=tuple(fields[c].lower() for c in STATUS_CLASSES if c in fields),
+            seller=fields.get('seller'),
+            fingerprint=self._hasher.hexdigest(),
+        ))
+        self._reset_card()
+
+
+def iter_cards_stream(chunks, strict=False, layout=None):
+    """Потоковый разбор: читает куски страницы и сразу отдаёт готовые карточки"""
+    parser = CardStreamParser(strict, layout)
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode('utf-8', errors='replace')
+        parser.feed(chunk)
+        yield from parser.pop_cards()
+    parser.close()
+    yield from parser.pop_cards()
+
+
+def _card_starts(html):
+    """Позиции открывающих тегов карточек в сыром HTML.
+
+    Ищем подстроку класса и отступаем к '<' её тега: поиск подстроки
+    в разы быстрее регулярного выражения, пробующего каждый тег страницы.
+    """
+    starts = []
+    position = html.find(CARD_CLASS)
+    while position != -1:
+        after = position + len(CARD_CLASS)
+        if not CARD_TOKEN_RE.match(html, position - 1) and not CARD_TOKEN_RE.match(html, after):
+            tag_start = html.rfind('<', 0, position)
+            # Внутри открывающего тега и в атрибуте class
+            if (tag_start != -1 and html.find('>', tag_start, position) == -1
+                    and html[tag_start + 1:tag_start + 2].isalpha()
+                    and 'class' in html[tag_start:position]):
+                starts.append(tag_start)
+        position = html.find(CARD_CLASS, after)
+    return starts
+
+
+# Открывающие и закрывающие теги по имени: <div ...> и </div>
+_tag_res = {}
+
+
+def _card_end(html, start, limit):
+    """Конец карточки: за её закрывающим тегом, но не дальше limit (начала следующей).
+
+    Вложенные теги того же имени считаются, так что </div> внутренних
+    блоков карточку не закрывает. Без закрывающего тега - limit.
+    """
+    name = TAG_NAME_RE.match(html, start).group(1).lower()
+    tag_re = _tag_res.get(name)
+    if tag_re is None:
+        tag_re = _tag_res[name] = re.compile(rf'<(/?){re.escape(name)}[\s/>]', re.IGNORECASE)
+    depth = 0
+    for match in tag_re.finditer(html, start, limit):
+        if not match.group(1):
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 0:
+            close = html.find('>', match.start(), limit)
+            return close + 1 if close != -1 else limit
+    return limit
+
+
+def _blank_card(fingerprint):
+    """Запись без полей: карточка известна по отпечатку, разбирать её не нужно"""
+    return CardRecord(None, None, None, None, None, (), None, fingerprint)
+
+
+def iter_cards_sliced(html, known, layout=None):
+    """Инкрементальный строгий разбор без прохода HTMLParser по всей странице.
+
+    Сырой HTML режется на карточки: от открывающего тега до его пары
+    (подвал и разметка между карточками в куски не попадают), кусок
+    хэшируется, и парсер получает только куски с отпечатком не из known.
+    Известные карточки отдаются пустыми записями с тем же отпечатком -
+    товар для них берётся из прошлого снимка. Так цена опроса растёт
+    с числом изменившихся карточек, а не с размером страницы.
+    """
+    starts = _card_starts(html)
+    for index, start in enumerate(starts):
+        piece = html[start:_card_end(html, start, starts[index + 1] if index + 1 < len(starts) else len(html))]
+        hasher = _fingerprint_hasher()
+        hasher.update(piece.encode('utf-8'))
+        fingerprint = hasher.hexdigest()
+        if fingerprint in known:
+            if layout is not None:
+                layout.skipped += 1
+            yield _blank_card(fingerprint)
+            # В куске могло оказаться несколько карточек (вложенная разметка)
+            extra = 1
+            while f'{fingerprint}:{extra}' in known:
+                yield _blank_card(f'{fingerprint}:{extra}')
+                extra += 1
+            continue
+        records = list(iter_cards_stream([piece], strict=True, layout=layout))
+        if not records:
+            # Класс нашёлся не у карточки: запоминаем кусок, чтобы не разбирать его снова
+            yield _blank_card(fingerprint)
+        for number, record in enumerate(records):
+            yield record._replace(fingerprint=f'{fingerprint}:{number}' if number else fingerprint)
+
+
+def _soup_card_record(card, fingerprint):
+    """Запись карточки из элемента BeautifulSoup (старый путь)"""
+    title_elem = card.find('div', class_=TITLE_CLASS)
+    if title_elem:
+        title = title_elem.get_text(strip=True)
+    else:
+        title = ""
+        for elem in card.find_all(['div', 'span', 'h3', 'h4']):
+            if elem.get_text(strip=True):
+                title = elem.get_text(strip=True)
+                break
+
+    price_elem = card.find('div', class_=PRICE_CLASS)
+    amount_elem = card.find('div', class_=AMOUNT_CLASS)
+    seller_elem = card.find('div', class_=SELLER_CLASS)
+    link_elem = card if card.name == 'a' else card.find('a')
+
+    status_texts = []
+    for status_class in STATUS_CLASSES:
+        status_elem = card.find('div', class_=status_class)
+        if status_elem:
+            status_texts.append(status_elem.get_text(strip=True).lower())
+
+    return CardRecord(
+        tag=card.name,
+        title=title,
+        price_text=price_elem.get_text(strip=True) if price_elem else None,
+        amount_text=amount_elem.get_text(strip=True) if amount_elem else None,
+        href=link_elem.get('href') if link_elem else None,
+        status_texts=tuple(status_texts),
+        seller=seller_elem.get_text(strip=True) if seller_elem else None,
+        fingerprint=fingerprint,
+    )
+
+
+def iter_cards_soup(html):
+    """Разбор через BeautifulSoup: полное дерево + четыре селектора"""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+
+    # Ищем ВСЕ карточки товаров - используем более гибкий подход
+    # На FunPay могут быть разные структуры
+    all_cards = []
+    for selector in ['div.tc-item', 'a.tc-item', '.tc-item', '[class*="tc-item"]']:
+        found = soup.select(selector)
+        if found:
+            all_cards.extend(found)
+
+    # Убираем дубликаты (отпечаток заодно служит для инкрементального режима)
+    seen = set()
+    for card in all_cards:
+        hasher = _fingerprint_hasher()
+        hasher.update(str(card).encode('utf-8'))
+        fingerprint = hasher.hexdigest()
+        if fingerprint not in seen:
+            seen.add(fingerprint)
+            yield _soup_card_record(card, fingerprint)
+
+
+def build_item(record, url, category, engine=None):
+    """Товар из записи карточки или None, если под него не подходит ни одно правило"""
+    title = record.title
+    if not title:
+        return None
+
+    price = 0
+    if record.price_text:
+        digits = PRICE_DIGITS_RE.findall(record.price_text.replace(' ', ''))
+        if digits:
+            price = int(''.join(digits))
+
+    link = url
+    href = record.href
+    if href:
+        if href.startswith('/'):
+            link = f"https://funpay.com{href}"
+        elif href.startswith('http'):
+            link = href
+
+    # Статус продавца: на FunPay он может быть в разных местах
+    seller_online = any('онлайн' in text or 'online' in text for text in record.status_texts)
+
+    amount = parse_amount(record.amount_text, title)
+
+    item = {
+        'id': offer_key(title, price),
+        'title': title[:100],
+        'price': price,
+        'amount': amount,
+        'unit_price': unit_price(price, amount),
+        'link': link,
+        'category': category,
+        'seller': record.seller or None,
+        'seller_online': seller_online
+    }
+    
+    # Фильтрация - правилами (ключевые слова, цена, цена за единицу, продавец).
+    # Рейтинг продавца есть только на странице лота: при обогащении его
+    # условия проверяются после загрузки (enrich_offers)
+    item['rules'] = (engine or get_rule_engine()).match(item, title.lower(), partial=ENRICH_OFFERS)
+    if not item['rules']:
+        return None
+    return item
+
+
+# Результат опроса страницы. status - HTTP-код (0 - сетевая ошибка),
+# not_modified - сервер ответил 304 и парсер не запускался,
+# changed - товары из новых/изменённых карточек (в инкрементальном режиме)
+PageResult = namedtuple('PageResult', ['items', 'status', 'not_modified', 'changed', 'error'], defaults=(None,))
+
+# Снимок прошлого разбора для инкрементального режима: url -> {отпечаток: товар или None}
+_card_snapshots = {}
+
+
+def parse_page(url, category, mode=None, conditional=True, incremental=None):
+    """Загрузка и разбор страницы категории через общую сессию.
+
+    С conditional=True отправляет If-None-Match/If-Modified-Since, и на 304
+    отдаёт товары прошлого разбора, не запуская парсер.
+    С incremental=True карточки с тем же отпечатком, что в прошлом опросе,
+    не собираются заново, а в changed попадают только новые/изменённые.
+    """
+    mode = mode or PARSER_MODE
+    if incremental is None:
+        incremental = INCREMENTAL_PARSE
+    # Вся страница разбирается одними правилами. Если их перезагрузят посреди
+    # разбора, снимок и кэш 304 с товарами старых правил не сохраняются
+    engine = get_rule_engine()
+    generation = rules_generation(category)
+    try:
+        headers = {}
+        cached = _page_cache.get(url) if conditional else None
+        if cached:
+            etag, last_modified, _ = cached
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        
+        logger.info(f"⚡ Быстрый парсинг {category} ({mode})...")
+        
+        # БЫСТРЫЙ запрос с коротким таймаутом, тело читаем потоком (не больше FETCH_MAX_BYTES)
+        response = fetch(url, category, headers=headers, timeout=10, max_bytes=FETCH_MAX_BYTES)
+        
+        with response:
+            if response.status_code == 304:
+                _release_unread(response)
+                BYTES_DOWNLOADED.inc(response.raw.tell(), category=category)
+                if page_recorder:
+                    page_recorder.record(url, category, 304)
+                if not cached:
+                    return PageResult([], 304, True, [])
+                logger.info(f"💤 {category}: страница не изменилась (304)")
+                return PageResult(list(cached[2]), 304, True, [])
+            
+            parse_started = time.perf_counter()
+            body = iter_body(response, category)
+            if page_recorder:
+                body = page_recorder.tee(url, category, body)
+            # Отпечаток вёрстки снимается попутно; запасной разбор - только после расхождения
+            layout = None if mode == 'soup' else PageLayout()
+            strict = layout is not None and layout_monitor.strict(category)
+            # Прочитанное строгим разбором - на случай, если эту же страницу придётся разобрать заново
+            read = []
+            if mode == 'soup':
+                records = iter_cards_soup(''.join(body))
+            elif strict and incremental:
+                # Тело читается целиком всё равно - режем его по карточкам до парсера
+                read.append(''.join(body))
+                records = iter_cards_sliced(read[0], _card_snapshots.get(url, {}), layout)
+            elif strict:
+                records = iter_cards_stream(_remember(body, read), strict=True, layout=layout)
+            else:
+                records = iter_cards_fallback(''.join(body), layout)
+            
+            def take(records):
+                if incremental:
+                    return list(records)
+                # Обрабатываем только первые карточки (для скорости):
+                # потоковый парсер перестаёт разбирать страницу, набрав нужное число
+                return list(itertools.islice(records, MAX_CARDS_PER_PAGE))
+            
+            cards = take(records)
+            switched = layout is not None and layout_monitor.observe(category, layout)
+            if switched and strict:
+                # Строгий разбор не понял новую вёрстку - эту же страницу разбираем
+                # запасным способом, а не отдаём пустой опрос
+                cards = take(iter_cards_fallback(''.join(itertools.chain(read, body)), PageLayout()))
+            if not incremental and mode != 'soup':
+                _release_unread(response)
+            BYTES_DOWNLOADED.inc(response.raw.tell(), category=category)
+        
+        previous = _card_snapshots.get(url, {}) if incremental else {}
+        snapshot = {}
+        items = []
+        changed = []
+        for record in cards:
+            if record.fingerprint in previous:
+                # Карточка не изменилась - берём готовый товар из прошлого опроса
+                item = previous[record.fingerprint]
+            else:
+                try:
+                    item = build_item(record, url, category, engine)
+                except Exception as e:
+                    logger.debug(f"⚠️ Ошибка карточки: {e}")
+                    item = None
+                if item:
+                    changed.append(item)
+                    logger.info(f"   ✅ '{item['title'][:40]}...' - {item['price']} руб. {'(онлайн)' if item['seller_online'] else ''}")
+            snapshot[record.fingerprint] = item
+            if item:
+                items.append(item)
+        
+        current = generation == rules_generation(category)
+        if incremental and current:
+            _card_snapshots[url] = snapshot
+        elif not incremental:
+            changed = items
+        if switched and not strict:
+            # Вёрстка снова совпала с эталоном - следующий опрос разберёт все карточки строго
+            forget_page(url)
+        
+        cards_changed = len(cards) - len(previous.keys() & snapshot.keys())
+        PARSE_SECONDS.observe(time.perf_counter() - parse_started, category=category)
+        CARDS_SEEN.inc(len(cards), category=category)
+        CARDS_CHANGED.inc(cards_changed, category=category)
+        ITEMS_MATCHED.inc(len(changed), category=category)
+        logger.info(f"📦 Обработано карточек: {len(cards)}, изменилось: {cards_changed}")
+        
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if conditional and current and (etag or last_modified):
+            with _page_cache_lock:
+                _page_cache[url] = (etag, last_modified, items)
+        
+        logger.info(f"🎯 Найдено подходящих товаров: {len(items)}")
+        return PageResult(items, 200, False, changed)
+        
+    except FetchError as e:
+        # Вид ошибки виден снаружи: «заблокированы» не выглядит как «нет товаров»
+        logger.error(f"❌ {category}: {e.kind}: {e}")
+        if page_recorder:
+            page_recorder.record(url, category, e.status, error=e.kind)
+        return PageResult([], e.status, False, [], e.kind)
+    except Exception as e:
+        FETCH_ERRORS.inc(category=category, kind='parse')
+        logger.error(f"💥 Неизвестная ошибка: {e}")
+        return PageResult([], 0, False, [], 'parse')
+
+
+def fast_parse_black_russia(url, category, mode=None):
+    """БЫСТРЫЙ парсинг для Render (таймаут 10 секунд)"""
+    # Разовый разбор (тесты, /test): без 304 и снимков, чтобы не сбить мониторинг
+    return parse_page(url, category, mode=mode, conditional=False, incremental=False).items
+
+
+def _remember(chunks, read):
+    """Пропускает куски тела дальше, складывая их в read"""
+    for chunk in chunks:
+        read.append(chunk)
+        yield chunk
+
+
+def forget_page(url):
+    """Сбрасывает кэш 304 и снимок карточек: следующий опрос разберёт страницу целиком"""
+    with _page_cache_lock:
+        _page_cache.pop(url, None)
+    _card_snapshots.pop(url, None)
+
+
+def forget_all_pages():
+    with _page_cache_lock:
+        _page_cache.clear()
+    _card_snapshots.clear()
+
+
+def dump_pages():
+    """Валидаторы 304 и снимки карточек по страницам (для снимка мониторинга)"""
+    with _page_cache_lock:
+        cached = dict(_page_cache)
+    pages = {}
+    for url, cards in list(_card_snapshots.items()):
+        pages[url] = {'cards': cards}
+    for url, (etag, last_modified, items) in cached.items():
+        pages.setdefault(url, {}).update(etag=etag, last_modified=last_modified, items=items)
+    return pages
+
+
+def restore_pages(pages):
+    """Обратно к dump_pages: первый опрос после перезапуска получит 304 или разберёт только новое"""
+    for url, page in pages.items():
+        if 'cards' in page:
+            _card_snapshots[url] = page['cards']
+        if 'items' in page:
+            with _page_cache_lock:
+                _page_cache[url] = (page['etag'], page['last_modified'], page['items'])
+
+
+# ==================== КОНТРОЛЬ ВЁРСТКИ ====================
+
+# Сходство отпечатка с эталоном (косинус), ниже которого вёрстка считается изменившейся
+LAYOUT_MIN_SIMILARITY = float(os.environ.get('LAYOUT_MIN_SIMILARITY', 0.85))
+# Насколько может упасть доля карточек с полем (заголовок, цена...) относительно эталона
+LAYOUT_MAX_FIELD_DROP = 0.3
+# Без заголовка по классу у стольких карточек строгий разбор бесполезен
+LAYOUT_MIN_TITLE_RATE = 0.5
+# Эталон снимается со страницы, где карточек не меньше
+LAYOUT_MIN_CARDS = 5
+
+LAYOUT_SIMILARITY = Gauge('funpay_layout_similarity', 'Сходство вёрстки карточек с эталоном', ['category'])
+LAYOUT_DRIFTS = Counter('funpay_layout_drifts_total', 'Обнаружено изменений вёрстки', ['category'])
+LAYOUT_FALLBACK = Gauge('funpay_layout_fallback', 'Категория разбирается запасным способом (1/0)', ['category'])
+
+
+def _cosine(a, b):
+    dot = sum(value * b.get(key, 0.0) for key, value in a.items())
+    norm = math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values()))
+    return dot / norm if norm else 0.0
+
+
+class LayoutMonitor:
+    """Сверка структуры страниц с эталоном и выбор способа разбора.
+
+    Пока вёрстка совпадает с эталоном, категория разбирается строгим
+    потоковым парсером без запасных путей. Без эталона и при расхождении -
+    запасной разбор (все эвристики, а без карточек - BeautifulSoup по
+    подстроке класса) и оповещение; когда вёрстка снова совпадает, строгий
+    разбор возвращается. Эталоны хранятся в общем состоянии.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._baselines = None
+        self._fallback = set()
+        self.similarity = {}
+
+    def _load(self):
+        if self._baselines is None:
+            self._baselines = dict(state.get_status('layout_baselines') or {})
+        return self._baselines
+
+    def strict(self, category):
+        """Строгий разбор - только по снятому эталону и без расхождения с ним"""
+        with self._lock:
+            return category in self._load() and category not in self._fallback
+
+    def _drift(self, category, details):
+        """Переводит категорию на запасной разбор и оповещает (под self._lock)"""
+        self._fallback.add(category)
+        LAYOUT_DRIFTS.inc(category=category)
+        LAYOUT_FALLBACK.set(1, category=category)
+        logger.warning(f"📐 Вёрстка {category} изменилась: {details}")
+        send_telegram_message(
+            f"⚠️ <b>Вёрстка FunPay изменилась</b>\n\n"
+            f"Категория: {escape(category)}\n{escape(details)}\n\n"
+            f"Включён запасной разбор. Проверьте /test; принять новую вёрстку - POST /layout/reset"
+        )
+
+    def observe(self, category, layout):
+        """Сверяет страницу с эталоном. True - способ разбора категории сменился"""
+        with self._lock:
+            baselines = self._load()
+            baseline = baselines.get(category)
+            rates = layout.rates()
+            if baseline is None:
+                # Без эталона страница разобрана запасным способом - способ не меняется,
+                # пока эталон не снят со следующей нормальной страницы
+                if layout.cards < LAYOUT_MIN_CARDS:
+                    return False
+                if rates.get('title', 0) < LAYOUT_MIN_TITLE_RATE:
+                    # Вёрстка разошлась раньше, чем появился эталон
+                    if category not in self._fallback:
+                        self._drift(category, f"эталона нет, карточек {layout.cards}, "
+                                              f"заголовков {rates.get('title', 0):.0%}")
+                    return False
+                baselines[category] = {
+                    'vector': layout.vector(),
+                    'rates': rates,
+                    'cards': layout.cards,
+                    'created_at': time.time(),
+                }
+                state.set_status('layout_baselines', baselines)
+                self._fallback.discard(category)
+                LAYOUT_FALLBACK.set(0, category=category)
+                logger.info(f"📐 Эталон вёрстки {category}: {layout.cards} карточек, {len(layout.classes)} классов")
+                return False
+            if layout.cards < LAYOUT_MIN_CARDS:
+                # Инкрементальный разбор увидел лишь несколько новых карточек, а пустая
+                # страница (категория опустела, заглушка вместо выдачи) - не сигнал: судить не по чему
+                return False
+
+            similarity = _cosine(layout.vector(), baseline['vector'])
+            drops = {field: rate - rates.get(field, 0.0) for field, rate in baseline['rates'].items()}
+            worst_field = max(drops, key=drops.get, default=None)
+            drifted = (similarity < LAYOUT_MIN_SIMILARITY
+                       or (worst_field is not None and drops[worst_field] > LAYOUT_MAX_FIELD_DROP)
+                       or rates.get('title', 0) < LAYOUT_MIN_TITLE_RATE)
+            self.similarity[category] = round(similarity, 3)
+            LAYOUT_SIMILARITY.set(similarity, category=category)
+
+            if drifted and category not in self._fallback:
+                self._drift(category, f"сходство {similarity:.2f}, карточек {layout.cards}"
+                            + (f", поле «{worst_field}» {rates.get(worst_field, 0):.0%} "
+                               f"(было {baseline['rates'][worst_field]:.0%})" if worst_field else ""))
+                return True
+            if not drifted and category in self._fallback:
+                self._fallback.discard(category)
+                LAYOUT_FALLBACK.set(0, category=category)
+                logger.info(f"📐 Вёрстка {category} снова совпадает с эталоном (сходство {similarity:.2f})")
+                return True
+            return False
+
+    def reset(self, category=None):
+        """Забывает эталон (следующая страница станет новым) и возвращает строгий разбор"""
+        with self._lock:
+            baselines = self._load()
+            for name in ([category] if category else list(baselines) + list(self._fallback)):
+                baselines.pop(name, None)
+                self._fallback.discard(name)
+                self.similarity.pop(name, None)
+                LAYOUT_FALLBACK.set(0, category=name)
+            state.set_status('layout_baselines', baselines)
+
+    def stats(self):
+        with self._lock:
+            baselines = self._load()
+            return {
+                name: {
+                    'strategy': 'strict' if name not in self._fallback else 'fallback',
+                    'similarity': self.similarity.get(name),
+                    'baseline_cards': baselines[name]['cards'] if name in baselines else None,
+                }
+                for name in set(baselines) | self._fallback
+            }
+
+
+layout_monitor = LayoutMonitor()
+startup_phase('parsing')
+
+
+def iter_cards_fallback(html, layout):
+    """Запасной разбор при изменившейся вёрстке: все эвристики потокового
+    парсера, а если карточек .tc-item нет совсем - BeautifulSoup по подстроке класса"""
+    cards = list(iter_cards_stream([html], strict=False, layout=layout))
+    if not cards:
+        cards = list(iter_cards_soup(html))
+    return iter(cards)
+
+
+# ==================== КАТЕГОРИИ И ОПРОС ====================
+
+Category = namedtuple('Category', ['url', 'name'])
+
+DEFAULT_CATEGORIES = [
+    Category("https://funpay.com/chips/186/", "Black Russia - Вирты"),
+]
+
+# Параллельный опрос: общий пул потоков + лимит одновременных запросов на хост
+POLL_WORKERS = int(os.environ.get('POLL_WORKERS', 8))
+PER_HOST_CONCURRENCY = int(os.environ.get('PER_HOST_CONCURRENCY', 4))
+# Сколько секунд цикл ждёт страницы, прежде чем бросить отстающие
+POLL_DEADLINE = float(os.environ.get('POLL_DEADLINE', 25))
+
+
+def load_categories():
+    """Реестр категорий.
+
+    Источник: переменная MONITOR_CATEGORIES (JSON) или файл CATEGORIES_FILE
+    (по умолчанию categories.json). Формат - список объектов
+    {"url": "...", "name": "..."} или пар ["url", "name"].
+    """
+    raw = os.environ.get('MONITOR_CATEGORIES', '').strip()
+    path = os.environ.get('CATEGORIES_FILE', 'categories.json')
+    try:
+        if not raw and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                raw = f.read()
+        if not raw:
+            return list(DEFAULT_CATEGORIES)
+
+        categories = []
+        for entry in json.loads(raw):
+            if isinstance(entry, dict):
+                categories.append(Category(entry['url'], entry.get('name') or entry['url']))
+            else:
+                url, name = entry
+                categories.append(Category(url, name))
+        logger.info(f"📂 Загружено категорий: {len(categories)}")
+        return categories or list(DEFAULT_CATEGORIES)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.error(f"❌ Ошибка реестра категорий: {e}, используем стандартные")
+        return list(DEFAULT_CATEGORIES)
+
+
+CATEGORIES = load_categories()
+
+_poll_executor = ThreadPoolExecutor(max_workers=POLL_WORKERS, thread_name_prefix='poll')
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+
+def _host_slot(url):
+    """Семафор хоста: не больше PER_HOST_CONCURRENCY запросов к одному сайту"""
+    host = urlparse(url).netloc
+    with _host_slots_lock:
+        slot = _host_slots.get(host)
+        if slot is None:
+            slot = _host_slots[host] = threading.BoundedSemaphore(PER_HOST_CONCURRENCY)
+    return slot
+
+
+def _poll_category(category):
+    with _host_slot(category.url):
+        return parse_page(category.url, category.name)
+
+
+def poll_categories(categories, deadline=POLL_DEADLINE):
+    """Параллельный опрос категорий.
+
+    Отдаёт (category, PageResult) по мере готовности страниц, так что медленная
+    страница не задерживает остальные. Что не успело к deadline - бросаем.
+    """
+    futures = {_poll_executor.submit(_poll_category, category): category for category in categories}
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            yield futures[future], future.result()
+    except FuturesTimeoutError:
+        late = []
+        for future, category in futures.items():
+            if not future.done():
+                late.append(category.name)
+                # Результат опоздавшей страницы никто не увидит - пусть следующий
+                # цикл разберёт её заново, иначе новые карточки потеряются
+                future.add_done_callback(lambda _, url=category.url: forget_page(url))
+        logger.warning(f"⏱️ Не уложились в {deadline:g} сек: {', '.join(late)}")
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+# ==================== ОБОГАЩЕНИЕ ПРЕДЛОЖЕНИЙ ====================
+
+# Загрузка страницы лота: рейтинг и отзывы продавца, его настоящий статус и наличие
+ENRICH_OFFERS = os.environ.get('ENRICH_OFFERS', '0').strip().lower() in ('1', 'true', 'yes', 'on')
+ENRICH_WORKERS = int(os.environ.get('ENRICH_WORKERS', 4))
+# Сведения о продавце живут в кэше столько секунд
+ENRICH_CACHE_TTL = float(os.environ.get('ENRICH_CACHE_TTL', 600))
+ENRICH_CACHE_SIZE = 5000
+# Не больше стольких загрузок за цикл и не чаще одной в ENRICH_MIN_INTERVAL секунд
+ENRICH_MAX_FETCHES = int(os.environ.get('ENRICH_MAX_FETCHES', 20))
+ENRICH_MIN_INTERVAL = float(os.environ.get('ENRICH_MIN_INTERVAL', 0.25))
+ENRICH_MAX_BYTES = 1024 * 1024
+
+LOT_STATUS_CLASS = 'media-user-status'
+LOT_RATING_CLASS = 'rating-value'
+LOT_STARS_CLASS = 'rating-stars'
+LOT_REVIEWS_CLASSES = ('rating-full-count', 'rating-mini-count')
+LOT_PARAM_CLASS = 'param-item'
+LOT_STOCK_LABELS = ('наличие', 'available', 'в наличии')
+RATING_RE = re.compile(r'\d+(?:[.,]\d+)?')
+
+ENRICH_RESULTS = Counter('funpay_enrich_total', 'Обогащение предложений по исходу', ['result'])
+
+# Сведения со страницы лота (None - не нашлось на странице)
+LotInfo = namedtuple('LotInfo', ['link', 'seller_rating', 'seller_reviews', 'seller_online', 'stock'])
+
+
+class LotPageParser(HTMLParser):
+    """Потоковый разбор страницы лота: только блок продавца и параметры"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.fields = {}
+        self.params = {}
+        self._stack = []
+        self._open = {}
+        self._label = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            return
+        classes = _class_tokens(attrs)
+        opened = []
+        for field in (LOT_STATUS_CLASS, LOT_RATING_CLASS, LOT_PARAM_CLASS) + LOT_REVIEWS_CLASSES:
+            if field in classes and field not in self.fields and field not in self._open:
+                self._open[field] = []
+                opened.append(field)
+        if LOT_STARS_CLASS in classes and 'stars' not in self.fields:
+            for token in classes:
+                if token.startswith('rating-') and token[7:].isdigit():
+                    self.fields['stars'] = token[7:]
+        if tag == 'h5' and LOT_PARAM_CLASS in self._open and 'label' not in self._open:
+            self._open['label'] = []
+            opened.append('label')
+        self._stack.append((tag, opened))
+
+    def handle_endtag(self, tag):
+        if tag in VOID_TAGS or not any(open_tag == tag for open_tag, _ in self._stack):
+            return
+        while self._stack:
+            open_tag, opened = self._stack.pop()
+            for field in opened:
+                text = ' '.join(self._open.pop(field)).strip()
+                if field == 'label':
+                    self._label = text.lower()
+                elif field == LOT_PARAM_CLASS:
+                    # Параметр «Наличие 1000 кк»: значение - текст без подписи
+                    if self._label and text.lower().startswith(self._label):
+                        self.params[self._label] = text[len(self._label):].strip()
+                    self._label = None
+                else:
+                    self.fields[field] = text
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        data = data.strip()
+        if data:
+            for parts in self._open.values():
+                parts.append(data)
+
+    def info(self, link):
+        fields = self.fields
+        rating = None
+        match = RATING_RE.search(fields.get(LOT_RATING_CLASS) or fields.get('stars') or '')
+        if match:
+            rating = float(match.group().replace(',', '.'))
+        reviews = None
+        for field in LOT_REVIEWS_CLASSES:
+            digits = PRICE_DIGITS_RE.findall(fields.get(field) or '')
+            if digits:
+                reviews = int(''.join(digits))
+                break
+        online = None
+        if LOT_STATUS_CLASS in fields:
+            status = fields[LOT_STATUS_CLASS].lower()
+            online = 'онлайн' in status or 'online' in status
+        stock = None
+        for label, value in self.params.items():
+            if any(stock_label in label for stock_label in LOT_STOCK_LABELS):
+                stock = parse_amount(value, '')
+                break
+        return LotInfo(link, rating, reviews, online, stock)
+
+
+def fetch_lot_info(link):
+    """Загрузка и разбор страницы лота (тело не больше ENRICH_MAX_BYTES). FetchError - не вышло"""
+    with _host_slot(link):
+        response = fetch(link, 'lot', timeout=(3, 5), max_bytes=ENRICH_MAX_BYTES)
+        with response:
+            parser = LotPageParser()
+            for chunk in iter_body(response, 'lot', ENRICH_MAX_BYTES):
+                parser.feed(chunk)
+            BYTES_DOWNLOADED.inc(response.raw.tell(), category='lot')
+    parser.close()
+    return parser.info(link)
+
+
+class OfferEnricher:
+    """Обогащение предложений со страниц лотов.
+
+    Ключ кэша - продавец (если известен с карточки), иначе ссылка на лот:
+    у продавца с 20 лотами загружается одна страница. Одинаковые загрузки
+    в полёте объединяются, опоздавшие к сроку цикла не ждутся - их
+    результат попадёт в кэш и пригодится в следующем цикле.
+    """
+
+    def __init__(self, workers=ENRICH_WORKERS, ttl=ENRICH_CACHE_TTL, fetch=None):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='enrich')
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self._next_fetch = 0.0
+        self.ttl = ttl
+        self.fetch = fetch or fetch_lot_info
+
+    @staticmethod
+    def cache_key(item):
+        return f"seller:{item['seller']}" if item.get('seller') else f"offer:{item['link']}"
+
+    def _cached(self, key, now):
+        entry = self._cache.get(key)
+        if entry and entry[0] > now:
+            return entry[1]
+        return None
+
+    def _fetch(self, key, link):
+        # Равномерный темп загрузок, чтобы не получить 429 от FunPay
+        with self._lock:
+            delay = self._next_fetch - time.time()
+            self._next_fetch = max(self._next_fetch, time.time()) + ENRICH_MIN_INTERVAL
+        if delay > 0:
+            time.sleep(delay)
+        return self.fetch(link)
+
+    def _done(self, key, future):
+        with self._lock:
+            self._inflight.pop(key, None)
+            if future.cancelled() or future.exception() is not None:
+                return
+            self._cache[key] = (time.time() + self.ttl, future.result())
+            self._cache.move_to_end(key)
+            while len(self._cache) > ENRICH_CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+    def lookup(self, items, deadline, max_fetches=ENRICH_MAX_FETCHES):
+        """Сведения для товаров: {ключ: LotInfo} по тем, что успели к deadline"""
+        now = time.time()
+        found = {}
+        waiting = {}
+        with self._lock:
+            for item in items:
+                key = self.cache_key(item)
+                if key in found or key in waiting:
+                    continue
+                info = self._cached(key, now)
+                if info is not None:
+                    found[key] = info
+                    ENRICH_RESULTS.inc(result='cached')
+                elif key in self._inflight:
+                    waiting[key] = self._inflight[key]
+                elif max_fetches > 0:
+                    max_fetches -= 1
+                    future = self._executor.submit(self._fetch, key, item['link'])
+                    self._inflight[key] = waiting[key] = future
+                    future.add_done_callback(lambda f, key=key: self._done(key, f))
+                else:
+                    ENRICH_RESULTS.inc(result='skipped')
+        
+        if waiting:
+            wait(waiting.values(), timeout=max(deadline - time.time(), 0))
+        for key, future in waiting.items():
+            if not future.done():
+                ENRICH_RESULTS.inc(result='late')
+            elif future.exception() is not None:
+                ENRICH_RESULTS.inc(result='error')
+                logger.debug(f"⚠️ Страница лота не загружена ({key}): {future.exception()}")
+            else:
+                ENRICH_RESULTS.inc(result='fetched')
+                found[key] = future.result()
+        return found
+
+    def stats(self):
+        with self._lock:
+            return {'cached': len(self._cache), 'inflight': len(self._inflight)}
+
+
+offer_enricher = OfferEnricher()
+
+
+def enrich_offers(items, deadline):
+    """Дополняет товары сведениями со страниц лотов и заново проверяет правила.
+
+    Возвращает копии товаров, которые по-прежнему подходят. Товары без
+    сведений (опоздали, ошибка, лимит) проверяются по данным карточки.
+    """
+    if not ENRICH_OFFERS or not items:
+        return items
+    # Первыми загружаются лоты продавцов, онлайн по карточке
+    found = offer_enricher.lookup(sorted(items, key=lambda item: not item.get('seller_online')), deadline)
+    engine = get_rule_engine()
+    enriched = []
+    for item in items:
+        item = dict(item)
+        info = found.get(OfferEnricher.cache_key(item))
+        if info is not None:
+            item['seller_rating'] = info.seller_rating
+            item['seller_reviews'] = info.seller_reviews
+            if info.seller_online is not None:
+                item['seller_online'] = info.seller_online
+            # Наличие - свойство лота, а не продавца
+            if info.link == item['link'] and info.stock is not None:
+                item['stock'] = info.stock
+        item['rules'] = engine.match(item)
+        if item['rules']:
+            enriched.append(item)
+    return enriched
+
+
+# ==================== ПЛАНИРОВЩИК ОПРОСА ====================
+
+# Базовый интервал опроса категории и его границы (секунды)
+POLL_INTERVAL = float(os.environ.get('POLL_INTERVAL', 30))
+POLL_MIN_INTERVAL = float(os.environ.get('POLL_MIN_INTERVAL', 10))
+POLL_MAX_INTERVAL = float(os.environ.get('POLL_MAX_INTERVAL', 300))
+POLL_MAX_BACKOFF = float(os.environ.get('POLL_MAX_BACKOFF', 900))
+# Общий бюджет запросов к FunPay в минуту на все категории
+POLL_BUDGET_PER_MINUTE = float(os.environ.get('POLL_BUDGET_PER_MINUTE', 120))
+# Коды, на которые отвечаем экспоненциальной паузой, а не обычным интервалом
+THROTTLE_STATUSES = frozenset([403, 429, 503])
+
+
+class PollScheduler:
+    """Адаптивное расписание опроса.
+
+    У каждой категории своё время следующего опроса: на активной странице
+    интервал сокращается, на статичной (или 304) растёт, при ошибках и
+    429/503 - экспоненциальная пауза со случайным разбросом. Сверху всё
+    ограничено общим бюджетом запросов (token bucket).
+    """
+
+    def __init__(self, categories, budget_per_minute=POLL_BUDGET_PER_MINUTE, clock=None):
+        self.clock = clock = clock or time.time
+        now = clock()
+        self.budget = budget_per_minute
+        self._tokens = budget_per_minute
+        self._refilled_at = now
+        self._lock = threading.Lock()
+        self._slots = {}
+        for index, category in enumerate(categories):
+            # Разносим первые опросы, чтобы не бить по FunPay залпом
+            self._slots[category] = {
+                'next': now + index * min(POLL_INTERVAL / max(len(categories), 1), 1.0),
+                'interval': POLL_INTERVAL,
+                'errors': 0,
+                'polls': 0,
+            }
+
+    def _refill(self, now):
+        self._tokens = min(self.budget, self._tokens + (now - self._refilled_at) * self.budget / 60)
+        self._refilled_at = now
+
+    def due(self):
+        """Категории, которым пора на опрос (сначала самые просроченные), в пределах бюджета"""
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            ready = sorted((slot['next'], category) for category, slot in self._slots.items() if slot['next'] <= now)
+            granted = []
+            for scheduled_at, category in ready:
+                if self._tokens < 1:
+                    break
+                self._tokens -= 1
+                granted.append(category)
+                SCHEDULER_LAG.observe(now - scheduled_at, category=category.name)
+            return granted
+
+    def take(self, categories):
+        """Внеплановый опрос (ручная проверка): те из categories, на которые хватает бюджета"""
+        with self._lock:
+            self._refill(self.clock())
+            granted = []
+            for category in categories:
+                if self._tokens < 1:
+                    break
+                self._tokens -= 1
+                granted.append(category)
+            return granted
+
+    def record(self, category, result):
+        """Подстраивает интервал категории по результату опроса"""
+        with self._lock:
+            slot = self._slots.get(category)
+            if slot is None:
+                return
+            now = self.clock()
+            slot['polls'] += 1
+
+            if result is None or result.status in THROTTLE_STATUSES or result.status not in (200, 304):
+                slot['errors'] += 1
+                delay = min(POLL_INTERVAL * 2 ** slot['errors'], POLL_MAX_BACKOFF)
+                slot['next'] = now + delay * random.uniform(0.5, 1.0)
+                return
+
+            slot['errors'] = 0
+            if result.not_modified or not result.changed:
+                slot['interval'] = min(slot['interval'] * 1.5, POLL_MAX_INTERVAL)
+            elif slot['polls'] > 1:
+                # Первый опрос видит все карточки «новыми» - это не активность
+                slot['interval'] = max(slot['interval'] / (1 + min(len(result.changed), 4)), POLL_MIN_INTERVAL)
+            slot['next'] = now + slot['interval'] * random.uniform(0.9, 1.1)
+
+    def next_wakeup(self):
+        """Когда планировщику снова будет что опрашивать (с учётом бюджета)"""
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            earliest = min((slot['next'] for slot in self._slots.values()), default=now + POLL_INTERVAL)
+            if self._tokens < 1:
+                earliest = max(earliest, now + (1 - self._tokens) * 60 / self.budget)
+            return earliest
+
+    def dump(self):
+        """Расписание по url категорий (для снимка мониторинга)"""
+        with self._lock:
+            return {
+                category.url: {key: slot[key] for key in ('next', 'interval', 'errors')}
+                for category, slot in self._slots.items()
+            }
+
+    def restore(self, slots):
+        """Продолжает расписание прошлого воркера; незнакомые категории пропускаются"""
+        with self._lock:
+            for category, slot in self._slots.items():
+                saved = slots.get(category.url)
+                if saved:
+                    slot.update(next=saved['next'], interval=saved['interval'], errors=saved['errors'])
+
+    def stats(self):
+        with self._lock:
+            now = self.clock()
+            return {
+                'budget_per_minute': self.budget,
+                'tokens': round(self._tokens, 2),
+                'categories': {
+                    category.name: {
+                        'interval': round(slot['interval'], 1),
+                        'next_in': round(slot['next'] - now, 1),
+                        'errors': slot['errors'],
+                    }
+                    for category, slot in self._slots.items()
+                },
+            }
+
+
+scheduler = PollScheduler(CATEGORIES)
+startup_phase('categories')
+
+# ==================== УВИДЕННЫЕ ТОВАРЫ ====================
+
+# Хранилище увиденных: 'lru' - точное с TTL/LRU, 'bloom' - фиксированного размера
+SEEN_STORE_KIND = os.environ.get('SEEN_STORE', 'lru').strip().lower()
+SEEN_MAX_ITEMS = int(os.environ.get('SEEN_MAX_ITEMS', 50000))
+SEEN_TTL = float(os.environ.get('SEEN_TTL_HOURS', 72)) * 3600
+SEEN_BLOOM_ERROR_RATE = float(os.environ.get('SEEN_BLOOM_ERROR_RATE', 0.001))
+# Куда сохранять увиденное между перезапусками воркера ('' - не сохранять)
+SEEN_STORE_PATH = os.environ.get('SEEN_STORE_PATH', 'seen_items.json').strip()
+
+
+def offer_key(title, price):
+    """Стабильный ключ предложения: одинаков во всех процессах и после перезапуска"""
+    return hashlib.blake2b(f"{title}\x1f{price}".encode('utf-8'), digest_size=8).hexdigest()
+
+
+class SeenStore:
+    """Увиденные ключи с TTL и вытеснением давно не встречавшихся (LRU).
+
+    Хранит только ключ и время последней встречи, а не весь товар.
+    """
+
+    # Примерная цена записи: строка-ключ, float, узел OrderedDict
+    ENTRY_BYTES = 200
+
+    def __init__(self, capacity=SEEN_MAX_ITEMS, ttl=SEEN_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted_ttl = 0
+        self.evicted_lru = 0
+        self.dirty = False
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        with self._lock:
+            seen_at = self._items.get(key)
+            return seen_at is not None and time.time() - seen_at < self.ttl
+
+    def add(self, key, now=None):
+        """Отмечает ключ увиденным. True - ключ новый (надо оповещать)"""
+        now = now or time.time()
+        with self._lock:
+            self._expire(now)
+            is_new = key not in self._items
+            self._items[key] = now
+            self._items.move_to_end(key)
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+                self.evicted_lru += 1
+            self.dirty = True
+            return is_new
+
+    def _expire(self, now):
+        # Записи упорядочены по времени последней встречи - старые в начале
+        items = self._items
+        while items:
+            key, seen_at = next(iter(items.items()))
+            if now - seen_at < self.ttl:
+                break
+            del items[key]
+            self.evicted_ttl += 1
+
+    def stats(self):
+        return {
+            'kind': 'lru',
+            'size': len(self._items),
+            'capacity': self.capacity,
+            'ttl_hours': self.ttl / 3600,
+            'memory_bytes': len(self._items) * self.ENTRY_BYTES,
+            'memory_limit_bytes': self.capacity * self.ENTRY_BYTES,
+            'evicted_ttl': self.evicted_ttl,
+            'evicted_lru': self.evicted_lru,
+            'evictions': self.evicted_ttl + self.evicted_lru,
+        }
+
+    def dump(self):
+        with self._lock:
+            return {'kind': 'lru', 'items': list(self._items.items())}
+
+    def restore(self, data):
+        now = time.time()
+        with self._lock:
+            for key, seen_at in data.get('items', []):
+                if now - seen_at < self.ttl:
+                    self._items[key] = seen_at
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+
+
+class BloomSeenStore:
+    """Увиденные ключи в двух поколениях фильтра Блума фиксированного размера.
+
+    Память не зависит от числа предложений. Когда текущее поколение
+    заполнено (capacity/2 ключей) или старше ttl/2, предыдущее выбрасывается
+    целиком - так ключ живёт от ttl/2 до ttl. Ложные срабатывания (с
+    вероятностью ~error_rate) означают пропущенное оповещение.
+    """
+
+    def __init__(self, capacity=SEEN_MAX_ITEMS, ttl=SEEN_TTL, error_rate=SEEN_BLOOM_ERROR_RATE):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.error_rate = error_rate
+        generation = max(capacity // 2, 1)
+        self.bits = max(int(-generation * math.log(error_rate) / math.log(2) ** 2), 64)
+        self.hashes = max(int(round(self.bits / generation * math.log(2))), 1)
+        self._lock = threading.Lock()
+        self._current = bytearray((self.bits + 7) // 8)
+        self._previous = bytearray(len(self._current))
+        self._current_count = 0
+        self._previous_count = 0
+        self._rotated_at = time.time()
+        self.evictions = 0
+        self.dirty = False
+
+    def __len__(self):
+        return self._current_count + self._previous_count
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    @staticmethod
+    def _test(bits, positions):
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in positions)
+
+    def __contains__(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            return self._test(self._current, positions) or self._test(self._previous, positions)
+
+    def add(self, key, now=None):
+        """Отмечает ключ увиденным. True - ключ новый (надо оповещать)"""
+        now = now or time.time()
+        positions = self._positions(key)
+        with self._lock:
+            if (self._current_count >= self.capacity // 2
+                    or now - self._rotated_at >= self.ttl / 2):
+                self.evictions += self._previous_count
+                self._previous, self._current = self._current, bytearray(len(self._current))
+                self._previous_count, self._current_count = self._current_count, 0
+                self._rotated_at = now
+
+            if self._test(self._current, positions):
+                return False
+            is_new = not self._test(self._previous, positions)
+            for p in positions:
+                self._current[p >> 3] |= 1 << (p & 7)
+            self._current_count += 1
+            self.dirty = True
+            return is_new
+
+    def stats(self):
+        size = len(self._current) * 2
+        return {
+            'kind': 'bloom',
+            'size': len(self),
+            'capacity': self.capacity,
+            'ttl_hours': self.ttl / 3600,
+            'error_rate': self.error_rate,
+            'memory_bytes': size,
+            'memory_limit_bytes': size,
+            'evictions': self.evictions,
+        }
+
+    def dump(self):
+        with self._lock:
+            return {
+                'kind': 'bloom',
+                'bits': self.bits,
+                'current': base64.b64encode(bytes(self._current)).decode('ascii'),
+                'previous': base64.b64encode(bytes(self._previous)).decode('ascii'),
+                'counts': [self._current_count, self._previous_count],
+                'rotated_at': self._rotated_at,
+            }
+
+    def restore(self, data):
+        if data.get('bits') != self.bits:
+            return
+        with self._lock:
+            self._current = bytearray(base64.b64decode(data['current']))
+            self._previous = bytearray(base64.b64decode(data['previous']))
+            self._current_count, self._previous_count = data['counts']
+            self._rotated_at = data['rotated_at']
+
+
+def make_seen_store(kind=SEEN_STORE_KIND):
+    store = BloomSeenStore() if kind == 'bloom' else SeenStore()
+    # С SQLite увиденное и так хранится в базе, файл нужен только без неё
+    if SEEN_STORE_PATH and STATE_BACKEND == 'memory':
+        try:
+            with open(SEEN_STORE_PATH, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('kind') == store.stats()['kind']:
+                store.restore(data)
+                logger.info(f"💾 Загружено увиденных товаров: {len(store)}")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"❌ Не удалось загрузить {SEEN_STORE_PATH}: {e}")
+    return store
+
+
+def save_seen_store(store):
+    """Сохраняет увиденное на диск (атомарно, через временный файл)"""
+    if not SEEN_STORE_PATH or STATE_BACKEND != 'memory' or not store.dirty:
+        return
+    try:
+        tmp_path = f"{SEEN_STORE_PATH}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(store.dump(), f)
+        os.replace(tmp_path, SEEN_STORE_PATH)
+        store.dirty = False
+    except OSError as e:
+        logger.error(f"❌ Не удалось сохранить {SEEN_STORE_PATH}: {e}")
+
+
+seen_items = make_seen_store()
+startup_phase('seen_store')
+
+
+# ==================== СОСТОЯНИЕ ====================
+
+# Аренда мониторинга: только один воркер/процесс опрашивает FunPay
+MONITOR_LEASE_TTL = 90
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class MemoryStateBackend:
+    """Состояние в памяти процесса: для запуска без диска и одного воркера.
+
+    Дедупликацию делает seen_items (и его файл SEEN_STORE_PATH), поэтому
+    mark_seen_many считает новыми все переданные ключи.
+    """
+
+    kind = 'memory'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._status = {}
+        self._leases = {}
+        self._prices = deque(maxlen=100000)
+        self._rules = {}
+        self._rule_ids = itertools.count(1)
+        self._subscriptions = {}
+        self._dropped = OrderedDict()
+        self._jobs = OrderedDict()
+        self._events = deque()
+        self._event_ids = itertools.count(1)
+
+    def mark_seen_many(self, keys, now=None):
+        return set(keys)
+
+    def mark_dropped(self, scores, now=None):
+        now = now or time.time()
+        with self._lock:
+            for key, score in scores.items():
+                self._dropped[key] = (score, now)
+                self._dropped.move_to_end(key)
+            while len(self._dropped) > SEEN_MAX_ITEMS:
+                self._dropped.popitem(last=False)
+
+    def take_dropped(self, keys):
+        with self._lock:
+            return {key: self._dropped.pop(key)[0] for key in keys if key in self._dropped}
+
+    def seen_count(self):
+        return len(seen_items)
+
+    def record_prices(self, rows):
+        self._prices.extend(rows)
+
+    def recent_prices(self, since):
+        return [row for row in self._prices if row[5] >= since]
+
+    def get_status(self, name, default=None):
+        return self._status.get(name, default)
+
+    def set_status(self, name, value):
+        self._status[name] = value
+
+    def _bump(self, name):
+        self._status[f'{name}_version'] = self._status.get(f'{name}_version', 0) + 1
+
+    def load_rules(self):
+        with self._lock:
+            return [dict(rule) for rule in self._rules.values()]
+
+    def seed_rules(self, rules):
+        with self._lock:
+            if 'rules_version' in self._status:
+                return
+            for rule in rules:
+                self._rules[rule['id']] = dict(rule)
+            self._rule_ids = itertools.count(max(self._rules, default=0) + 1)
+            self._bump('rules')
+
+    def insert_rule(self, rule, limit=None):
+        with self._lock:
+            if limit is not None and sum(r['chat_id'] == rule['chat_id'] for r in self._rules.values()) >= limit:
+                return None
+            rule_id = next(self._rule_ids)
+            self._rules[rule_id] = dict(rule, id=rule_id)
+            self._bump('rules')
+            return rule_id
+
+    def delete_rule(self, rule_id, owners=None):
+        with self._lock:
+            rule = self._rules.get(rule_id)
+            if rule is None or (owners is not None and rule['chat_id'] not in owners):
+                return False
+            del self._rules[rule_id]
+            self._bump('rules')
+            return True
+
+    def load_subscriptions(self):
+        with self._lock:
+            return {chat_id: dict(sub) for chat_id, sub in self._subscriptions.items()}
+
+    def seed_subscriptions(self):
+        with self._lock:
+            if 'subscriptions_version' not in self._status:
+                self._bump('subscriptions')
+
+    def save_subscription(self, chat_id, active, categories=None, limit=None):
+        with self._lock:
+            current = self._subscriptions.get(chat_id)
+            if current is None and limit is not None and len(self._subscriptions) >= limit:
+                return None
+            if categories is None:
+                categories = current['categories'] if current else []
+            self._subscriptions[chat_id] = {'active': bool(active), 'categories': list(categories)}
+            self._bump('subscriptions')
+            return dict(self._subscriptions[chat_id])
+
+    def acquire_lease(self, name, owner, ttl, now=None):
+        now = now or time.time()
+        with self._lock:
+            holder = self._leases.get(name)
+            if holder and holder[0] != owner and holder[1] > now:
+                return False
+            self._leases[name] = (owner, now + ttl)
+            return True
+
+    def release_lease(self, name, owner):
+        with self._lock:
+            if self._leases.get(name, (None,))[0] == owner:
+                del self._leases[name]
+
+    def claim_job(self, job, active_since, history):
+        with self._lock:
+            for other in reversed(self._jobs.values()):
+                if (other['name'] == job['name'] and other['status'] in ('queued', 'running')
+                        and other['created_at'] >= active_since):
+                    return dict(other)
+            self._jobs[job['id']] = dict(job)
+            while len(self._jobs) > history:
+                self._jobs.popitem(last=False)
+            return None
+
+    def save_job(self, job):
+        with self._lock:
+            if job['id'] in self._jobs:
+                self._jobs[job['id']] = dict(job)
+
+    def get_job(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def recent_jobs(self, limit):
+        with self._lock:
+            return [dict(job) for job in reversed(list(self._jobs.values())[-limit:])]
+
+    def append_event(self, kind, data, ts, keep):
+        with self._lock:
+            event_id = next(self._event_ids)
+            self._events.append((event_id, kind, data, ts))
+            while len(self._events) > keep:
+                self._events.popleft()
+            return event_id
+
+    def events_since(self, last_id, limit):
+        with self._lock:
+            return [event for event in self._events if event[0] > last_id][-limit:]
+
+    def compact(self, now=None):
+        pass
+
+
+class SqliteStateBackend:
+    """Состояние в SQLite (режим WAL): переживает перезапуск воркера и общее
+    для нескольких воркеров/процессов. Соединение - своё у каждого потока.
+    """
+
+    kind = 'sqlite'
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS seen (
+            key TEXT PRIMARY KEY,
+            first_seen REAL NOT NULL,
+            last_seen REAL NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS seen_last_seen ON seen (last_seen);
+        CREATE TABLE IF NOT EXISTS dropped_deals (
+            key TEXT PRIMARY KEY,
+            score REAL,
+            dropped_at REAL NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS price_history (
+            key TEXT NOT NULL,
+            category TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            unit_price REAL,
+            seller_online INTEGER NOT NULL,
+            ts REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS price_history_ts ON price_history (ts);
+        CREATE TABLE IF NOT EXISTS monitor (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS rules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS rules_chat_id ON rules (chat_id);
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            chat_id TEXT PRIMARY KEY,
+            active INTEGER NOT NULL,
+            categories TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            status TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            data TEXT NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS jobs_created_at ON jobs (created_at);
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            data TEXT NOT NULL,
+            ts REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path=STATE_DB_PATH, ttl=SEEN_TTL, price_retention=PRICE_HISTORY_DAYS * 86400):
+        self.path = path
+        self.ttl = ttl
+        self.price_retention = price_retention
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=10000')
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self):
+        """BEGIN IMMEDIATE: сразу берём блокировку записи, чтобы воркеры не гонялись"""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        return conn
+
+    def mark_seen_many(self, keys, now=None):
+        """Отмечает ключи увиденными. Возвращает те, что новы для всех воркеров"""
+        keys = list(keys)
+        if not keys:
+            return set()
+        now = now or time.time()
+        conn = self._transaction()
+        try:
+            new_keys = set()
+            for key in keys:
+                row = conn.execute('SELECT last_seen FROM seen WHERE key = ?', (key,)).fetchone()
+                if row is None or now - row[0] >= self.ttl:
+                    new_keys.add(key)
+                    conn.execute('INSERT OR REPLACE INTO seen (key, first_seen, last_seen) VALUES (?, ?, ?)',
+                                 (key, now, now))
+                else:
+                    conn.execute('UPDATE seen SET last_seen = ? WHERE key = ?', (now, key))
+            conn.execute('COMMIT')
+            return new_keys
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def mark_dropped(self, scores, now=None):
+        """Отмечает увиденные предложения, которые оценка сделки не пропустила"""
+        if not scores:
+            return
+        now = now or time.time()
+        self._conn().executemany('INSERT OR REPLACE INTO dropped_deals (key, score, dropped_at) VALUES (?, ?, ?)',
+                                 [(key, score, now) for key, score in scores.items()])
+
+    def take_dropped(self, keys):
+        """Снимает отметки с ключей и возвращает {ключ: оценка} для отмеченных"""
+        keys = list(keys)
+        if not keys:
+            return {}
+        conn = self._transaction()
+        try:
+            found = {}
+            for key in keys:
+                row = conn.execute('SELECT score FROM dropped_deals WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    found[key] = row[0]
+                    conn.execute('DELETE FROM dropped_deals WHERE key = ?', (key,))
+            conn.execute('COMMIT')
+            return found
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def seen_count(self):
+        return self._conn().execute('SELECT COUNT(*) FROM seen').fetchone()[0]
+
+    def record_prices(self, rows):
+        """rows: (key, category, price, unit_price, seller_online, ts)"""
+        if not rows:
+            return
+        conn = self._transaction()
+        try:
+            conn.executemany('INSERT INTO price_history (key, category, price, unit_price, seller_online, ts) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', rows)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def recent_prices(self, since):
+        """Цены не старше since, по времени: (key, category, price, unit_price, seller_online, ts)"""
+        return self._conn().execute(
+            'SELECT key, category, price, unit_price, seller_online, ts FROM price_history '
+            'WHERE ts >= ? ORDER BY ts', (since,)).fetchall()
+
+    def get_status(self, name, default=None):
+        row = self._conn().execute('SELECT value FROM monitor WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_status(self, name, value):
+        self._conn().execute('INSERT OR REPLACE INTO monitor (name, value, updated_at) VALUES (?, ?, ?)',
+                             (name, json.dumps(value, ensure_ascii=False), time.time()))
+
+    @staticmethod
+    def _bump(conn, name):
+        """Счётчик правок (get_status('<name>_version')): воркеры сверяют его, а не сами данные"""
+        conn.execute("INSERT INTO monitor (name, value, updated_at) VALUES (?, '1', ?) "
+                     "ON CONFLICT (name) DO UPDATE SET value = CAST(value AS INTEGER) + 1, "
+                     "updated_at = excluded.updated_at", (f'{name}_version', time.time()))
+
+    @staticmethod
+    def _rule_row(rule):
+        data = {key: value for key, value in rule.items() if key != 'id'}
+        return rule['chat_id'], json.dumps(data, ensure_ascii=False)
+
+    def load_rules(self):
+        rows = self._conn().execute('SELECT id, data FROM rules ORDER BY id').fetchall()
+        return [dict(json.loads(data), id=rule_id) for rule_id, data in rows]
+
+    def seed_rules(self, rules):
+        """Первое заполнение таблицы правил; если её уже заполнил другой воркер - ничего"""
+        conn = self._transaction()
+        try:
+            if conn.execute("SELECT 1 FROM monitor WHERE name = 'rules_version'").fetchone() is None:
+                conn.executemany('INSERT OR REPLACE INTO rules (id, chat_id, data) VALUES (?, ?, ?)',
+                                 [(rule['id'],) + self._rule_row(rule) for rule in rules])
+                self._bump(conn, 'rules')
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def insert_rule(self, rule, limit=None):
+        """Добавляет правило, id выдаёт база. None - у чата уже limit правил"""
+        conn = self._transaction()
+        try:
+            if limit is not None:
+                count = conn.execute('SELECT COUNT(*) FROM rules WHERE chat_id = ?', (rule['chat_id'],)).fetchone()[0]
+                if count >= limit:
+                    conn.execute('ROLLBACK')
+                    return None
+            rule_id = conn.execute('INSERT INTO rules (chat_id, data) VALUES (?, ?)', self._rule_row(rule)).lastrowid
+            self._bump(conn, 'rules')
+            conn.execute('COMMIT')
+            return rule_id
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def delete_rule(self, rule_id, owners=None):
+        """Удаляет правило; с owners - только если его chat_id среди них (None - правило администратора)"""
+        sql, params = 'DELETE FROM rules WHERE id = ?', [rule_id]
+        if owners is not None:
+            chats = [owner for owner in owners if owner is not None]
+            condition = f"chat_id IN ({', '.join('?' * len(chats))})" if chats else '0'
+            if None in owners:
+                condition += ' OR chat_id IS NULL'
+            sql += f' AND ({condition})'
+            params.extend(chats)
+        conn = self._transaction()
+        try:
+            deleted = conn.execute(sql, params).rowcount
+            if deleted:
+                self._bump(conn, 'rules')
+            conn.execute('COMMIT')
+            return bool(deleted)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def load_subscriptions(self):
+        rows = self._conn().execute('SELECT chat_id, active, categories FROM subscriptions').fetchall()
+        return {chat_id: {'active': bool(active), 'categories': json.loads(categories)}
+                for chat_id, active, categories in rows}
+
+    def seed_subscriptions(self):
+        """Заводит счётчик правок подписок на новой базе"""
+        conn = self._transaction()
+        try:
+            if conn.execute("SELECT 1 FROM monitor WHERE name = 'subscriptions_version'").fetchone() is None:
+                self._bump(conn, 'subscriptions')
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def save_subscription(self, chat_id, active, categories=None, limit=None):
+        """Создаёт или меняет подписку; categories=None - прежние. None - новой подписке нет места"""
+        conn = self._transaction()
+        try:
+            row = conn.execute('SELECT categories FROM subscriptions WHERE chat_id = ?', (chat_id,)).fetchone()
+            if row is None and limit is not None:
+                if conn.execute('SELECT COUNT(*) FROM subscriptions').fetchone()[0] >= limit:
+                    conn.execute('ROLLBACK')
+                    return None
+            if categories is None:
+                categories = json.loads(row[0]) if row else []
+            conn.execute('INSERT OR REPLACE INTO subscriptions (chat_id, active, categories, updated_at) '
+                         'VALUES (?, ?, ?, ?)',
+                         (chat_id, int(bool(active)), json.dumps(list(categories), ensure_ascii=False), time.time()))
+            self._bump(conn, 'subscriptions')
+            conn.execute('COMMIT')
+            return {'active': bool(active), 'categories': list(categories)}
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def acquire_lease(self, name, owner, ttl, now=None):
+        """Берёт или продлевает аренду. False - она у другого живого владельца"""
+        now = now or time.time()
+        conn = self._transaction()
+        try:
+            row = conn.execute('SELECT owner, expires_at FROM leases WHERE name = ?', (name,)).fetchone()
+            if row and row[0] != owner and row[1] > now:
+                conn.execute('ROLLBACK')
+                return False
+            conn.execute('INSERT OR REPLACE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)',
+                         (name, owner, now + ttl))
+            conn.execute('COMMIT')
+            return True
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def release_lease(self, name, owner):
+        self._conn().execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, owner))
+
+    def claim_job(self, job, active_since, history):
+        """Записывает новую задачу. Если задача с тем же именем уже идёт
+        (создана не раньше active_since) - не записывает и возвращает её"""
+        conn = self._transaction()
+        try:
+            row = conn.execute("SELECT data FROM jobs WHERE name = ? AND status IN ('queued', 'running') "
+                               "AND created_at >= ? ORDER BY created_at DESC LIMIT 1",
+                               (job['name'], active_since)).fetchone()
+            if row is None:
+                conn.execute('INSERT INTO jobs (id, name, status, created_at, data) VALUES (?, ?, ?, ?, ?)',
+                             (job['id'], job['name'], job['status'], job['created_at'],
+                              json.dumps(job, ensure_ascii=False)))
+                conn.execute('DELETE FROM jobs WHERE id NOT IN '
+                             '(SELECT id FROM jobs ORDER BY created_at DESC LIMIT ?)', (history,))
+            conn.execute('COMMIT')
+            return json.loads(row[0]) if row else None
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def save_job(self, job):
+        self._conn().execute('UPDATE jobs SET status = ?, data = ? WHERE id = ?',
+                             (job['status'], json.dumps(job, ensure_ascii=False), job['id']))
+
+    def get_job(self, job_id):
+        row = self._conn().execute('SELECT data FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def recent_jobs(self, limit):
+        rows = self._conn().execute('SELECT data FROM jobs ORDER BY created_at DESC LIMIT ?', (limit,)).fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def append_event(self, kind, data, ts, keep):
+        """Событие живой ленты для всех воркеров; id общий и растёт. Хранятся последние keep"""
+        conn = self._transaction()
+        try:
+            event_id = conn.execute('INSERT INTO events (kind, data, ts) VALUES (?, ?, ?)',
+                                    (kind, json.dumps(data, ensure_ascii=False), ts)).lastrowid
+            conn.execute('DELETE FROM events WHERE id <= ?', (event_id - keep,))
+            conn.execute('COMMIT')
+            return event_id
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def events_since(self, last_id, limit):
+        """Последние limit событий новее last_id: (id, kind, data, ts) по возрастанию id"""
+        rows = self._conn().execute('SELECT id, kind, data, ts FROM events WHERE id > ? ORDER BY id DESC LIMIT ?',
+                                    (last_id, limit)).fetchall()
+        return [(event_id, kind, json.loads(data), ts) for event_id, kind, data, ts in reversed(rows)]
+
+    def compact(self, now=None):
+        """Удаляет устаревшие записи и сбрасывает WAL в основной файл"""
+        now = now or time.time()
+        conn = self._conn()
+        seen = conn.execute('DELETE FROM seen WHERE last_seen < ?', (now - self.ttl,)).rowcount
+        conn.execute('DELETE FROM dropped_deals WHERE dropped_at < ?', (now - self.ttl,))
+        prices = conn.execute('DELETE FROM price_history WHERE ts < ?', (now - self.price_retention,)).rowcount
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        if seen or prices:
+            logger.info(f"🧹 Очистка состояния: {seen} увиденных, {prices} цен")
+
+
+def make_state_backend(kind=STATE_BACKEND):
+    if kind == 'sqlite':
+        try:
+            return SqliteStateBackend()
+        except sqlite3.Error as e:
+            logger.error(f"❌ SQLite недоступен ({e}), состояние только в памяти")
+    return MemoryStateBackend()
+
+
+state = make_state_backend()
+startup_phase('state')
+
+# Как часто чистить хранилище состояния (секунды)
+STATE_COMPACT_INTERVAL = 3600
+_compacted_at = time.time()
+
+
+# ==================== ИСТОРИЯ ЦЕН ====================
+
+# Сколько наблюдений держим в памяти (кольцевой буфер, ~33 байта на наблюдение)
+PRICE_HISTORY_CAPACITY = int(os.environ.get('PRICE_HISTORY_CAPACITY', 200000))
+# Окно скользящей статистики категории: по времени и по числу наблюдений
+PRICE_WINDOW_SECONDS = float(os.environ.get('PRICE_WINDOW_HOURS', 24)) * 3600
+PRICE_WINDOW_SAMPLES = int(os.environ.get('PRICE_WINDOW_SAMPLES', 2000))
+PRICE_PERCENTILES = (10, 25, 50, 75, 90)
+
+
+class RollingStats:
+    """Скользящее окно значений с отсортированной копией.
+
+    Добавление и вытеснение - O(log n) поиск + сдвиг памяти, а минимум,
+    медиана и перцентили берутся индексом за O(1).
+    """
+
+    def __init__(self, max_age=PRICE_WINDOW_SECONDS, max_samples=PRICE_WINDOW_SAMPLES):
+        self.max_age = max_age
+        self.max_samples = max_samples
+        self._window = deque()
+        self._sorted = []
+
+    def __len__(self):
+        return len(self._sorted)
+
+    def add(self, value, ts):
+        self._window.append((ts, value))
+        bisect.insort(self._sorted, value)
+        self._expire(ts)
+
+    def _expire(self, now):
+        window = self._window
+        while window and (len(window) > self.max_samples or now - window[0][0] > self.max_age):
+            _, value = window.popleft()
+            del self._sorted[bisect.bisect_left(self._sorted, value)]
+
+    def percentile(self, p):
+        values = self._sorted
+        if not values:
+            return None
+        return values[min(int(p / 100 * len(values)), len(values) - 1)]
+
+    def summary(self):
+        if not self._sorted:
+            return {'count': 0}
+        result = {'count': len(self._sorted), 'min': self._sorted[0], 'max': self._sorted[-1]}
+        for p in PRICE_PERCENTILES:
+            result[f'p{p}'] = self.percentile(p)
+        result['median'] = result['p50']
+        return result
+
+
+class PriceHistory:
+    """История цен в колонках array (кольцевой буфер) + скользящая статистика.
+
+    Хранится каждое наблюдение (предложение, цена, цена за кк, онлайн, время).
+    Предложение считается один раз за окно статистики: повторный разбор тех
+    же карточек (сброс снимков, перезапуск) не удваивает выборку.
+    Статистика по категориям обновляется при записи, так что запросы не
+    перебирают историю. Предложение в колонке - crc32 ключа, без словаря ключей.
+    """
+
+    def __init__(self, capacity=PRICE_HISTORY_CAPACITY):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self.ts = array('d')
+        self.price = array('d')
+        self.unit_price = array('d')
+        self.online = array('b')
+        self.offer = array('I')
+        self.category = array('i')
+        self._head = 0
+        self.total = 0
+        # Ключ предложения -> время его наблюдения в окне (не больше capacity)
+        self._observed = OrderedDict()
+        self.duplicates = 0
+        self._category_ids = {}
+        self._category_names = []
+        self._stats = {}
+        # Последняя цена лота (категория, продавец, название) - для событий об изменении цены
+        self._listing_prices = OrderedDict()
+
+    def __len__(self):
+        return len(self.ts)
+
+    def _intern(self, ids, names, value):
+        index = ids.get(value)
+        if index is None:
+            index = ids[value] = len(names)
+            names.append(value)
+        return index
+
+    def add_items(self, items, ts):
+        """Записывает товары цикла. Возвращает [(товар, прежняя цена)] для лотов с новой ценой"""
+        changes = []
+        with self._lock:
+            for item in items:
+                listing = (item['category'], item.get('seller'), item['title'])
+                previous = self._listing_prices.pop(listing, None)
+                if previous is not None and previous != item['price']:
+                    changes.append((item, previous))
+                self._listing_prices[listing] = item['price']
+                if len(self._listing_prices) > self.capacity:
+                    self._listing_prices.popitem(last=False)
+                self._observe(item['id'], item['category'], item['price'], item.get('unit_price'),
+                              item.get('seller_online'), ts)
+        return changes
+
+    def _observe(self, key, category, price, unit, online, ts):
+        """Записывает наблюдение, если предложение ещё не учтено в текущем окне"""
+        observed = self._observed.get(key)
+        if observed is not None and ts - observed < PRICE_WINDOW_SECONDS:
+            self.duplicates += 1
+            return
+        self._observed[key] = ts
+        self._observed.move_to_end(key)
+        if len(self._observed) > self.capacity:
+            self._observed.popitem(last=False)
+        self._add(key, category, price, unit, online, ts)
+
+    def _add(self, key, category, price, unit, online, ts):
+        row = (ts, float(price), math.nan if unit is None else float(unit), 1 if online else 0,
+               zlib.crc32(key.encode('utf-8')),
+               self._intern(self._category_ids, self._category_names, category))
+        columns = (self.ts, self.price, self.unit_price, self.online, self.offer, self.category)
+        if len(self.ts) < self.capacity:
+            for column, value in zip(columns, row):
+                column.append(value)
+        else:
+            for column, value in zip(columns, row):
+                column[self._head] = value
+            self._head = (self._head + 1) % self.capacity
+        self.total += 1
+
+        stats = self._stats.get(category)
+        if stats is None:
+            stats = self._stats[category] = {'price': RollingStats(), 'unit_price': RollingStats()}
+        stats['price'].add(float(price), ts)
+        if unit is not None:
+            stats['unit_price'].add(float(unit), ts)
+
+    def stats(self, category, metric='unit_price'):
+        """Скользящая статистика категории: min, max, медиана, перцентили"""
+        with self._lock:
+            stats = self._stats.get(category)
+            return stats[metric].summary() if stats else {'count': 0}
+
+    def medians(self, category, min_samples=1):
+        """Медианы цены и цены за кк категории (None, если наблюдений мало)"""
+        with self._lock:
+            stats = self._stats.get(category, {})
+            return {
+                metric: rolling.percentile(50) if len(rolling) >= min_samples else None
+                for metric, rolling in stats.items()
+            }
+
+    def all_stats(self):
+        with self._lock:
+            return {
+                category: {metric: rolling.summary() for metric, rolling in stats.items()}
+                for category, stats in self._stats.items()
+            }
+
+    def memory_bytes(self):
+        return sum(column.itemsize * len(column)
+                   for column in (self.ts, self.price, self.unit_price, self.online, self.offer, self.category))
+
+    def load(self, rows):
+        """Прогрев из сохранённой истории: rows - (key, category, price, unit_price, seller_online, ts)"""
+        with self._lock:
+            for key, category, price, unit, online, ts in rows:
+                self._observe(key, category, price, unit, online, ts)
+
+
+    def summary(self):
+        return {
+            'samples': len(self.ts),
+            'total': self.total,
+            'offers': len(self._observed),
+            'duplicates': self.duplicates,
+            'categories': len(self._category_names),
+            'memory_bytes': self.memory_bytes(),
+        }
+
+
+def make_price_history():
+    """История цен, прогретая записями из хранилища состояния за окно статистики"""
+    history = PriceHistory()
+    try:
+        history.load(state.recent_prices(time.time() - PRICE_WINDOW_SECONDS))
+        if len(history):
+            logger.info(f"📈 Загружено цен из истории: {len(history)}")
+    except sqlite3.Error as e:
+        logger.error(f"❌ Не удалось загрузить историю цен: {e}")
+    return history
+
+
+price_history = make_price_history()
+startup_phase('price_history')
+
+
+# ==================== ЖИВАЯ ЛЕНТА ====================
+
+# Сколько последних событий держим для догоняющих клиентов (Last-Event-ID, long-poll)
+EVENTS_HISTORY = 500
+# Буфер одного клиента: медленный читатель теряет старые события, а не копит память
+EVENTS_CLIENT_BUFFER = int(os.environ.get('EVENTS_CLIENT_BUFFER', 100))
+# Каждый клиент ленты, который держит соединение (SSE или ждущий long-poll),
+# занимает поток gthread-воркера. Сколько потоков всегда остаётся остальным
+# маршрутам (/health, webhook, /status)
+EVENTS_RESERVED_THREADS = 4
+EVENTS_MAX_CLIENTS = min(
+    int(os.environ.get('EVENTS_MAX_CLIENTS', 100)),
+    max(int(os.environ.get('GUNICORN_THREADS', 16)) - EVENTS_RESERVED_THREADS, 1),
+)
+# Зрители сверх EVENTS_MAX_CLIENTS не отклоняются, а получают пропущенное и
+# переподключаются через столько секунд: их число потоками не ограничено
+EVENTS_BUSY_RETRY = 5
+EVENTS_KEEPALIVE = 15
+EVENTS_POLL_TIMEOUT = 25
+# Как часто воркер забирает новые события из общего состояния (секунды)
+EVENTS_RELAY_INTERVAL = 1.0
+# Поля товара, которые уходят в ленту
+EVENT_ITEM_FIELDS = ('id', 'title', 'price', 'unit_price', 'link', 'category', 'seller', 'seller_online',
+                     'seller_rating', 'deal_score', 'market_median')
+
+EVENTS_PUBLISHED = Counter('events_published_total', 'Событий живой ленты', ['kind'])
+EVENTS_DROPPED = Counter('events_dropped_total', 'Событий, вытесненных из буфера медленного клиента')
+EVENTS_CLIENTS = Gauge('events_clients', 'Подключённых клиентов живой ленты')
+
+# id выдаёт общее состояние: он растёт и одинаков во всех воркерах
+Event = namedtuple('Event', ['id', 'kind', 'data', 'ts'])
+
+
+class EventSubscriber:
+    """Кольцевой буфер событий одного клиента"""
+
+    def __init__(self, maxlen=EVENTS_CLIENT_BUFFER):
+        self.queue = deque(maxlen=maxlen)
+        self.dropped = 0
+
+
+class EventBroker:
+    """Рассылка событий монитора подключённым клиентам.
+
+    События публикует воркер с арендой мониторинга, и они пишутся в общее
+    состояние. Фоновый поток каждого воркера, к которому подключены
+    клиенты, забирает оттуда новые и раскладывает по буферам подписчиков:
+    лента одна и та же в любом воркере. Публикация не ждёт клиентов,
+    переполненный буфер вытесняет самое старое, опрос FunPay от числа
+    клиентов не зависит.
+    """
+
+    def __init__(self, history=EVENTS_HISTORY, relay_interval=EVENTS_RELAY_INTERVAL):
+        self._cond = threading.Condition()
+        self._history = deque(maxlen=history)
+        self._subscribers = set()
+        self._waiting = 0
+        self._last_id = 0
+        self._relay_interval = relay_interval
+        self._relay = None
+        self._relay_lock = threading.Lock()
+        self._pull_lock = threading.Lock()
+        self._wake = threading.Event()
+        self.relay_errors = 0
+
+    def publish(self, kind, data):
+        """Пишет событие в общее состояние. Возвращает его id (None - не удалось)"""
+        try:
+            event_id = state.append_event(kind, data, time.time(), self._history.maxlen)
+        except Exception as e:
+            # Лента - не повод ронять цикл мониторинга
+            logger.error(f"❌ Событие {kind} не записано: {e}")
+            return None
+        EVENTS_PUBLISHED.inc(kind=kind)
+        # Клиенты этого воркера получают событие сразу, не дожидаясь опроса
+        self._wake.set()
+        return event_id
+
+    def pull(self):
+        """Забирает новые события из общего состояния и раскладывает подписчикам"""
+        with self._pull_lock:
+            events = [Event(*row) for row in state.events_since(self._last_id, self._history.maxlen)]
+            if not events:
+                return 0
+            with self._cond:
+                for event in events:
+                    self._history.append(event)
+                    for subscriber in self._subscribers:
+                        if len(subscriber.queue) == subscriber.queue.maxlen:
+                            subscriber.dropped += 1
+                            EVENTS_DROPPED.inc()
+                        subscriber.queue.append(event)
+                self._last_id = events[-1].id
+                self._cond.notify_all()
+            return len(events)
+
+    def _ensure_relay(self):
+        """Поток пересылки запускается с первым клиентом воркера"""
+        if self._relay is not None and self._relay.is_alive():
+            return
+        with self._relay_lock:
+            if self._relay is None or not self._relay.is_alive():
+                # Догоняем историю до ответа первому клиенту (Last-Event-ID, long-poll)
+                self._pull_safely()
+                self._relay = threading.Thread(target=self._run_relay, name='events-relay', daemon=True)
+                self._relay.start()
+
+    def _run_relay(self):
+        while True:
+            self._wake.wait(self._relay_interval)
+            self._wake.clear()
+            self._pull_safely()
+
+    def _pull_safely(self):
+        try:
+            self.pull()
+        except Exception as e:
+            self.relay_errors += 1
+            logger.error(f"❌ Не удалось забрать события ленты: {e}")
+
+    def full(self):
+        """Все потоки под ленту заняты: новый клиент соединение не держит"""
+        with self._cond:
+            return len(self._subscribers) + self._waiting >= EVENTS_MAX_CLIENTS
+
+    def last_id(self):
+        self._ensure_relay()
+        with self._cond:
+            return self._last_id
+
+    def since(self, last_id):
+        self._ensure_relay()
+        with self._cond:
+            return [event for event in self._history if event.id > last_id]
+
+    def subscribe(self, last_id=None):
+        """Новый подписчик; с last_id буфер сразу заполняется пропущенным"""
+        self._ensure_relay()
+        subscriber = EventSubscriber()
+        with self._cond:
+            if len(self._subscribers) + self._waiting >= EVENTS_MAX_CLIENTS:
+                return None
+            if last_id is not None:
+                subscriber.queue.extend(event for event in self._history if event.id > last_id)
+            self._subscribers.add(subscriber)
+            EVENTS_CLIENTS.set(len(self._subscribers))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._cond:
+            self._subscribers.discard(subscriber)
+            EVENTS_CLIENTS.set(len(self._subscribers))
+
+    def get(self, subscriber, timeout):
+        """События подписчика; пустой список, если за timeout ничего не пришло"""
+        with self._cond:
+            if not subscriber.queue:
+                self._cond.wait_for(lambda: subscriber.queue, timeout)
+            events = list(subscriber.queue)
+            subscriber.queue.clear()
+        return events
+
+    def wait_since(self, last_id, timeout):
+        """Long-poll: события новее last_id, ждём не дольше timeout.
+
+        Когда потоки под ленту заняты, отвечает сразу, не дожидаясь событий.
+        """
+        self._ensure_relay()
+        with self._cond:
+            if len(self._subscribers) + self._waiting >= EVENTS_MAX_CLIENTS:
+                timeout = 0
+            self._waiting += 1
+            try:
+                self._cond.wait_for(lambda: self._history and self._history[-1].id > last_id, timeout)
+            finally:
+                self._waiting -= 1
+            return [event for event in self._history if event.id > last_id]
+
+    def stats(self):
+        with self._cond:
+            return {
+                'clients': len(self._subscribers),
+                'waiting': self._waiting,
+                'max_clients': EVENTS_MAX_CLIENTS,
+                'last_id': self._last_id,
+                'relay': self._relay is not None and self._relay.is_alive(),
+                'relay_errors': self.relay_errors,
+            }
+
+
+event_broker = EventBroker()
+
+
+def event_item(item):
+    return {field: item.get(field) for field in EVENT_ITEM_FIELDS}
+
+
+def format_sse(event):
+    data = json.dumps(event.data, ensure_ascii=False)
+    return f"id: {event.id}\nevent: {event.kind}\ndata: {data}\n\n"
+
+
+# ==================== ОЦЕНКА ПРЕДЛОЖЕНИЙ ====================
+
+# Сколько лучших предложений отправлять за цикл (0 - без ограничения).
+# По умолчанию отбора нет: предложения только ранжируются, лучшие - первыми в дайджесте
+DEAL_TOP_N = int(os.environ.get('DEAL_TOP_N', 0))
+# Минимальная оценка: доля, на которую цена ниже медианы категории (0 - не дороже медианы).
+# Пусто - порога нет
+DEAL_MIN_SCORE = float(os.environ['DEAL_MIN_SCORE']) if os.environ.get('DEAL_MIN_SCORE', '').strip() else None
+# Пока наблюдений меньше, сравнивать не с чем - предложение не оценивается и не отсеивается
+DEAL_MIN_SAMPLES = int(os.environ.get('DEAL_MIN_SAMPLES', 20))
+
+
+def score_deals(items, category):
+    """Оценивает пачку предложений одной категории разом.
+
+    Медианы берутся из истории один раз на пачку, дальше - одно деление на
+    карточку. Оценка = 1 - цена / медиана: 0.3 - на 30% дешевле рынка.
+    Сравнивается цена за 1 кк, а без объёма в названии - просто цена.
+    """
+    medians = price_history.medians(category, DEAL_MIN_SAMPLES)
+    unit_median = medians.get('unit_price')
+    price_median = medians.get('price')
+    for item in items:
+        if item.get('unit_price') is not None and unit_median:
+            metric, value, median = 'unit_price', item['unit_price'], unit_median
+        elif price_median:
+            metric, value, median = 'price', item['price'], price_median
+        else:
+            metric, value, median = None, None, None
+        item['deal_metric'] = metric
+        item['market_median'] = median
+        item['deal_score'] = round(1 - value / median, 4) if median else None
+    return items
+
+
+def select_deals(items, top_n=None, min_score=None):
+    """Лучшие предложения цикла: оценка не ниже порога (если он задан), не больше top_n.
+
+    Неоценённые (мало истории) проходят порог и идут после оценённых.
+    """
+    top_n = DEAL_TOP_N if top_n is None else top_n
+    min_score = DEAL_MIN_SCORE if min_score is None else min_score
+    if min_score is None:
+        passed = list(items)
+    else:
+        passed = [item for item in items if item['deal_score'] is None or item['deal_score'] >= min_score]
+
+    def sort_key(item):
+        return -math.inf if item['deal_score'] is None else item['deal_score']
+
+    if top_n and len(passed) > top_n:
+        return heapq.nlargest(top_n, passed, key=sort_key)
+    return sorted(passed, key=sort_key, reverse=True)
+
+
+def format_seller(item):
+    """Строка сообщения о продавце (если предложение обогащено)"""
+    if item.get('seller_rating') is None and item.get('seller_reviews') is None:
+        return ''
+    parts = []
+    if item.get('seller_rating') is not None:
+        parts.append(f"{item['seller_rating']:g}")
+    if item.get('seller_reviews') is not None:
+        parts.append(f"{item['seller_reviews']} отзывов")
+    stock = f", в наличии {item['stock']:,}".replace(',', ' ').replace(' ', ',', 1) if item.get('stock') else ''
+    return f"⭐ <b>Продавец:</b> {escape(item.get('seller') or '')} {' / '.join(parts)}{stock}\n"
+
+
+def format_deal(item):
+    """Строка сообщения о выгоде предложения (пустая, если не оценено)"""
+    if item.get('deal_score') is None:
+        return ''
+    unit = 'руб./кк' if item['deal_metric'] == 'unit_price' else 'руб.'
+    direction = 'ниже' if item['deal_score'] >= 0 else 'выше'
+    return (f"📉 <b>На {abs(item['deal_score']):.0%} {direction} медианы</b> "
+            f"({item['market_median']:.0f} {unit})\n")
+
+
+# ==================== ПРАВИЛА ОТБОРА ====================
+
+# Цена за единицу считается за 1 кк (миллион) виртов
+UNIT_SIZE = 1000000
+AMOUNT_RE = re.compile(r'(\d+(?:[.,]\d+)?)\s*(ккк|kkk|млрд|кк|kk|млн|к|k|тыс)(?![a-zа-яё])', re.IGNORECASE)
+AMOUNT_MULTIPLIERS = {
+    'ккк': 10 ** 9, 'kkk': 10 ** 9, 'млрд': 10 ** 9,
+    'кк': 10 ** 6, 'kk': 10 ** 6, 'млн': 10 ** 6,
+    'к': 10 ** 3, 'k': 10 ** 3, 'тыс': 10 ** 3,
+}
+RULES_RELOAD_INTERVAL = 10
+
+DEFAULT_RULES = [{
+    'id': 1,
+    'name': 'Black Russia',
+    'keywords': ['black russia', 'blackrussia', 'блек раша', 'блэк раша', 'br ', 'бр '],
+    'price_min': 10,
+    'price_max': 50000,
+}]
+
+RULE_DEFAULTS = {
+    'name': '',
+    'keywords': [],       # подстроки названия (без учёта регистра), хотя бы одна
+    'pattern': '',        # регулярное выражение по названию
+    'categories': [],     # названия категорий; пусто - все
+    'price_min': None,
+    'price_max': None,
+    'unit_price_max': None,
+    'require_online': False,
+    'min_rating': None,   # если рейтинг продавца неизвестен - правило не срабатывает
+    'enabled': True,
+    'chat_id': None,      # чат-подписчик; None - администратор (TELEGRAM_CHAT_ID)
+}
+
+
+def parse_amount(amount_text, title):
+    """Количество виртов: из колонки «Наличие» или из названия («40 кк», «500к»)"""
+    if amount_text:
+        digits = PRICE_DIGITS_RE.findall(amount_text.replace(' ', '').replace('\xa0', ''))
+        if digits:
+            return int(''.join(digits))
+    match = AMOUNT_RE.search(title)
+    if match:
+        return int(float(match.group(1).replace(',', '.')) * AMOUNT_MULTIPLIERS[match.group(2).lower()])
+    return None
+
+
+def unit_price(price, amount):
+    """Цена за UNIT_SIZE виртов или None, если количество неизвестно"""
+    if not amount or not price:
+        return None
+    return round(price * UNIT_SIZE / amount, 2)
+
+
+def normalize_rule(data):
+    """Проверяет и дополняет правило значениями по умолчанию. ValueError - если правило битое"""
+    if not isinstance(data, dict):
+        raise ValueError("правило должно быть объектом")
+    rule = dict(RULE_DEFAULTS)
+    rule.update({key: value for key, value in data.items() if key in RULE_DEFAULTS or key == 'id'})
+
+    if isinstance(rule['keywords'], str):
+        rule['keywords'] = [k.strip() for k in rule['keywords'].split(',')]
+    # Пробелы внутри списка не трогаем: 'br ' с пробелом - это часть слова
+    rule['keywords'] = [k.lower() for k in rule['keywords'] if k and k.strip()]
+    if isinstance(rule['categories'], str):
+        rule['categories'] = [c.strip() for c in rule['categories'].split(',') if c.strip()]
+    for key in ('price_min', 'price_max', 'unit_price_max', 'min_rating'):
+        if rule[key] in ('', None):
+            rule[key] = None
+        else:
+            rule[key] = float(rule[key])
+    rule['require_online'] = bool(rule['require_online'])
+    rule['enabled'] = bool(rule['enabled'])
+    rule['chat_id'] = str(rule['chat_id']) if rule['chat_id'] not in (None, '') else None
+    if rule['pattern']:
+        try:
+            re.compile(rule['pattern'])
+        except re.error as e:
+            raise ValueError(f"неверное выражение: {e}")
+    if not rule['keywords'] and not rule['pattern'] and rule['price_max'] is None and rule['unit_price_max'] is None:
+        raise ValueError("нужны ключевые слова, выражение или ограничение цены")
+    rule['name'] = rule['name'] or ', '.join(rule['keywords'])[:40] or rule['pattern'][:40]
+    return rule
+
+
+def _keyword_trie(words):
+    """Дерево префиксов: буква -> поддерево, '' -> слово, которое здесь кончается"""
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = word
+    return trie
+
+
+def _contained_words(trie, text):
+    """Все слова дерева, встречающиеся в text как подстроки"""
+    found = set()
+    for start in range(len(text)):
+        node = trie
+        for char in text[start:]:
+            node = node.get(char)
+            if node is None:
+                break
+            if '' in node:
+                found.add(node[''])
+    return found
+
+
+def _trie_regex(trie):
+    """Одно выражение-дерево по всем словам: общие префиксы проверяются один раз"""
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        # Жадный необязательный хвост: при совпадении выбирается самое длинное слово
+        return f'(?:{body})?' if '' in node else body
+
+    return build(trie)
+
+
+class RuleEngine:
+    """Отбор товаров правилами, скомпилированными один раз.
+
+    Ключевые слова всех правил собраны в одно выражение-дерево; один проход
+    по названию находит все совпавшие слова, а через них - правила-кандидаты.
+    Дальше у кандидатов проверяются только числовые условия.
+    """
+
+    def __init__(self, rules):
+        self.all_rules = list(rules)
+        self.rules = [rule for rule in rules if rule['enabled']]
+        self._patterns = {rule['id']: re.compile(rule['pattern'], re.IGNORECASE)
+                          for rule in self.rules if rule['pattern']}
+
+        by_keyword = {}
+        unkeyed = []
+        for rule in self.rules:
+            if rule['keywords']:
+                for keyword in rule['keywords']:
+                    by_keyword.setdefault(keyword, []).append(rule)
+            else:
+                unkeyed.append(rule)
+
+        # В выражении побеждает самое длинное слово в позиции, поэтому слово
+        # заранее «включает» правила всех слов, которые в нём содержатся.
+        # Вложенные слова ищутся проходом по дереву, а не сравнением всех пар
+        trie = _keyword_trie(by_keyword)
+        self._keyword_rules = {
+            keyword: tuple({rule['id']: rule for other in _contained_words(trie, keyword)
+                            for rule in by_keyword[other]}.values())
+            for keyword in by_keyword
+        }
+        self._keyword_re = re.compile(f'(?=({_trie_regex(trie)}))') if by_keyword else None
+
+        # Правила без слов (только цена/выражение) разложены по категориям и
+        # отсортированы по потолку цены: товару достаются лишь те, чей потолок
+        # не ниже его цены
+        anywhere = [rule for rule in unkeyed if not rule['categories']]
+        by_category = {None: anywhere}
+        for rule in unkeyed:
+            for category in rule['categories']:
+                by_category.setdefault(category, list(anywhere)).append(rule)
+        self._unkeyed = {}
+        for category, rules in by_category.items():
+            rules.sort(key=self._price_ceiling)
+            self._unkeyed[category] = (tuple(map(self._price_ceiling, rules)), tuple(rules))
+
+    @staticmethod
+    def _price_ceiling(rule):
+        return math.inf if rule['price_max'] is None else rule['price_max']
+
+    def _check(self, rule, item, partial=False):
+        if rule['categories'] and item['category'] not in rule['categories']:
+            return False
+        price = item['price']
+        if rule['price_min'] is not None and price < rule['price_min']:
+            return False
+        if rule['price_max'] is not None and price > rule['price_max']:
+            return False
+        if rule['unit_price_max'] is not None:
+            if item.get('unit_price') is None or item['unit_price'] > rule['unit_price_max']:
+                return False
+        if rule['require_online'] and not item.get('seller_online'):
+            return False
+        if rule['min_rating'] is not None:
+            if item.get('seller_rating') is None:
+                if not partial:
+                    return False
+            elif item['seller_rating'] < rule['min_rating']:
+                return False
+        pattern = self._patterns.get(rule['id'])
+        if pattern and not pattern.search(item['title']):
+            return False
+        return True
+
+    def match(self, item, title_lower=None, partial=False):
+        """id правил, под которые подходит товар.
+
+        partial=True - неизвестный пока рейтинг продавца правило не отсекает
+        """
+        candidates = {}
+        if self._keyword_re:
+            if title_lower is None:
+                title_lower = item['title'].lower()
+            for match in self._keyword_re.finditer(title_lower):
+                for rule in self._keyword_rules[match.group(1)]:
+                    candidates[rule['id']] = rule
+        ceilings, rules = self._unkeyed.get(item['category']) or self._unkeyed[None]
+        for rule in itertools.islice(rules, bisect.bisect_left(ceilings, item['price']), None):
+            candidates[rule['id']] = rule
+        return sorted(rule_id for rule_id, rule in candidates.items() if self._check(rule, item, partial))
+
+
+_rule_engine = None
+# Растут при смене правил (общий - для правил без категорий): parse_page по ним
+# узнаёт, что страницу разобрали старыми правилами
+_rules_generation = 0
+_category_generations = {}
+_rules_raw = None
+_rules_version = None
+_rules_checked_at = 0.0
+_rules_lock = threading.Lock()
+
+
+def _normalized(rules):
+    normalized = []
+    for data in rules:
+        try:
+            normalized.append(normalize_rule(data))
+        except ValueError as e:
+            logger.error(f"❌ Пропускаем правило {data!r}: {e}")
+    return normalized
+
+
+def _seed_rules():
+    if state.get_status('rules_version') is None:
+        # Первый запуск на этой базе: правила по умолчанию
+        state.seed_rules(_normalized(DEFAULT_RULES))
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+def load_rules():
+    """Правила из общего состояния (правки видны всем воркерам)"""
+    _seed_rules()
+    return _normalized(state.load_rules())
 
-# Конфигурация из переменных окружения
-TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '').strip()
-TELEGRAM_CHAT_ID = os.environ.get('TELEGRAM_CHAT_ID', '').strip()
 
-# Глобальные переменные
-found_items = {}
-monitoring_active = False
-monitoring_thread = None
+def changed_categories(old_rules, new_rules):
+    """Категории, которых касаются различия двух наборов правил; None - все"""
+    old_rules = {rule['id']: rule for rule in old_rules}
+    new_rules = {rule['id']: rule for rule in new_rules}
+    names = set()
+    for rule_id in old_rules.keys() | new_rules.keys():
+        before, after = old_rules.get(rule_id), new_rules.get(rule_id)
+        if before == after:
+            continue
+        for rule in (before, after):
+            if rule is None:
+                continue
+            if not rule['categories']:
+                return None
+            names.update(rule['categories'])
+    return names
+
 
-def send_telegram_message(message, parse_mode='HTML'):
-    """Отправка сообщения в Telegram"""
-    if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
-        logger.warning("⚠️ Telegram не настроен, пропускаем отправку")
-        return False
+def rules_generation(category):
+    return _rules_generation, _category_generations.get(category, 0)
+
+
+def get_rule_engine():
+    """Текущий движок правил; раз в RULES_RELOAD_INTERVAL сверяет счётчик правок в состоянии"""
+    global _rule_engine, _rules_generation, _rules_raw, _rules_version, _rules_checked_at
     
-    try:
-        bot = Bot(token=TELEGRAM_BOT_TOKEN)
-        bot.send_message(chat_id=TELEGRAM_CHAT_ID, text=message, parse_mode=parse_mode)
-        logger.info(f"📨 Отправлено в Telegram: {message[:50]}...")
-        return True
-    except TelegramError as e:
-        logger.error(f"❌ Ошибка Telegram: {e}")
+    if _rule_engine is not None and time.time() - _rules_checked_at < RULES_RELOAD_INTERVAL:
+        return _rule_engine
+    with _rules_lock:
+        _seed_rules()
+        version = state.get_status('rules_version')
+        if _rule_engine is None or version != _rules_version:
+            rules = load_rules()
+            raw = json.dumps(rules, sort_keys=True, ensure_ascii=False)
+            if raw != _rules_raw:
+                if _rule_engine is not None:
+                    # Снимки разобраны старыми правилами - заново разбираем только затронутые категории
+                    names = changed_categories(_rule_engine.all_rules, rules)
+                    if names is None:
+                        _rules_generation += 1
+                    for name in names or ():
+                        _category_generations[name] = _category_generations.get(name, 0) + 1
+                    for category in CATEGORIES:
+                        if names is None or category.name in names:
+                            forget_page(category.url)
+                    logger.info(f"📋 Правила обновлены: {len(rules)}, "
+                                f"категории: {'все' if names is None else ', '.join(sorted(names)) or 'нет'}")
+                _rule_engine = RuleEngine(rules)
+                _rules_raw = raw
+            _rules_version = version
+        _rules_checked_at = time.time()
+    return _rule_engine
+
+
+def add_rule(data, chat_id=None, token=None):
+    """Добавляет правило и возвращает его. ValueError - если правило битое.
+
+    С chat_id правило принадлежит этому чату (не больше SUBSCRIBER_MAX_RULES),
+    без него (веб-интерфейс) - администратору; чат из data не берётся.
+    Регулярные выражения - только у администратора (чат TELEGRAM_CHAT_ID
+    или token, равный ADMIN_TOKEN): чужой re= может подвесить цикл
+    мониторинга катастрофическим откатом
+    """
+    global _rules_checked_at
+    rule = normalize_rule(data)
+    rule.pop('id', None)
+    admin = is_admin_token(token) if chat_id is None else is_admin_chat(chat_id)
+    if rule['pattern'] and not admin:
+        raise ValueError("выражения re= доступны только администратору")
+    rule['chat_id'] = None if chat_id is None or is_admin_chat(chat_id) else str(chat_id)
+    limit = None if rule['chat_id'] is None else SUBSCRIBER_MAX_RULES
+    _seed_rules()
+    rule_id = state.insert_rule(rule, limit)
+    if rule_id is None:
+        raise ValueError(f"не больше {SUBSCRIBER_MAX_RULES} правил на чат")
+    rule['id'] = rule_id
+    _rules_checked_at = 0.0
+    return rule
+
+
+def delete_rule(rule_id, chat_id=None):
+    """Удаляет правило; с chat_id - только если оно принадлежит этому чату"""
+    global _rules_checked_at
+    owners = None
+    if chat_id is not None:
+        # Правила без чата принадлежат администратору (см. rule_owner)
+        owners = [str(chat_id), None] if is_admin_chat(chat_id) else [str(chat_id)]
+    _seed_rules()
+    if not state.delete_rule(rule_id, owners):
         return False
+    _rules_checked_at = 0.0
+    return True
 
-def fast_parse_black_russia(url, category):
-    """БЫСТРЫЙ парсинг для Render (таймаут 10 секунд)"""
-    try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+
+def parse_rule_text(text):
+    """Правило из строки Telegram-команды.
+
+    Формат: «слова, через, запятую | price=100-3000 | unit=150 | online | rating=4.5 | re=выражение»
+    """
+    parts = [part.strip() for part in text.split('|')]
+    data = {'keywords': parts[0]}
+    for part in parts[1:]:
+        key, _, value = part.partition('=')
+        key = key.strip().lower()
+        value = value.strip()
+        if key in ('online', 'онлайн'):
+            data['require_online'] = True
+        elif key in ('price', 'цена'):
+            low, _, high = value.partition('-')
+            data['price_min'] = low or None
+            data['price_max'] = high or None
+        elif key in ('unit', 'кк'):
+            data['unit_price_max'] = value
+        elif key in ('rating', 'рейтинг'):
+            data['min_rating'] = value
+        elif key in ('re', 'pattern'):
+            data['pattern'] = value
+        elif key in ('cat', 'категория'):
+            data['categories'] = value
+        elif key in ('name', 'имя'):
+            data['name'] = value
+        else:
+            raise ValueError(f"непонятная часть «{part}»")
+    return normalize_rule(data)
+
+
+def describe_rule(rule):
+    """Краткое описание правила для Telegram и веб-страницы"""
+    parts = []
+    if rule['keywords']:
+        parts.append(', '.join(rule['keywords']))
+    if rule['pattern']:
+        parts.append(f"re={rule['pattern']}")
+    if rule['price_min'] is not None or rule['price_max'] is not None:
+        low = f"{rule['price_min']:g}" if rule['price_min'] is not None else ''
+        high = f"{rule['price_max']:g}" if rule['price_max'] is not None else ''
+        parts.append(f"цена {low}-{high}")
+    if rule['unit_price_max'] is not None:
+        parts.append(f"≤{rule['unit_price_max']:g} руб/кк")
+    if rule['require_online']:
+        parts.append("онлайн")
+    if rule['min_rating'] is not None:
+        parts.append(f"рейтинг ≥{rule['min_rating']:g}")
+    if rule['categories']:
+        parts.append(f"категории: {', '.join(rule['categories'])}")
+    return ' | '.join(parts)
+
+
+# ==================== ПОДПИСКИ ====================
+
+# Принимать команды от любых чатов (каждый - со своими правилами и категориями).
+# По умолчанию - только TELEGRAM_CHAT_ID, как раньше
+SUBSCRIPTIONS_OPEN = os.environ.get('SUBSCRIPTIONS_OPEN', '0').strip().lower() in ('1', 'true', 'yes', 'on')
+# Токен администратора для веб-интерфейса и API: без него правила с re= там не добавить
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '').strip()
+MAX_SUBSCRIBERS = int(os.environ.get('MAX_SUBSCRIBERS', 10000))
+SUBSCRIBER_MAX_RULES = 20
+
+
+def is_admin_chat(chat_id):
+    return bool(TELEGRAM_CHAT_ID) and str(chat_id) == TELEGRAM_CHAT_ID
+
+
+def is_admin_token(token):
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(str(token or ''), ADMIN_TOKEN)
+
+
+def rule_owner(rule):
+    """Чат-владелец правила: правила без чата принадлежат администратору"""
+    return rule['chat_id'] or TELEGRAM_CHAT_ID
+
+
+def rules_for_chat(chat_id, rules=None):
+    chat_id = str(chat_id)
+    return [rule for rule in (load_rules() if rules is None else rules) if rule_owner(rule) == chat_id]
+
+
+def load_subscriptions():
+    """Подписки {chat_id: {'active': bool, 'categories': [...]}} из общего состояния.
+
+    Администратор подписан всегда, пока сам не отпишется.
+    """
+    _seed_subscriptions()
+    subscriptions = state.load_subscriptions()
+    if TELEGRAM_CHAT_ID and TELEGRAM_CHAT_ID not in subscriptions:
+        subscriptions[TELEGRAM_CHAT_ID] = {'active': True, 'categories': []}
+    return subscriptions
+
+
+def _seed_subscriptions():
+    if state.get_status('subscriptions_version') is None:
+        state.seed_subscriptions()
+
+
+def save_subscription(chat_id, active, categories=None):
+    """Создаёт или меняет подписку. ValueError - неизвестная категория или нет мест"""
+    global _subscribers_checked_at
+    if categories is not None:
+        known = {category.name for category in CATEGORIES}
+        unknown = [name for name in categories if name not in known]
+        if unknown:
+            raise ValueError(f"нет категорий: {', '.join(unknown)}. Есть: {', '.join(sorted(known))}")
+    _seed_subscriptions()
+    subscription = state.save_subscription(str(chat_id), active, categories, MAX_SUBSCRIBERS)
+    if subscription is None:
+        raise ValueError("подписчиков слишком много")
+    _subscribers_checked_at = 0.0
+    return subscription
+
+
+class SubscriberIndex:
+    """Индекс правило → чат и чат → категории для раздачи найденного.
+
+    Страницы разбираются один раз общим движком правил по правилам всех
+    чатов; товар уходит владельцам совпавших правил, чья подписка активна
+    и включает категорию товара. Цена раздачи - от числа совпавших правил,
+    а не от числа подписчиков.
+    """
+
+    def __init__(self, engine, subscriptions):
+        self.engine = engine
+        self.chat_categories = {
+            chat_id: frozenset(sub['categories']) or None
+            for chat_id, sub in subscriptions.items() if sub.get('active')
         }
-        
-        logger.info(f"⚡ Быстрый парсинг {category}...")
-        
-        # БЫСТРЫЙ запрос с коротким таймаутом
-        response = requests.get(url, headers=headers, timeout=10)
-        
-        if response.status_code != 200:
-            logger.error(f"❌ Ошибка HTTP: {response.status_code}")
-            return []
-        
-        soup = BeautifulSoup(response.text, 'html.parser')
-        items = []
-        
-        # Ищем ВСЕ карточки товаров - используем более гибкий подход
-        # На FunPay могут быть разные структуры
-        all_cards = []
-        
-        # Пробуем разные селекторы
-        for selector in ['div.tc-item', 'a.tc-item', '.tc-item', '[class*="tc-item"]']:
-            found = soup.select(selector)
-            if found:
-                all_cards.extend(found)
-        
-        # Убираем дубликаты
-        unique_cards = []
-        seen = set()
-        for card in all_cards:
-            card_hash = hash(str(card))
-            if card_hash not in seen:
-                seen.add(card_hash)
-                unique_cards.append(card)
-        
-        logger.info(f"📦 Найдено уникальных карточек: {len(unique_cards)}")
-        
-        # Обрабатываем только первые 15 карточек (для скорости)
-        for card in unique_cards[:15]:
-            try:
-                # 1. Извлекаем название
-                title = ""
-                title_elem = card.find('div', class_='tc-desc-text')
-                if title_elem:
-                    title = title_elem.get_text(strip=True)
-                else:
-                    # Альтернативный поиск названия
-                    for elem in card.find_all(['div', 'span', 'h3', 'h4']):
-                        if elem.get_text(strip=True):
-                            title = elem.get_text(strip=True)
-                            break
-                
-                if not title:
-                    continue
-                
-                # 2. Фильтруем Black Russia (гибкая фильтрация)
-                title_lower = title.lower()
-                keywords = ['black russia', 'blackrussia', 'блек раша', 'блэк раша', 'br ', 'бр ']
-                
-                if not any(keyword in title_lower for keyword in keywords):
-                    continue
-                
-                # 3. Извлекаем цену
-                price = 0
-                price_elem = card.find('div', class_='tc-price')
-                if price_elem:
-                    price_text = price_elem.get_text(strip=True)
-                    digits = re.findall(r'\d+', price_text.replace(' ', ''))
-                    if digits:
-                        price = int(''.join(digits))
-                
-                if price < 10 or price > 50000:
-                    continue
-                
-                # 4. Извлекаем ссылку
-                link = url
-                link_elem = card if card.name == 'a' else card.find('a')
-                if link_elem and link_elem.get('href'):
-                    href = link_elem['href']
-                    if href.startswith('/'):
-                        link = f"https://funpay.com{href}"
-                    elif href.startswith('http'):
-                        link = href
-                
-                # 5. Проверяем статус продавца (упрощенно)
-                # На FunPay статус может быть в разных местах
-                seller_online = False
-                status_text = ""
-                
-                # Ищем статус в разных местах
-                for status_class in ['media-user-status', 'online-status', 'status']:
-                    status_elem = card.find('div', class_=status_class)
-                    if status_elem:
-                        status_text = status_elem.get_text(strip=True).lower()
-                        if 'онлайн' in status_text or 'online' in status_text:
-                            seller_online = True
-                            break
-                
-                # Если не нашли статус, можем пропустить или считать офлайн
-                if not seller_online:
-                    # Можно раскомментировать, если хотим ТОЛЬКО онлайн
-                    # continue
-                    pass
-                
-                # 6. Создаем ID
-                item_id = f"{hash(title)}_{price}"
-                
-                items.append({
-                    'id': item_id,
-                    'title': title[:100],
-                    'price': price,
-                    'link': link,
-                    'category': category,
-                    'seller_online': seller_online
-                })
-                
-                logger.info(f"   ✅ '{title[:40]}...' - {price} руб. {'(онлайн)' if seller_online else ''}")
-                
-            except Exception as e:
-                logger.debug(f"⚠️ Ошибка карточки: {e}")
-                continue
-        
-        logger.info(f"🎯 Найдено подходящих товаров: {len(items)}")
-        return items
-        
-    except requests.exceptions.Timeout:
-        logger.error("⏱️ Таймаут запроса к FunPay (10 сек)")
-        return []
-    except requests.exceptions.RequestException as e:
-        logger.error(f"🌐 Ошибка сети: {e}")
-        return []
-    except Exception as e:
-        logger.error(f"💥 Неизвестная ошибка: {e}")
-        return []
+        self.rule_chats = {}
+        for rule in engine.rules:
+            owner = rule_owner(rule)
+            if owner in self.chat_categories:
+                self.rule_chats[rule['id']] = owner
+
+    def chats_for(self, item):
+        chats = set()
+        for rule_id in item['rules']:
+            chat_id = self.rule_chats.get(rule_id)
+            if chat_id is not None and chat_id not in chats:
+                categories = self.chat_categories[chat_id]
+                if categories is None or item['category'] in categories:
+                    chats.add(chat_id)
+        return chats
+
+    def stats(self):
+        return {'subscribers': len(self.chat_categories), 'rules': len(self.rule_chats)}
+
 
-def check_new_items():
-    """Проверка новых товаров"""
-    global found_items
+_subscriber_index = None
+_subscribers_version = None
+_subscribers_checked_at = 0.0
+
+
+def get_subscriber_index():
+    """Текущий индекс подписчиков; раз в RULES_RELOAD_INTERVAL сверяет счётчик правок подписок"""
+    global _subscriber_index, _subscribers_version, _subscribers_checked_at
     
-    if not monitoring_active:
-        return
+    engine = get_rule_engine()
+    if (_subscriber_index is not None and _subscriber_index.engine is engine
+            and time.time() - _subscribers_checked_at < RULES_RELOAD_INTERVAL):
+        return _subscriber_index
+    with _rules_lock:
+        _seed_subscriptions()
+        version = state.get_status('subscriptions_version')
+        if _subscriber_index is None or _subscriber_index.engine is not engine or version != _subscribers_version:
+            _subscriber_index = SubscriberIndex(engine, load_subscriptions())
+            _subscribers_version = version
+        _subscribers_checked_at = time.time()
+    return _subscriber_index
+
+
+def format_offer_message(item):
+    return (
+        f"🎮 <b>НОВОЕ ПРЕДЛОЖЕНИЕ</b>\n\n"
+        f"📦 {escape(item['title'])}\n"
+        f"💰 <b>Цена:</b> {item['price']} руб.\n"
+        f"{format_deal(item)}"
+        f"{format_seller(item)}"
+        f"🟢 <b>Продавец онлайн</b>\n"
+        f"🔗 <a href='{escape(item['link'])}'>Купить на FunPay</a>\n\n"
+        f"⏰ {datetime.now().strftime('%H:%M:%S')}"
+    )
+
+
+# Цикл мониторинга и ручная проверка меняют одни снимки карточек и кэш 304 - по очереди
+_check_lock = threading.Lock()
+
+
+def check_new_items(categories=None):
+    """Проверка новых товаров (по умолчанию - во всех категориях). Возвращает число новых"""
+    with _check_lock:
+        return _check_new_items(categories)
+
+
+def _check_new_items(categories):
+    global _compacted_at
+    
+    if not monitor.active:
+        return 0
     
-    logger.info("🔍 Проверка новых товаров...")
+    if categories is None:
+        categories = CATEGORIES
+    if not categories:
+        return 0
     
-    urls_to_monitor = [
-        ("https://funpay.com/chips/186/", "Black Russia - Вирты"),
-    ]
+    logger.info(f"🔍 Проверка новых товаров ({len(categories)} категорий)...")
+    # Правила перечитываем до опроса: перезагрузка посреди разбора страниц не сохранит их снимки
+    get_rule_engine()
+    cycle_started = time.time()
+    new_total = 0
+    polled = set()
+    offers = []
     
-    for url, category in urls_to_monitor:
-        current_items = fast_parse_black_russia(url, category)
+    for category, result in poll_categories(categories):
+        polled.add(category)
+        scheduler.record(category, result)
+        if not result.changed:
+            continue
         
-        for item in current_items:
-            item_id = item['id']
-            if item_id not in found_items:
-                found_items[item_id] = item
-                
-                # Отправляем только если продавец онлайн
-                if item.get('seller_online'):
-                    message = (
-                        f"🎮 <b>НОВОЕ ПРЕДЛОЖЕНИЕ</b>\n\n"
-                        f"📦 {item['title']}\n"
-                        f"💰 <b>Цена:</b> {item['price']} руб.\n"
-                        f"🟢 <b>Продавец онлайн</b>\n"
-                        f"🔗 <a href='{item['link']}'>Купить на FunPay</a>\n\n"
-                        f"⏰ {datetime.now().strftime('%H:%M:%S')}"
-                    )
-                    send_telegram_message(message)
+        # Неизменившиеся карточки уже сверялись в прошлых циклах.
+        # Сначала быстрый фильтр в памяти, затем общее хранилище (другие воркеры, перезапуски)
+        candidates = [item for item in result.changed if seen_items.add(item['id'])]
+        new_keys = state.mark_seen_many(item['id'] for item in candidates)
+        # Отсеянное оценкой сделки раньше оценивается снова, только если его карточка изменилась
+        # (цена входит в ключ, так что здесь - например, продавец вернулся онлайн)
+        rescored = state.take_dropped({item['id'] for item in result.changed} - new_keys)
+        scored = {item['id']: item for item in result.changed if item['id'] in new_keys or item['id'] in rescored}
+        # Оцениваем до записи цен цикла, чтобы предложение не сравнивалось само с собой
+        offers.extend(score_deals(list(scored.values()), category.name))
+        state.record_prices([
+            (item['id'], item['category'], item['price'], item['unit_price'],
+             int(item['seller_online']), cycle_started)
+            for item in result.changed
+        ])
+        for item, old_price in price_history.add_items(result.changed, cycle_started):
+            event_broker.publish('price', dict(event_item(item), old_price=old_price))
+        new_total += len(new_keys)
+        NEW_ITEMS.inc(len(new_keys), category=category.name)
+        DEDUPE_HITS.inc(len(result.changed) - len(new_keys), category=category.name)
     
-    logger.info(f"📊 Всего в памяти: {len(found_items)} товаров")
-
-def monitoring_loop():
-    """Цикл мониторинга"""
-    global monitoring_active
+    # Отправляем только если продавец онлайн (по странице лота, если она успела загрузиться)
+    offers = [item for item in enrich_offers(offers, cycle_started + POLL_DEADLINE) if item.get('seller_online')]
+    # Раздача подписчикам: каждому - лучшие из совпавших с его правилами
+    index = get_subscriber_index()
+    per_chat = {}
+    for item in offers:
+        for chat_id in index.chats_for(item):
+            per_chat.setdefault(chat_id, []).append(item)
+    messages = {}
+    alerted = set()
+    for chat_id, chat_offers in per_chat.items():
+        deals = select_deals(chat_offers)
+        DEALS_FILTERED.inc(len(chat_offers) - len(deals))
+        for item in deals:
+            if item['id'] not in messages:
+                messages[item['id']] = format_offer_message(item)
+            alerted.add(item['id'])
+            send_telegram_message(messages[item['id']], chat_id=chat_id, digest=True)
+    for item in offers:
+        event_broker.publish('offer', dict(event_item(item), alerted=item['id'] in alerted))
+    # Отсеянные оценкой сделки (порог, top_n) остаются увиденными, но с отметкой:
+    # изменится карточка - предложение сравнится с рынком ещё раз
+    state.mark_dropped({item['id']: item['deal_score'] for chat_offers in per_chat.values()
+                        for item in chat_offers if item['id'] not in alerted})
     
-    logger.info("🔄 Мониторинг запущен")
+    # Не уложившиеся в срок страницы считаем ошибкой - планировщик отложит их
+    for category in categories:
+        if category not in polled:
+            scheduler.record(category, None)
     
-    while monitoring_active:
+    save_seen_store(seen_items)
+    CYCLE_SECONDS.observe(time.time() - cycle_started)
+    last_cycle = {
+        'worker': WORKER_ID,
+        'finished_at': time.time(),
+        'duration': round(time.time() - cycle_started, 3),
+        'categories': len(categories),
+        'new_items': new_total,
+    }
+    state.set_status('last_cycle', last_cycle)
+    event_broker.publish('cycle', dict(last_cycle, polled=len(polled), alerted=len(alerted), chats=len(per_chat)))
+    if time.time() - _compacted_at > STATE_COMPACT_INTERVAL:
+        _compacted_at = time.time()
+        state.compact()
+    logger.info(f"📊 Всего в памяти: {len(seen_items)} товаров, цикл {time.time() - cycle_started:.1f} сек")
+    return new_total
+
+
+# ==================== СНИМОК МОНИТОРИНГА ====================
+
+# Снимок для тёплого старта: валидаторы 304, карточки прошлого разбора, расписание.
+# Пусто - не сохранять
+MONITOR_SNAPSHOT_PATH = os.environ.get('MONITOR_SNAPSHOT_PATH', 'monitor_snapshot.json').strip()
+# Как часто ведущий воркер обновляет снимок (и всегда - при выходе)
+MONITOR_SNAPSHOT_INTERVAL = 60
+
+
+class MonitorSnapshot:
+    """Снимок мониторинга на диске.
+
+    Перезапущенный воркер (max_requests) поднимает его до первого опроса:
+    страницы отвечают 304 или разбираются инкрементально, а планировщик
+    продолжает прежние интервалы вместо холодного старта. Снимок, разобранный
+    другими правилами, к страницам не применяется.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.saved_at = None
+        self.loaded = None
+
+    def _fingerprint(self):
+        get_rule_engine()
+        return hashlib.blake2b(f"{_rules_raw}|{ENRICH_OFFERS}".encode('utf-8'), digest_size=8).hexdigest()
+
+    def save(self):
+        if not self.path:
+            return False
+        with self._lock:
+            data = {
+                'saved_at': time.time(),
+                'worker': WORKER_ID,
+                'rules': self._fingerprint(),
+                'pages': dump_pages(),
+                'scheduler': scheduler.dump(),
+            }
+            try:
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+                os.replace(tmp_path, self.path)
+            except (OSError, TypeError, ValueError) as e:
+                logger.error(f"❌ Не удалось сохранить {self.path}: {e}")
+                return False
+            self.saved_at = data['saved_at']
+            self._dirty = False
+            return True
+
+    def maybe_save(self):
+        """После цикла: пишет снимок не чаще MONITOR_SNAPSHOT_INTERVAL"""
+        self._dirty = True
+        if self.saved_at is None or time.time() - self.saved_at >= MONITOR_SNAPSHOT_INTERVAL:
+            self.save()
+
+    def flush(self):
+        """При выходе воркера: сохраняет, если с прошлой записи были циклы"""
+        if self._dirty:
+            self.save()
+
+    def load(self):
+        """Поднимает снимок с диска. False - снимка нет или он не подходит"""
+        if not self.path or not os.path.exists(self.path):
+            return False
+        started = time.perf_counter()
         try:
-            check_new_items()
-            # Ждем 30 секунд (вместо 60 для бесплатного Render)
-            for _ in range(30):
-                if not monitoring_active:
-                    break
-                time.sleep(1)
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            scheduler.restore(data.get('scheduler') or {})
+            pages = 0
+            if data.get('rules') == self._fingerprint():
+                known = {category.url for category in CATEGORIES}
+                restore_pages({url: page for url, page in (data.get('pages') or {}).items() if url in known})
+                pages = len(known & (data.get('pages') or {}).keys())
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.error(f"❌ Снимок мониторинга {self.path} не прочитан: {e}")
+            return False
+        self.loaded = {
+            'saved_at': data.get('saved_at'),
+            'worker': data.get('worker'),
+            'pages': pages,
+            'ms': round((time.perf_counter() - started) * 1000, 1),
+        }
+        logger.info(f"♨️ Тёплый старт: снимок от {data.get('worker')}, страниц {pages}, {self.loaded['ms']} мс")
+        return True
+
+    def stats(self):
+        return {'path': self.path or None, 'saved_at': self.saved_at, 'loaded': self.loaded}
+
+
+monitor_snapshot = MonitorSnapshot(MONITOR_SNAPSHOT_PATH)
+
+
+# ==================== МОНИТОРИНГ ====================
+
+# Как часто сторож проверяет, жив ли поток мониторинга (секунды)
+MONITOR_WATCHDOG_INTERVAL = 15
+# Без сердцебиения дольше этого поток считается зависшим
+MONITOR_STALL_AFTER = MONITOR_LEASE_TTL
+
+
+class MonitorSupervisor:
+    """Единственный поток мониторинга на процесс.
+
+    start/stop/shutdown потокобезопасны: повторный start при живом потоке
+    (в том числе ещё не завершившемся после stop) не создаёт второй цикл,
+    а отменяет остановку. Сторож перезапускает упавший поток, сердцебиение
+    показывает, что цикл не завис.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._watchdog = None
+        self._shutdown = threading.Event()
+        self.active = False
+        self.started_at = None
+        self.heartbeat = None
+        self.restarts = 0
+        self.last_error = None
+
+    def start(self, persist=True):
+        """Включает мониторинг. False - он уже запущен"""
+        with self._lock:
+            if self.active and self._alive():
+                return False
+            self.active = True
+            if persist:
+                state.set_status('monitoring_active', True)
+            self._stop.clear()
+            self._spawn()
+            return True
+
+    def stop(self, persist=True):
+        """Выключает мониторинг, не дожидаясь конца текущей проверки"""
+        with self._lock:
+            self.active = False
+            if persist:
+                state.set_status('monitoring_active', False)
+            self._stop.set()
+
+    def resume(self):
+        """Возобновляет мониторинг в новом воркере, если он был включён до перезапуска"""
+        if not state.get_status('monitoring_active', False):
+            return
+        # Снимок прошлого воркера - до первого опроса, иначе он начнёт с холодного разбора
+        if not self._alive():
+            monitor_snapshot.load()
+        if self.start(persist=False):
+            logger.info("♻️ Мониторинг возобновлён после перезапуска воркера")
+
+    def shutdown(self, timeout=5):
+        """Остановка при выходе воркера: флаг в состоянии не трогаем,
+        аренду отдаём сразу, чтобы мониторинг подхватил другой воркер"""
+        self._shutdown.set()
+        self.stop(persist=False)
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+        monitor_snapshot.flush()
+        state.release_lease('monitor', WORKER_ID)
+
+    def _alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _spawn(self):
+        """Запускает поток, если его нет (вызывается под блокировкой)"""
+        if not self._alive():
+            self.started_at = time.time()
+            self.heartbeat = time.time()
+            self._thread = threading.Thread(target=self._run, name='monitor', daemon=True)
+            self._thread.start()
+        if self._watchdog is None or not self._watchdog.is_alive():
+            self._watchdog = threading.Thread(target=self._watch, name='monitor-watchdog', daemon=True)
+            self._watchdog.start()
+
+    def _watch(self):
+        while not self._shutdown.wait(MONITOR_WATCHDOG_INTERVAL):
+            with self._lock:
+                if self.active and not self._alive():
+                    self.restarts += 1
+                    logger.error(f"💀 Поток мониторинга умер, перезапуск #{self.restarts}")
+                    self._spawn()
+
+    def _should_run(self):
+        """Решение о выходе из цикла принимается под блокировкой, чтобы
+        start, пришедший в этот момент, не остался без потока"""
+        with self._lock:
+            if self._stop.is_set():
+                if self._thread is threading.current_thread():
+                    self._thread = None
+                return False
+            return True
+
+    def _run(self):
+        logger.info("🔄 Мониторинг запущен")
+        loop_errors = 0
+        
+        try:
+            while self._should_run():
+                self.heartbeat = time.time()
+                try:
+                    # Мониторинг мог остановить другой воркер
+                    if not state.get_status('monitoring_active', True):
+                        self.stop(persist=False)
+                        continue
+                    
+                    # Опрашивает только держатель аренды, остальные воркеры ждут
+                    if state.acquire_lease('monitor', WORKER_ID, MONITOR_LEASE_TTL):
+                        check_new_items(scheduler.due())
+                        monitor_snapshot.maybe_save()
+                        wake_at = scheduler.next_wakeup()
+                    else:
+                        logger.debug("💤 Мониторинг ведёт другой воркер")
+                        wake_at = time.time() + POLL_INTERVAL
+                    loop_errors = 0
+                except Exception as e:
+                    loop_errors += 1
+                    self.last_error = f"{type(e).__name__}: {e}"
+                    logger.error(f"❌ Ошибка мониторинга: {e}")
+                    wake_at = time.time() + min(10 * 2 ** (loop_errors - 1), 300) * random.uniform(0.5, 1.0)
+                
+                # Спим до следующего опроса, но не дольше аренды; stop будит сразу
+                wake_at = min(wake_at, time.time() + MONITOR_LEASE_TTL / 3)
+                self._stop.wait(max(wake_at - time.time(), 0))
+        except BaseException as e:
+            self.last_error = f"{type(e).__name__}: {e}"
+            logger.error(f"💀 Поток мониторинга упал: {self.last_error}")
+            raise
+        
+        state.release_lease('monitor', WORKER_ID)
+        logger.info("⏹️ Мониторинг завершён")
+
+    def stats(self):
+        now = time.time()
+        alive = self._alive()
+        heartbeat_age = now - self.heartbeat if self.heartbeat else None
+        return {
+            'active': self.active,
+            'thread_alive': alive,
+            'healthy': (not self.active) or (alive and heartbeat_age is not None
+                                             and heartbeat_age < MONITOR_STALL_AFTER),
+            'started_at': self.started_at,
+            'heartbeat_age': round(heartbeat_age, 1) if heartbeat_age is not None else None,
+            'restarts': self.restarts,
+            'last_error': self.last_error,
+        }
+
+
+monitor = MonitorSupervisor()
+
+
+# ==================== ФОНОВЫЕ ЗАДАЧИ ====================
+
+# Долгие операции (/check, /test) выполняются вне потока запроса,
+# чтобы медленный FunPay не блокировал webhook и /health
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+# Сколько задач помнить для опроса статуса
+JOB_HISTORY = 100
+# Незавершённая задача старше этого считается потерянной (её воркер перезапустился)
+JOB_STALE_AFTER = 600
+
+
+class Job:
+    """Фоновая задача: статус queued → running → done/error"""
+
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.status = 'queued'
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+
+    @classmethod
+    def from_dict(cls, data):
+        """Задача из общего состояния (в том числе созданная другим воркером)"""
+        job = cls(data['name'])
+        for name in ('id', 'status', 'created_at', 'started_at', 'finished_at', 'result', 'error'):
+            setattr(job, name, data.get(name))
+        return job
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'error')
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'error': self.error,
+        }
+
+    def dump(self):
+        """Запись для общего состояния: с результатом (он должен быть JSON)"""
+        return dict(self.as_dict(), result=self.result)
+
+
+class JobQueue:
+    """Очередь фоновых задач.
+
+    Задача выполняется в воркере, который её создал, а статус и результат
+    пишутся в общее состояние: /jobs/<id> и /test?job= работают из любого
+    воркера. Повторный запуск задачи с тем же именем, пока она не
+    завершилась (в любом воркере), возвращает уже идущую задачу.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, history=JOB_HISTORY):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._lock = threading.Lock()
+        # Задачи, которые выполняет этот процесс
+        self._running = {}
+        self._history = history
+        self.coalesced = 0
+
+    def submit(self, name, func, *args, on_done=None):
+        """Ставит задачу в очередь. Возвращает (задача, создана ли новая)"""
+        job = Job(name)
+        with self._lock:
+            existing = state.claim_job(job.dump(), job.created_at - JOB_STALE_AFTER, self._history)
+            if existing is not None:
+                self.coalesced += 1
+                return self._running.get(existing['id']) or Job.from_dict(existing), False
+            self._running[job.id] = job
+        self._executor.submit(self._run, job, func, args, on_done)
+        return job, True
+
+    def _run(self, job, func, args, on_done):
+        job.status = 'running'
+        job.started_at = time.time()
+        state.save_job(job.dump())
+        try:
+            job.result = func(*args)
+            job.status = 'done'
         except Exception as e:
-            logger.error(f"❌ Ошибка мониторинга: {e}")
-            time.sleep(10)
+            logger.error(f"❌ Задача {job.name} ({job.id}) упала: {e}")
+            job.error = str(e)
+            job.status = 'error'
+        finally:
+            job.finished_at = time.time()
+            try:
+                state.save_job(job.dump())
+            except Exception as e:
+                logger.error(f"❌ Не удалось сохранить задачу {job.name} ({job.id}): {e}")
+            with self._lock:
+                self._running.pop(job.id, None)
+        if on_done is not None:
+            try:
+                on_done(job)
+            except Exception as e:
+                logger.error(f"❌ Обработчик задачи {job.name} упал: {e}")
+
+    def get(self, job_id):
+        data = state.get_job(job_id)
+        if data is None:
+            return None
+        job = Job.from_dict(data)
+        if not job.finished and time.time() - job.created_at > JOB_STALE_AFTER:
+            job.status = 'error'
+            job.error = 'задача потеряна: её воркер перезапустился'
+        return job
+
+    def recent(self, limit=20):
+        return [Job.from_dict(data).as_dict() for data in state.recent_jobs(limit)]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'active': sorted(job.name for job in self._running.values()),
+                'coalesced': self.coalesced,
+            }
+
+
+job_queue = JobQueue()
+
+
+def manual_check_job():
+    """Ручная проверка для очереди задач: результат - число новых товаров.
+
+    Опрашивает только держатель аренды и в пределах бюджета планировщика;
+    с циклом мониторинга не пересекается (check_new_items под блокировкой).
+    """
+    # Остановленный мониторинг не опрашивает: не берём аренду и не тратим бюджет впустую
+    if not state.get_status('monitoring_active', False):
+        raise RuntimeError('мониторинг остановлен, запустите его: /monitor')
+    if not state.acquire_lease('monitor', WORKER_ID, MONITOR_LEASE_TTL):
+        raise RuntimeError('мониторинг ведёт другой воркер, проверка уже идёт там')
+    categories = scheduler.take(CATEGORIES)
+    if not categories:
+        raise RuntimeError('бюджет запросов к FunPay исчерпан, попробуйте через минуту')
+    new_items = check_new_items(categories)
+    return {'items': len(seen_items), 'new_items': new_items}
+
+
+def report_check_job(job):
+    """Итог ручной проверки из Telegram"""
+    if job.status == 'done':
+        send_telegram_message(
+            f"✅ Проверено. Новых: {job.result['new_items']}, товаров в памяти: {job.result['items']}"
+        )
+    else:
+        send_telegram_message(f"❌ Проверка не удалась: {escape(job.error or '')}")
+
+
+def test_parse_job():
+    """Полный тест парсинга для очереди задач: товары, HTTP-код и вид ошибки, если была"""
+    result = parse_page("https://funpay.com/chips/186/", "Black Russia", conditional=False, incremental=False)
+    return {'items': result.items, 'status': result.status, 'error': result.error}
+
 
 # ==================== FLASK ROUTES ====================
 
 @app.route('/')
 def index():
-    status = "🟢 АКТИВЕН" if monitoring_active else "🔴 ОСТАНОВЛЕН"
+    status = "🟢 АКТИВЕН" if monitor.active else "🔴 ОСТАНОВЛЕН"
     return f'''
     <!DOCTYPE html>
     <html>
@@ -259,7 +4444,7 @@ def index():
         <div class="card">
             <h3>📊 Статус системы</h3>
             <p><strong>Мониторинг:</strong> {status}</p>
-            <p><strong>Найдено товаров:</strong> {len(found_items)}</p>
+            <p><strong>Найдено товаров:</strong> {len(seen_items)}</p>
             <p><strong>Время:</strong> {datetime.now().strftime("%H:%M:%S")}</p>
             <p><strong>Telegram:</strong> {'✅ Настроен' if TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID else '❌ Не настроен'}</p>
         </div>
@@ -270,7 +4455,46 @@ def index():
             <a href="/start_monitor" class="btn btn-green">▶️ Запустить мониторинг</a>
             <a href="/stop_monitor" class="btn btn-red">⏹️ Остановить мониторинг</a>
             <a href="/check" class="btn btn-blue">🔄 Проверить сейчас</a>
+            <a href="/rules" class="btn btn-orange">📋 Правила</a>
+        </div>
+        
+        <div class="card">
+            <h3>📡 Живая лента</h3>
+            <p id="cycle"><button onclick="connectFeed(this)">Подключить ленту</button></p>
+            <div id="feed"></div>
         </div>
+        <script>
+            const feed = document.getElementById('feed');
+            const esc = s => String(s ?? '').replace(/[&<>"']/g, c => '&#' + c.charCodeAt(0) + ';');
+            const add = html => {{
+                feed.insertAdjacentHTML('afterbegin', '<p>' + html + '</p>');
+                while (feed.children.length > 50) feed.lastChild.remove();
+            }};
+            // Лента держит поток воркера, поэтому подключается только по кнопке
+            function connectFeed(button) {{
+                button.disabled = true;
+                document.getElementById('cycle').textContent = 'Ожидание цикла мониторинга...';
+                const source = new EventSource('/events');
+                source.addEventListener('error', () => {{
+                    // 503: места под ленту нет - не переподключаемся в цикле
+                    if (source.readyState === EventSource.CLOSED) add('⚠️ Лента недоступна, попробуйте позже');
+                }});
+                source.addEventListener('offer', e => {{
+                    const o = JSON.parse(e.data);
+                    add('🆕 <a href="' + esc(o.link) + '" target="_blank">' + esc(o.title) + '</a> - ' + esc(o.price) + ' руб.'
+                        + (o.deal_score != null ? ' (' + Math.round(o.deal_score * 100) + '% к медиане)' : ''));
+                }});
+                source.addEventListener('price', e => {{
+                    const o = JSON.parse(e.data);
+                    add('💱 ' + esc(o.title) + ': ' + esc(o.old_price) + ' → ' + esc(o.price) + ' руб.');
+                }});
+                source.addEventListener('cycle', e => {{
+                    const c = JSON.parse(e.data);
+                    document.getElementById('cycle').textContent = '⏱️ Цикл ' + new Date(c.finished_at * 1000).toLocaleTimeString()
+                        + ': ' + c.duration + ' сек, новых ' + c.new_items;
+                }});
+            }}
+        </script>
         
         <div class="card">
             <h3>📋 Инструкция</h3>
@@ -280,7 +4504,8 @@ def index():
                 <li>Запустите мониторинг</li>
                 <li>Бот будет присылать уведомления в Telegram</li>
             </ol>
-            <p><strong>Telegram команды:</strong> /start, /check, /monitor, /stop, /status</p>
+            <p><strong>Живая лента:</strong> /events (SSE), /events/poll?since=N (long-poll)</p>
+            <p><strong>Telegram команды:</strong> /start, /check, /monitor, /stop, /status, /rules</p>
         </div>
     </body>
     </html>
@@ -288,58 +4513,87 @@ def index():
 
 @app.route('/test')
 def test():
-    """Полный тест парсинга"""
-    try:
-        items = fast_parse_black_russia("https://funpay.com/chips/186/", "Black Russia")
-        
-        if items:
-            html = f"<h2>✅ Найдено {len(items)} товаров:</h2>"
-            for item in items:
-                online_badge = "🟢 ОНЛАЙН" if item['seller_online'] else "🔴 ОФФЛАЙН"
-                html += f'''
-                <div style="border:1px solid #ddd; padding:15px; margin:10px; border-radius:5px;">
-                    <h4>{item['title']}</h4>
-                    <p><strong>Цена:</strong> {item['price']} руб.</p>
-                    <p><strong>Статус:</strong> {online_badge}</p>
-                    <p><a href="{item['link']}" target="_blank">Открыть на FunPay</a></p>
-                </div>
-                '''
-        else:
-            html = '''
-            <div style="background:#f8d7da; padding:20px; border-radius:5px;">
-                <h2>❌ Товары не найдены</h2>
-                <p>Возможные причины:</p>
-                <ul>
-                    <li>Нет онлайн продавцов в данный момент</li>
-                    <li>Страница FunPay недоступна</li>
-                    <li>Изменена структура сайта</li>
-                </ul>
-                <p>Попробуйте <a href="/quick_test">быстрый тест</a> для проверки подключения.</p>
-            </div>
-            '''
-        
+    """Полный тест парсинга (в фоне, страница обновляется до готовности)"""
+    job = job_queue.get(request.args.get('job', ''))
+    if job is None:
+        job, _ = job_queue.submit('test', test_parse_job)
+        return redirect(f"/test?job={job.id}")
+    
+    if not job.finished:
         return f'''
         <!DOCTYPE html>
         <html>
-        <head><title>Тест парсинга</title></head>
+        <head><title>Тест парсинга</title><meta http-equiv="refresh" content="2"></head>
         <body style="font-family:Arial; margin:20px;">
             <a href="/">← Назад</a>
-            {html}
+            <h2>⏳ Парсинг выполняется...</h2>
+            <p>Задача <a href="/jobs/{job.id}">{job.id}</a>, страница обновится сама.</p>
         </body>
         </html>
         '''
-    except Exception as e:
-        return f"<h2>❌ Ошибка:</h2><pre>{e}</pre><p><a href='/'>Назад</a></p>"
+    
+    if job.status == 'error':
+        return f"<h2>❌ Ошибка:</h2><pre>{escape(job.error)}</pre><p><a href='/'>Назад</a></p>"
+    
+    items = job.result['items']
+    if job.result['error']:
+        html = f'''
+        <div style="background:#f8d7da; padding:20px; border-radius:5px;">
+            <h2>❌ Страница не загружена</h2>
+            <p>{FETCH_ERROR_TEXTS.get(job.result['error'], job.result['error'])} (HTTP {job.result['status']})</p>
+            <p>Попробуйте <a href="/quick_test">быстрый тест</a> для проверки подключения.</p>
+        </div>
+        '''
+    elif items:
+        html = f"<h2>✅ Найдено {len(items)} товаров:</h2>"
+        for item in items:
+            online_badge = "🟢 ОНЛАЙН" if item['seller_online'] else "🔴 ОФФЛАЙН"
+            html += f'''
+            <div style="border:1px solid #ddd; padding:15px; margin:10px; border-radius:5px;">
+                <h4>{escape(item['title'])}</h4>
+                <p><strong>Цена:</strong> {item['price']} руб.</p>
+                <p><strong>Статус:</strong> {online_badge}</p>
+                <p><a href="{escape(item['link'])}" target="_blank">Открыть на FunPay</a></p>
+            </div>
+            '''
+    else:
+        html = '''
+        <div style="background:#f8d7da; padding:20px; border-radius:5px;">
+            <h2>❌ Товары не найдены</h2>
+            <p>Возможные причины:</p>
+            <ul>
+                <li>Нет онлайн продавцов в данный момент</li>
+                <li>Страница FunPay недоступна</li>
+                <li>Изменена структура сайта</li>
+            </ul>
+            <p>Попробуйте <a href="/quick_test">быстрый тест</a> для проверки подключения.</p>
+        </div>
+        '''
+    
+    return f'''
+    <!DOCTYPE html>
+    <html>
+    <head><title>Тест парсинга</title></head>
+    <body style="font-family:Arial; margin:20px;">
+        <a href="/">← Назад</a>
+        {html}
+    </body>
+    </html>
+    '''
 
 @app.route('/quick_test')
 def quick_test():
     """Быстрый тест подключения"""
     try:
         import time
+        from bs4 import BeautifulSoup
         start_time = time.time()
         
-        response = requests.get("https://funpay.com/chips/186/", timeout=5)
-        soup = BeautifulSoup(response.text, 'html.parser')
+        # Через общий fetch: автоматы, прокси и лимит размера тела те же, что у мониторинга
+        response = fetch("https://funpay.com/chips/186/", "Black Russia", timeout=5, max_bytes=FETCH_MAX_BYTES)
+        with response:
+            html = ''.join(iter_body(response, "Black Russia"))
+        soup = BeautifulSoup(html, 'html.parser')
         
         # Быстрый анализ
         all_divs = len(soup.find_all('div'))
@@ -362,7 +4616,7 @@ def quick_test():
                 <p><strong>Всего div элементов:</strong> {all_divs}</p>
                 <p><strong>Элементов .tc-item:</strong> {tc_items}</p>
                 <p><strong>Элементов .tc-desc-text:</strong> {tc_desc}</p>
-                <p><strong>Размер страницы:</strong> {len(response.text)//1000} КБ</p>
+                <p><strong>Размер страницы:</strong> {len(html)//1000} КБ</p>
             </div>
             <p><a href="/test">Полный тест парсинга →</a></p>
         </body>
@@ -387,14 +4641,7 @@ def quick_test():
 @app.route('/start_monitor')
 def start_monitor():
     """Запуск мониторинга"""
-    global monitoring_active, monitoring_thread
-    
-    if not monitoring_active:
-        monitoring_active = True
-        monitoring_thread = threading.Thread(target=monitoring_loop)
-        monitoring_thread.daemon = True
-        monitoring_thread.start()
-        
+    if monitor.start():
         send_telegram_message("✅ <b>Мониторинг запущен!</b>\nБот будет проверять новые предложения каждые 30 секунд.")
         
         return '''
@@ -423,8 +4670,7 @@ def start_monitor():
 @app.route('/stop_monitor')
 def stop_monitor():
     """Остановка мониторинга"""
-    global monitoring_active
-    monitoring_active = False
+    monitor.stop()
     send_telegram_message("⏸️ <b>Мониторинг остановлен</b>")
     
     return '''
@@ -440,80 +4686,243 @@ def stop_monitor():
 
 @app.route('/check')
 def manual_check():
-    """Ручная проверка"""
-    check_new_items()
+    """Ручная проверка (в фоне)"""
+    job, created = job_queue.submit('check', manual_check_job)
+    status = "🔍 Проверка запущена" if created else "⏳ Проверка уже выполняется"
+    return f'''
+    <!DOCTYPE html>
+    <html>
+    <body style="font-family:Arial; margin:20px;">
+        <a href="/">← Назад</a>
+        <h2>{status}</h2>
+        <p>Задача: <a href="/jobs/{job.id}">{job.id}</a></p>
+        <p>Товаров в памяти: {len(seen_items)}</p>
+    </body>
+    </html>
+    ''', 202
+
+@app.route('/jobs')
+def jobs_list():
+    """Последние фоновые задачи"""
+    return jsonify({'jobs': job_queue.recent(), **job_queue.stats()})
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Статус фоновой задачи"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'not found'}), 404
+    data = job.as_dict()
+    if job.status == 'done' and job.name == 'check':
+        data['result'] = job.result
+    elif job.status == 'done' and job.name == 'test':
+        data['result'] = dict(job.result, items=len(job.result['items']))
+    return jsonify(data)
+
+@app.route('/rules', methods=['GET', 'POST'])
+def rules_page():
+    """Правила отбора: список и добавление"""
+    message = ""
+    if request.method == 'POST':
+        try:
+            data = request.form.to_dict()
+            rule = add_rule(data, token=data.pop('token', None))
+            message = f"<p style='color:#28a745;'>✅ Правило #{rule['id']} добавлено</p>"
+        except ValueError as e:
+            message = f"<p style='color:#dc3545;'>❌ {escape(str(e))}</p>"
+    
+    rows = ""
+    for rule in load_rules():
+        rows += f'''
+            <tr>
+                <td>#{rule['id']}</td>
+                <td>{escape(rule['name'])}</td>
+                <td>{escape(describe_rule(rule))}</td>
+                <td>{escape(rule['chat_id'] or 'админ')}</td>
+                <td>
+                    <form method="post" action="/rules/{rule['id']}/delete" style="margin:0;">
+                        <button type="submit">🗑️</button>
+                    </form>
+                </td>
+            </tr>
+        '''
+    
     return f'''
     <!DOCTYPE html>
     <html>
+    <head><title>Правила отбора</title><meta charset="utf-8"></head>
     <body style="font-family:Arial; margin:20px;">
         <a href="/">← Назад</a>
-        <h2>🔍 Проверка выполнена</h2>
-        <p>Проверено на наличие новых предложений.</p>
-        <p>Найдено товаров: {len(found_items)}</p>
+        <h2>📋 Правила отбора</h2>
+        {message}
+        <table border="1" cellpadding="8" style="border-collapse:collapse;">
+            <tr><th>ID</th><th>Название</th><th>Условия</th><th>Чат</th><th></th></tr>
+            {rows}
+        </table>
+        <h3>➕ Новое правило</h3>
+        <form method="post">
+            <p>Название: <input name="name"></p>
+            <p>Ключевые слова (через запятую): <input name="keywords" size="40"></p>
+            <p>Регулярное выражение: <input name="pattern" size="40">
+               токен администратора: <input name="token" type="password" size="20"></p>
+            <p>Категории (через запятую, пусто - все): <input name="categories" size="40"></p>
+            <p>Цена от <input name="price_min" size="6"> до <input name="price_max" size="6"> руб.</p>
+            <p>Не дороже <input name="unit_price_max" size="6"> руб. за 1 кк</p>
+            <p>Рейтинг продавца от <input name="min_rating" size="4"></p>
+            <p><label><input type="checkbox" name="require_online" value="1"> Только онлайн продавцы</label></p>
+            <button type="submit">Добавить</button>
+        </form>
     </body>
     </html>
     '''
 
+@app.route('/rules/<int:rule_id>/delete', methods=['POST'])
+def rules_delete(rule_id):
+    delete_rule(rule_id)
+    return redirect('/rules')
+
+@app.route('/api/rules', methods=['GET', 'POST'])
+def api_rules():
+    """JSON API правил: GET - список, POST - добавить"""
+    if request.method == 'POST':
+        try:
+            data = request.get_json(force=True) or {}
+            return jsonify(add_rule(data, token=request.headers.get('X-Admin-Token'))), 201
+        except ValueError as e:
+            return jsonify({'status': 'error', 'error': str(e)}), 400
+    return jsonify(load_rules())
+
+@app.route('/api/rules/<int:rule_id>', methods=['DELETE'])
+def api_rules_delete(rule_id):
+    if delete_rule(rule_id):
+        return jsonify({'status': 'ok'})
+    return jsonify({'status': 'error', 'error': 'not found'}), 404
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    """Webhook для Telegram"""
+    """Webhook для Telegram: администратор управляет мониторингом,
+    любой чат (если SUBSCRIPTIONS_OPEN) - своей подпиской и правилами"""
     try:
         data = request.get_json()
         
         if 'message' in data and 'text' in data['message']:
             text = data['message']['text']
-            chat_id = data['message']['chat']['id']
+            chat_id = str(data['message']['chat']['id'])
+            is_admin = is_admin_chat(chat_id)
             
-            if str(chat_id) != TELEGRAM_CHAT_ID:
+            if not is_admin and not SUBSCRIPTIONS_OPEN:
                 return jsonify({'status': 'error'}), 403
             
-            if text == '/start':
-                send_telegram_message(
+            def reply(message):
+                send_telegram_message(message, chat_id=chat_id)
+            
+            if text in ('/check', '/monitor', '/stop') and not is_admin:
+                reply("⛔ Команда только для администратора. Подписка: /subscribe, /unsubscribe")
+            
+            elif text == '/start':
+                try:
+                    if chat_id not in load_subscriptions():
+                        save_subscription(chat_id, True)
+                    subscribed = "✅ Вы подписаны на оповещения.\n\n"
+                except ValueError as e:
+                    subscribed = f"⚠️ {escape(str(e))}\n\n"
+                reply(
                     "🚀 <b>FunPay Hunter для Black Russia</b>\n\n"
                     "Я отслеживаю новые предложения на FunPay.\n"
                     "Только онлайн продавцы, мгновенные уведомления.\n\n"
+                    f"{subscribed}"
                     "<b>Команды:</b>\n"
-                    "/check - проверить сейчас\n"
-                    "/monitor - запустить авто-проверку\n"
-                    "/stop - остановить\n"
-                    "/status - статус\n"
+                    + ("/check - проверить сейчас\n"
+                       "/monitor - запустить авто-проверку\n"
+                       "/stop - остановить\n" if is_admin else "")
+                    + "/status - статус\n"
+                    "/rules - правила отбора\n"
+                    "/subscribe - категории подписки\n"
+                    "/unsubscribe - отписаться\n"
                     "/help - помощь"
                 )
             
             elif text == '/check':
-                send_telegram_message("🔍 Проверяю...")
-                check_new_items()
-                send_telegram_message(f"✅ Проверено. Товаров в памяти: {len(found_items)}")
+                # Отвечаем Telegram сразу, итог придёт отдельным сообщением
+                job, created = job_queue.submit('check', manual_check_job, on_done=report_check_job)
+                if created:
+                    reply("🔍 Проверяю...")
+                else:
+                    reply("⏳ Проверка уже идёт")
             
             elif text == '/monitor':
-                global monitoring_active
-                if not monitoring_active:
-                    monitoring_active = True
-                    thread = threading.Thread(target=monitoring_loop)
-                    thread.daemon = True
-                    thread.start()
-                    send_telegram_message("✅ Мониторинг запущен! Проверка каждые 30 сек.")
+                if monitor.start():
+                    reply("✅ Мониторинг запущен! Проверка каждые 30 сек.")
                 else:
-                    send_telegram_message("⚠️ Мониторинг уже запущен")
+                    reply("⚠️ Мониторинг уже запущен")
             
             elif text == '/stop':
-                monitoring_active = False
-                send_telegram_message("⏸️ Мониторинг остановлен")
+                monitor.stop()
+                reply("⏸️ Мониторинг остановлен")
             
             elif text == '/status':
-                status = "🟢 АКТИВЕН" if monitoring_active else "🔴 ОСТАНОВЛЕН"
-                send_telegram_message(
+                status = "🟢 АКТИВЕН" if monitor.active else "🔴 ОСТАНОВЛЕН"
+                subscription = load_subscriptions().get(chat_id)
+                if subscription and subscription['active']:
+                    categories = ', '.join(subscription['categories']) or 'все'
+                    subscribed = f"Подписка: ✅ (категории: {escape(categories)})\n"
+                else:
+                    subscribed = "Подписка: ❌ (/subscribe)\n"
+                reply(
                     f"📊 <b>Статус</b>\n\n"
                     f"Мониторинг: {status}\n"
-                    f"Товаров: {len(found_items)}\n"
+                    f"{subscribed}"
+                    f"Правил: {len(rules_for_chat(chat_id))}\n"
+                    f"Товаров: {len(seen_items)}\n"
                     f"Время: {datetime.now().strftime('%H:%M:%S')}"
                 )
             
+            elif text.startswith('/subscribe'):
+                names = [name.strip() for name in text[len('/subscribe'):].split(',') if name.strip()]
+                try:
+                    save_subscription(chat_id, True, names)
+                    reply(f"✅ Подписка на категории: {escape(', '.join(names) or 'все')}")
+                except ValueError as e:
+                    reply(f"❌ {escape(str(e))}\n\nФормат: /subscribe категория, категория (пусто - все)")
+            
+            elif text == '/unsubscribe':
+                save_subscription(chat_id, False)
+                reply("🔕 Оповещения отключены. Вернуть: /subscribe")
+            
+            elif text == '/rules':
+                lines = [f"#{rule['id']} {escape(describe_rule(rule))}" for rule in rules_for_chat(chat_id)]
+                reply("📋 <b>Правила отбора</b>\n\n" + ("\n".join(lines) or "Правил нет. Добавить: /addrule"))
+            
+            elif text.startswith('/addrule'):
+                try:
+                    rule = add_rule(parse_rule_text(text[len('/addrule'):].strip()), chat_id=chat_id)
+                    reply(f"✅ Правило #{rule['id']}: {escape(describe_rule(rule))}")
+                except ValueError as e:
+                    reply(
+                        f"❌ {escape(str(e))}\n\n"
+                        "Формат: /addrule black russia, br | price=100-3000 | unit=150 | online | rating=4.5"
+                    )
+            
+            elif text.startswith('/delrule'):
+                rule_id = text[len('/delrule'):].strip().lstrip('#')
+                if rule_id.isdigit() and delete_rule(int(rule_id), chat_id=chat_id):
+                    reply(f"🗑️ Правило #{rule_id} удалено")
+                else:
+                    reply("⚠️ Нет такого правила. Список: /rules")
+            
             elif text == '/help':
-                send_telegram_message(
+                reply(
                     "❓ <b>Помощь</b>\n\n"
-                    "Бот отслеживает Black Russia на FunPay.\n"
-                    "Только онлайн продавцы, цена 10-50000 руб.\n\n"
+                    "Бот отслеживает предложения на FunPay по правилам отбора.\n"
+                    "Оповещения - только об онлайн продавцах.\n\n"
+                    "<b>Подписка:</b>\n"
+                    "/subscribe - все категории\n"
+                    "/subscribe категория, категория - только выбранные\n"
+                    "/unsubscribe - отписаться\n\n"
+                    "<b>Правила:</b>\n"
+                    "/rules - список\n"
+                    "/addrule слова, через, запятую | price=100-3000 | unit=150 | online | rating=4.5\n"
+                    "/delrule N - удалить\n\n"
                     "Веб-интерфейс: откройте в браузере адрес вашего сервиса на Render."
                 )
         
@@ -525,14 +4934,120 @@ def webhook():
 
 @app.route('/health')
 def health():
+    monitor_stats = monitor.stats()
     return jsonify({
-        'status': 'ok',
-        'monitoring': monitoring_active,
-        'items': len(found_items),
+        # degraded - мониторинг включён, но поток мёртв или завис
+        'status': 'ok' if monitor_stats['healthy'] else 'degraded',
+        'monitoring': monitor.active,
+        'monitor': monitor_stats,
+        'items': len(seen_items),
+        'seen_store': seen_items.stats(),
+        'state_backend': state.kind,
+        'last_cycle': state.get_status('last_cycle'),
+        'telegram': telegram_dispatcher.stats(),
+        'scheduler': scheduler.stats(),
+        'price_history': price_history.summary(),
+        'jobs': job_queue.stats(),
+        'enrichment': dict(offer_enricher.stats(), enabled=ENRICH_OFFERS),
+        'events': event_broker.stats(),
+        'fetch': fetch_stats(),
+        'layout': layout_monitor.stats(),
+        'capture': page_recorder.stats() if page_recorder else None,
+        'snapshot': monitor_snapshot.stats(),
+        'startup': startup_profile(),
+        'subscriptions': get_subscriber_index().stats(),
         'time': datetime.now().isoformat()
     })
 
+@app.route('/events')
+def events():
+    """Живая лента (Server-Sent Events): новые предложения, цены, итоги циклов"""
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('since')
+    last_id = int(last_id) if last_id and last_id.isdigit() else None
+    subscriber = event_broker.subscribe(last_id)
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    if subscriber is None:
+        # Потоки под ленту заняты: отдаём пропущенное и закрываем соединение.
+        # EventSource переподключится через retry с Last-Event-ID - пустое событие
+        # с id задаёт его и новому клиенту, так что ничего не теряется
+        batch = event_broker.since(last_id) if last_id is not None else []
+        body = (f"retry: {EVENTS_BUSY_RETRY * 1000}\n\n"
+                + (''.join(format_sse(event) for event in batch) or f"id: {event_broker.last_id()}\n\n"))
+        return app.response_class(body, mimetype='text/event-stream', headers=headers)
+    
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                batch = event_broker.get(subscriber, EVENTS_KEEPALIVE)
+                if not batch:
+                    # Комментарий держит соединение и вовремя замечает ушедшего клиента
+                    yield ": keepalive\n\n"
+                for event in batch:
+                    yield format_sse(event)
+        finally:
+            event_broker.unsubscribe(subscriber)
+    
+    return app.response_class(stream(), mimetype='text/event-stream', headers=headers)
+
+@app.route('/events/poll')
+def events_poll():
+    """Long-poll для клиентов без SSE: события новее since"""
+    since = request.args.get('since', '0')
+    try:
+        timeout = float(request.args.get('timeout', EVENTS_POLL_TIMEOUT))
+    except ValueError:
+        timeout = None
+    # not (0 <= nan) - тоже ошибка
+    if timeout is None or not 0 <= timeout:
+        return jsonify({'error': 'timeout - неотрицательное число секунд'}), 400
+    busy = event_broker.full()
+    batch = event_broker.wait_since(int(since) if since.isdigit() else 0, min(timeout, EVENTS_POLL_TIMEOUT))
+    data = {
+        'events': [{'id': e.id, 'kind': e.kind, 'data': e.data, 'ts': e.ts} for e in batch],
+        'last_id': batch[-1].id if batch else int(since) if since.isdigit() else 0,
+    }
+    if busy:
+        # Ответили не дожидаясь событий: следующий запрос - не раньше чем через retry_after
+        data['retry_after'] = EVENTS_BUSY_RETRY
+    return jsonify(data)
+
+@app.route('/layout')
+def layout_status():
+    """Сверка вёрстки с эталонами по категориям"""
+    return jsonify(layout_monitor.stats())
+
+@app.route('/layout/reset', methods=['POST'])
+def layout_reset():
+    """Принять текущую вёрстку: эталон снимется со следующей страницы"""
+    layout_monitor.reset(request.args.get('category'))
+    return jsonify({'status': 'ok'})
+
+@app.route('/api/prices')
+def api_prices():
+    """Скользящая статистика цен по категориям (цена и цена за 1 кк)"""
+    category = request.args.get('category')
+    if category:
+        return jsonify({metric: price_history.stats(category, metric) for metric in ('price', 'unit_price')})
+    return jsonify(price_history.all_stats())
+
+@app.route('/metrics')
+def metrics():
+    """Метрики в формате Prometheus"""
+    seen_stats = seen_items.stats()
+    SEEN_SIZE.set(seen_stats['size'])
+    SEEN_EVICTIONS.set(seen_stats['evictions'])
+    SEEN_MEMORY.set(seen_stats['memory_bytes'])
+    TELEGRAM_QUEUE.set(telegram_dispatcher.stats()['queued'])
+    MONITORING_UP.set(1 if monitor.active else 0)
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+startup_phase('routes')
+logger.info(f"🚀 Модуль загружен за {startup_profile()['total_ms']} мс: "
+            + ', '.join(f"{name} {seconds * 1000:.0f}" for name, seconds in STARTUP_PHASES))
+
 # Запуск приложения
 if __name__ == '__main__':
+    monitor.resume()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
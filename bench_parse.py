@@ -0,0 +1,317 @@
+"""Офлайн-бенчмарк парсера карточек FunPay.
+
+Поднимает локальный HTTP-сервер вместо funpay.com и прогоняет все
+экстракторы по страницам /chips/186/ разного размера. Сеть не нужна.
+
+Страницы берутся из bench_fixtures/*.html (сохранённые снимки, см. --record),
+а недостающие размеры генерируются детерминированно.
+
+Примеры:
+    python bench_parse.py
+    python bench_parse.py --sizes 50 500 5000 --repeat 5
+    python bench_parse.py --save-json bench_baseline.json
+    python bench_parse.py --compare bench_baseline.json --max-slowdown 1.25
+    python bench_parse.py --record https://funpay.com/chips/186/
+"""
+import argparse
+import glob
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+# До импорта app: бенчмарк не должен писать в рабочее состояние, архив и снимок
+os.environ['STATE_BACKEND'] = 'memory'
+os.environ['SEEN_STORE_PATH'] = ''
+os.environ['CAPTURE_PATH'] = ''
+os.environ['MONITOR_SNAPSHOT_PATH'] = ''
+os.environ['CATEGORIES_FILE'] = ''
+
+import app
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_fixtures')
+DEFAULT_SIZES = (50, 500, 5000)
+SERVERS = ('Red', 'Green', 'Blue', 'Yellow', 'Orange', 'Purple', 'Lime', 'Pink', 'Cherry', 'Black')
+
+
+# ==================== ФИКСТУРЫ ====================
+
+def make_chips_page(cards, seed=186):
+    """Страница в разметке funpay.com/chips/186/ с заданным числом карточек"""
+    rnd = random.Random(seed + cards)
+    parts = [
+        '<!DOCTYPE html><html lang="ru"><head><meta charset="utf-8">'
+        '<title>Black Russia - Вирты - FunPay</title>'
+        '<link rel="stylesheet" href="/css/main.css"><script src="/js/app.js"></script></head>'
+        '<body><header class="header"><nav class="navbar">'
+        + ''.join(f'<a class="menu-item" href="/games/{i}/">Игра {i}</a>' for i in range(40))
+        + '</nav></header><div class="content"><div class="tc table-hover table-clickable">'
+        '<div class="tc-header"><div class="tc-server">Сервер</div><div class="tc-user">Продавец</div>'
+        '<div class="tc-amount">Наличие</div><div class="tc-price">Цена</div></div>'
+    ]
+    for i in range(cards):
+        server = rnd.choice(SERVERS)
+        online = rnd.random() < 0.6
+        amount = rnd.randint(1, 500) * 100000
+        amount_text = f'{amount:,}'.replace(',', ' ')
+        price = rnd.randint(5, 60000) if rnd.random() < 0.1 else rnd.randint(10, 3000)
+        title = rnd.choice((
+            f'Black Russia {server} {amount // 1000000} кк вирт',
+            f'BR {server} вирты, быстрая выдача',
+            f'Блэк раша {server} {amount // 1000} к',
+            f'Вирты {server} моментально',
+        ))
+        parts.append(
+            f'<a href="https://funpay.com/chips/offer?id={1000000 + i}-186-{server.lower()}" '
+            f'class="tc-item{" offer-promo" if i % 11 == 0 else ""}" data-server="{i % 10}" '
+            f'data-online="{int(online)}">'
+            f'<div class="tc-server hidden-xxs">{server}</div>'
+            f'<div class="tc-desc"><div class="tc-desc-text">{title}</div></div>'
+            '<div class="tc-user"><div class="media media-user style-circle">'
+            f'<div class="media-left"><div class="avatar-photo" style="background-image: url(/img/{i}.jpg);"></div></div>'
+            f'<div class="media-body"><div class="media-user-name"><span class="pseudo-a">seller_{i % 300}</span></div>'
+            f'<div class="media-user-status">{"онлайн" if online else "был 3 часа назад"}</div>'
+            f'<div class="media-user-reviews"><div class="rating-stars rating-{rnd.randint(1, 5)}">'
+            '<i class="fas"></i><i class="fas"></i><i class="fas"></i><i class="fas"></i><i class="fas"></i>'
+            f'</div><span class="rating-mini-count">{rnd.randint(0, 900)}</span></div></div></div></div>'
+            f'<div class="tc-amount" data-s="{amount}">{amount_text}</div>'
+            f'<div class="tc-price" data-s="{price}"><div>{price} <span class="unit">₽</span></div></div>'
+            '</a>'
+        )
+    parts.append('</div></div><footer class="footer"><p>© FunPay</p></footer></body></html>')
+    return ''.join(parts)
+
+
+def load_fixtures(sizes):
+    """Снимки страниц: имя -> HTML. Сохранённые файлы + сгенерированные размеры"""
+    pages = {}
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, '*.html'))):
+        with open(path, encoding='utf-8') as f:
+            pages[os.path.splitext(os.path.basename(path))[0]] = f.read()
+    for size in sizes:
+        pages.setdefault(f'synthetic-{size}', make_chips_page(size))
+    return pages
+
+
+def record_fixture(url):
+    """Сохраняет живую страницу в bench_fixtures/ для офлайн-прогонов"""
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    response = requests.get(url, timeout=15, headers={'User-Agent': 'Mozilla/5.0'})
+    response.raise_for_status()
+    name = f"funpay-{time.strftime('%Y%m%d-%H%M%S')}"
+    path = os.path.join(FIXTURES_DIR, f'{name}.html')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(response.text)
+    print(f"💾 Сохранено: {path} ({len(response.content) // 1024} КБ)")
+
+
+# ==================== ЛОКАЛЬНЫЙ СЕРВЕР ====================
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Потоковый парсер закрывает соединение, набрав нужные карточки
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+class FixtureServer:
+    """Локальная замена funpay.com: GET /chips/186/<имя> отдаёт снимок"""
+
+    def __init__(self, pages):
+        encoded = {name: html.encode('utf-8') for name, html in pages.items()}
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                body = encoded.get(self.path.rstrip('/').rsplit('/', 1)[-1])
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = _QuietHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def url(self, name):
+        return f'http://127.0.0.1:{self.httpd.server_port}/chips/186/{name}'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# ==================== ЭКСТРАКТОРЫ ====================
+
+def _soup_cards(url):
+    response = requests.get(url, timeout=30)
+    return list(app.iter_cards_soup(response.text))
+
+
+def _stream_cards(url):
+    with requests.get(url, timeout=30, stream=True) as response:
+        if response.encoding is None:
+            response.encoding = 'utf-8'
+        return list(app.iter_cards_stream(response.iter_content(chunk_size=16384, decode_unicode=True)))
+
+
+# Имя -> функция(url) -> список карточек/товаров. Новые экстракторы добавлять сюда
+EXTRACTORS = {
+    'soup': _soup_cards,
+    'stream': _stream_cards,
+    'fast_parse[soup]': lambda url: app.fast_parse_black_russia(url, 'bench', mode='soup'),
+    'fast_parse[stream]': lambda url: app.fast_parse_black_russia(url, 'bench', mode='stream'),
+    # После прогрева снимок уже есть: замер установившегося режима без изменений на странице
+    'parse_page[incremental]': lambda url: app.parse_page(url, 'bench', conditional=False, incremental=True).items,
+}
+
+
+# ==================== ЗАМЕРЫ ====================
+
+def _current_rss_kb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() // 1024
+
+
+def _measure(extractor, url, repeat):
+    """Замер в отдельном процессе, чтобы пик RSS не смешивался между экстракторами"""
+    func = EXTRACTORS[extractor]
+    func(url)  # прогрев: соединение, кэши re и т.п.
+    start_rss = _current_rss_kb()
+
+    times = []
+    items = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        items = len(func(url))
+        times.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    func(url)
+    alloc_current, alloc_peak = tracemalloc.get_traced_memory()
+    blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+
+    best = min(times)
+    return {
+        'items': items,
+        'parse_ms': best * 1000,
+        'median_ms': sorted(times)[len(times) // 2] * 1000,
+        'items_per_sec': items / best if best else 0.0,
+        'alloc_peak_kb': alloc_peak // 1024,
+        'alloc_blocks': blocks,
+        'peak_rss_kb': max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss, 0),
+    }
+
+
+def _child(queue, extractor, url, repeat):
+    logging.disable(logging.CRITICAL)
+    try:
+        queue.put(_measure(extractor, url, repeat))
+    except Exception as e:
+        queue.put({'error': repr(e)})
+
+
+def run_benchmark(pages, extractors, repeat):
+    results = []
+    ctx = multiprocessing.get_context('fork')
+    with FixtureServer(pages) as server:
+        for name, extractor in itertools.product(pages, extractors):
+            queue = ctx.Queue()
+            proc = ctx.Process(target=_child, args=(queue, extractor, server.url(name), repeat))
+            proc.start()
+            result = queue.get()
+            proc.join()
+            result.update(page=name, page_kb=len(pages[name].encode('utf-8')) // 1024, extractor=extractor)
+            results.append(result)
+            print_row(result)
+    return results
+
+
+def print_header():
+    print(f"{'page':<24}{'KB':>7}  {'extractor':<20}{'items':>7}{'best ms':>10}{'med ms':>10}"
+          f"{'items/s':>11}{'alloc KB':>10}{'blocks':>9}{'RSS KB':>9}", flush=True)
+
+
+def print_row(r):
+    if 'error' in r:
+        print(f"{r['page']:<24}{r['page_kb']:>7}  {r['extractor']:<20}  💥 {r['error']}", flush=True)
+        return
+    print(f"{r['page']:<24}{r['page_kb']:>7}  {r['extractor']:<20}{r['items']:>7}{r['parse_ms']:>10.1f}"
+          f"{r['median_ms']:>10.1f}{r['items_per_sec']:>11.0f}{r['alloc_peak_kb']:>10}"
+          f"{r['alloc_blocks']:>9}{r['peak_rss_kb']:>9}", flush=True)
+
+
+def compare(results, baseline_path, max_slowdown):
+    """Сравнение с сохранённым прогоном; возвращает число регрессий"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {(r['page'], r['extractor']): r for r in json.load(f) if 'error' not in r}
+
+    regressions = 0
+    for r in results:
+        base = baseline.get((r['page'], r['extractor']))
+        if not base or 'error' in r:
+            continue
+        ratio = r['parse_ms'] / base['parse_ms'] if base['parse_ms'] else 1.0
+        if ratio > max_slowdown:
+            regressions += 1
+            print(f"❌ {r['page']} / {r['extractor']}: {base['parse_ms']:.1f} → {r['parse_ms']:.1f} мс (x{ratio:.2f})")
+    if not regressions:
+        print(f"✅ Регрессий нет (порог x{max_slowdown})")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Офлайн-бенчмарк парсера FunPay')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES),
+                        help='размеры сгенерированных страниц (число карточек)')
+    parser.add_argument('--extractors', nargs='+', choices=sorted(EXTRACTORS), default=list(EXTRACTORS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save-json', metavar='PATH', help='сохранить результаты в JSON')
+    parser.add_argument('--compare', metavar='PATH', help='сравнить с сохранённым JSON')
+    parser.add_argument('--max-slowdown', type=float, default=1.25)
+    parser.add_argument('--record', metavar='URL', help='сохранить живую страницу в bench_fixtures/ и выйти')
+    args = parser.parse_args(argv)
+
+    if args.record:
+        record_fixture(args.record)
+        return 0
+
+    pages = load_fixtures(args.sizes)
+    print_header()
+    results = run_benchmark(pages, args.extractors, args.repeat)
+
+    if args.save_json:
+        with open(args.save_json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        return 1 if compare(results, args.compare, args.max_slowdown) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,14 @@
 # Конфигурация Gunicorn для Render
 import multiprocessing
+import os
 
-# Количество воркеров
-workers = 1
+# Количество воркеров: состояние общее (SQLite), мониторинг ведёт один из них
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+# Потоки в воркере: клиенты живой ленты (/events) держат соединение открытым,
+# поэтому держат его не больше GUNICORN_THREADS - 4 клиентов, остальные
+# переподключаются раз в несколько секунд. Лента общая для всех воркеров
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
 
 # Таймауты (увеличиваем для Render)
 timeout = 30  # 30 секунд на запрос
@@ -19,3 +25,33 @@ max_requests_jitter = 20
 
 # Бинд порта
 bind = "0.0.0.0:10000"
+
+# Тяжёлые библиотеки, которые app импортирует лениво. Мастер грузит их один раз,
+# и форкнутые воркеры (в том числе после max_requests) получают их готовыми.
+# Сам app в мастере не импортируем: потоки и SQLite-соединения не переживают fork
+PRELOAD_MODULES = ('flask', 'requests', 'bs4', 'telegram', 'telegram.error')
+
+
+def on_starting(server):
+    import importlib
+    import time
+    started = time.perf_counter()
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            server.log.warning(f"Предзагрузка {name} не удалась: {e}")
+    server.log.info(f"Предзагрузка модулей: {(time.perf_counter() - started) * 1000:.0f} мс")
+
+
+# Новый воркер (в том числе после max_requests) продолжает мониторинг
+# с тёплого снимка прошлого воркера
+def post_worker_init(worker):
+    from app import monitor
+    monitor.resume()
+
+
+# Уходящий воркер останавливает поток мониторинга и сразу отдаёт аренду новому
+def worker_exit(server, worker):
+    from app import monitor
+    monitor.shutdown()
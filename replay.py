@@ -0,0 +1,352 @@
+"""Воспроизведение записанных циклов мониторинга FunPay.
+
+Запись: с CAPTURE_PATH=capture.jsonl.gz приложение складывает каждую
+загруженную страницу категории (и 304/ошибки) со временем опроса в сжатый
+архив. Одинаковые тела страниц хранятся один раз.
+
+Воспроизведение гоняет весь конвейер - загрузку через fetch, разбор,
+дедупликацию, оценку, раздачу подписчикам - по архиву на виртуальных часах:
+локальный сервер отдаёт ту страницу, что была на FunPay в текущий
+виртуальный момент, планировщик сам решает, когда опрашивать, а вместо
+Telegram сообщения складываются в память. Сутки трафика проходят за секунды.
+
+Отчёт: задержка оповещения (от первого появления предложения в архиве до
+сообщения), пропускная способность, число оповещений.
+
+Состояние - в памяти (STATE_BACKEND=memory), рабочие state.db и архив не трогаются.
+
+Примеры:
+    CAPTURE_PATH=capture.jsonl.gz python app.py
+    python replay.py capture.jsonl.gz
+    python replay.py capture.jsonl.gz --speed 60 --save-json replay.json
+    python replay.py --synthetic 24 --save-archive day.jsonl.gz
+"""
+import argparse
+import bisect
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# До импорта app: воспроизведение не должно писать в рабочее состояние, архив и снимок
+os.environ['STATE_BACKEND'] = 'memory'
+os.environ['SEEN_STORE_PATH'] = ''
+os.environ['CAPTURE_PATH'] = ''
+os.environ['MONITOR_SNAPSHOT_PATH'] = ''
+# Без администратора правилам по умолчанию некому отправлять
+os.environ['TELEGRAM_CHAT_ID'] = os.environ.get('TELEGRAM_CHAT_ID', '').strip() or 'replay'
+
+import app
+from bench_parse import make_chips_page
+
+OFFER_MARK = '<a href="https://funpay.com/chips/offer'
+
+
+# ==================== ВИРТУАЛЬНЫЕ ЧАСЫ ====================
+
+class VirtualClock:
+    """Замена модуля time внутри app: time() идёт по виртуальному времени.
+
+    Часы двигает только цикл воспроизведения; perf_counter, monotonic и
+    sleep остаются настоящими (замеры, пауза очереди Telegram).
+    """
+
+    def __init__(self, start):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def advance_to(self, moment):
+        self.now = max(self.now, moment)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+# ==================== АРХИВ ====================
+
+class Archive:
+    """Архив опросов: по каждой категории - опросы в порядке времени"""
+
+    def __init__(self, bodies, pages):
+        self.bodies = {digest: html.encode('utf-8') for digest, html in bodies.items()}
+        self.pages = pages
+        self.categories = []
+        self._timeline = {}
+        for page in pages:
+            # 304 и оборванные разборы не говорят, что было на странице целиком
+            if page['status'] == 304 or page.get('partial'):
+                continue
+            if page['category'] not in self._timeline:
+                self.categories.append(page['category'])
+                self._timeline[page['category']] = ([], [])
+            moments, records = self._timeline[page['category']]
+            moments.append(page['ts'])
+            records.append(page)
+
+    @classmethod
+    def load(cls, path):
+        return cls(*app.read_capture(path))
+
+    @property
+    def start(self):
+        return self.pages[0]['ts']
+
+    @property
+    def end(self):
+        return self.pages[-1]['ts']
+
+    def page_at(self, category, moment):
+        """Опрос, который был актуален в момент moment (до первого - самый ранний)"""
+        moments, records = self._timeline[category]
+        index = bisect.bisect_right(moments, moment) - 1
+        return records[max(index, 0)]
+
+    def snapshots(self, category):
+        return self._timeline[category][1]
+
+
+class ReplayServer:
+    """Локальная замена funpay.com: GET /<номер категории> отдаёт страницу на виртуальный момент.
+
+    ETag - хэш тела, так что условные запросы и 304 работают как на FunPay.
+    Записанные ошибки повторяются: статус как есть, сетевые - обрывом соединения.
+    """
+
+    def __init__(self, archive, clock):
+        categories = archive.categories
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Заголовки и тело уходят разными send: без TCP_NODELAY каждый ответ ждёт delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                try:
+                    category = categories[int(self.path.strip('/'))]
+                except (ValueError, IndexError):
+                    self.send_error(404)
+                    return
+                page = archive.page_at(category, clock.time())
+                if page.get('error'):
+                    if not page['status']:
+                        self.close_connection = True
+                        return
+                    self.send_response(page['status'])
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                etag = f'"{page["hash"]}"'
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                body = archive.bodies[page['hash']]
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+
+    def url(self, index):
+        return f'http://127.0.0.1:{self.server.server_port}/{index}'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# ==================== ВОСПРОИЗВЕДЕНИЕ ====================
+
+def first_appearance(archive, categories):
+    """Когда каждое подходящее под правила предложение впервые появилось в архиве"""
+    appeared = {}
+    for category in categories:
+        parsed = {}
+        for page in archive.snapshots(category.name):
+            digest = page.get('hash')
+            if digest is None or digest in parsed:
+                continue
+            parsed[digest] = True
+            html = archive.bodies[digest].decode('utf-8')
+            for record in app.iter_cards_stream([html]):
+                item = app.build_item(record, category.url, category.name)
+                if item and item['seller_online']:
+                    appeared.setdefault(item['id'], page['ts'])
+    return appeared
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def replay(archive, speed=0.0):
+    """Прогоняет архив через конвейер мониторинга. Возвращает отчёт"""
+    clock = VirtualClock(archive.start)
+    alerts = {}
+    messages = []
+
+    def fake_send(message, parse_mode='HTML', chat_id=None, digest=False):
+        messages.append((clock.time(), chat_id))
+        return True
+
+    format_offer_message = app.format_offer_message
+
+    def recording_format(item):
+        alerts.setdefault(item['id'], clock.time())
+        return format_offer_message(item)
+
+    with ReplayServer(archive, clock) as server:
+        categories = [app.Category(server.url(index), name) for index, name in enumerate(archive.categories)]
+        prepare_started = time.perf_counter()
+        appeared = first_appearance(archive, categories)
+        prepared = time.perf_counter() - prepare_started
+
+        app.time = clock
+        app.send_telegram_message = fake_send
+        app.format_offer_message = recording_format
+        app.CATEGORIES = categories
+        app.scheduler = app.PollScheduler(categories)
+        app._breakers.clear()
+        app.forget_all_pages()
+        app.monitor.active = True
+
+        cycles = polls = 0
+        started = time.perf_counter()
+        while clock.time() <= archive.end:
+            due = app.scheduler.due()
+            if due:
+                app.check_new_items(due)
+                cycles += 1
+                polls += len(due)
+            wakeup = app.scheduler.next_wakeup()
+            if speed > 0:
+                # Темп в speed раз быстрее реального
+                lag = (wakeup - archive.start) / speed - (time.perf_counter() - started)
+                if lag > 0:
+                    time.sleep(lag)
+            clock.advance_to(wakeup)
+        elapsed = time.perf_counter() - started
+
+    latencies = [alerts[key] - appeared[key] for key in alerts if key in appeared]
+    span = archive.end - archive.start
+    return {
+        'virtual_seconds': round(span, 1),
+        'real_seconds': round(elapsed, 3),
+        'prepare_seconds': round(prepared, 3),
+        'speedup': round(span / elapsed, 1) if elapsed else None,
+        'cycles': cycles,
+        'polls': polls,
+        'polls_per_second': round(polls / elapsed, 1) if elapsed else None,
+        'archived_polls': len(archive.pages),
+        'offers_appeared': len(appeared),
+        'offers_alerted': len(alerts),
+        'messages': len(messages),
+        'latency_p50': _round(_percentile(latencies, 0.5)),
+        'latency_p95': _round(_percentile(latencies, 0.95)),
+        'latency_max': _round(max(latencies, default=None)),
+    }
+
+
+def _round(value):
+    return None if value is None else round(value, 1)
+
+
+def print_report(report):
+    print(f"⏱️  {report['virtual_seconds']:.0f} сек трафика за {report['real_seconds']:.2f} сек "
+          f"(x{report['speedup']}), разметка архива {report['prepare_seconds']:.2f} сек")
+    print(f"🔁 Циклов: {report['cycles']}, опросов: {report['polls']} ({report['polls_per_second']}/сек), "
+          f"в архиве: {report['archived_polls']}")
+    print(f"🔔 Предложений онлайн: {report['offers_appeared']}, оповещено: {report['offers_alerted']}, "
+          f"сообщений: {report['messages']}")
+    if report['latency_p50'] is not None:
+        print(f"📬 Задержка оповещения: p50 {report['latency_p50']} сек, p95 {report['latency_p95']} сек, "
+              f"max {report['latency_max']} сек")
+
+
+# ==================== СИНТЕТИЧЕСКИЙ АРХИВ ====================
+
+def synthesize(path, hours, interval=30.0, cards=50, categories=1, seed=186):
+    """Пишет архив «как с FunPay»: каждые interval секунд появляются новые карточки"""
+    rnd = random.Random(seed)
+    steps = int(hours * 3600 / interval)
+    clock = VirtualClock(time.time() - hours * 3600)
+    app.time = clock
+    recorder = app.PageRecorder(path)
+    pages = []
+    for index in range(categories):
+        html = make_chips_page(cards + steps * 2, seed + index)
+        head, *offers = html.split(OFFER_MARK)
+        last, tail = offers[-1].split('</a>', 1)
+        offers[-1] = last + '</a>'
+        pages.append((f'Категория {index + 1}', f'https://funpay.com/chips/{186 + index}/', head, offers, tail))
+    try:
+        for step in range(steps):
+            clock.advance_to(clock.now + interval)
+            for name, url, head, offers, tail in pages:
+                # Скользящее окно: новые предложения вытесняют старые снизу
+                offset = step * 2 - rnd.randint(0, 2)
+                window = offers[max(offset, 0):max(offset, 0) + cards]
+                recorder.record(url, name, 200, head + ''.join(OFFER_MARK + offer for offer in window) + tail)
+    finally:
+        recorder.close()
+        app.time = time
+    return recorder.stats()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Воспроизведение записанных циклов мониторинга')
+    parser.add_argument('archive', nargs='?', help='архив CAPTURE_PATH (gzip JSONL)')
+    parser.add_argument('--speed', type=float, default=0.0,
+                        help='темп относительно реального времени (0 - как можно быстрее)')
+    parser.add_argument('--save-json', metavar='PATH', help='сохранить отчёт в JSON')
+    parser.add_argument('--synthetic', type=float, metavar='HOURS', help='сгенерировать архив на столько часов')
+    parser.add_argument('--save-archive', metavar='PATH', default='synthetic.jsonl.gz',
+                        help='куда писать сгенерированный архив')
+    parser.add_argument('--verbose', action='store_true', help='не глушить журнал приложения')
+    args = parser.parse_args(argv)
+
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+    path = args.archive
+    if args.synthetic:
+        stats = synthesize(args.save_archive, args.synthetic)
+        print(f"💾 Архив {stats['path']}: {stats['pages']} опросов, {stats['bodies']} страниц")
+        path = path or args.save_archive
+    if not path:
+        parser.error('нужен архив или --synthetic')
+
+    archive = Archive.load(path)
+    if not archive.categories:
+        print(f"❌ В архиве {path} нет страниц")
+        return 1
+    report = replay(archive, args.speed)
+    print_report(report)
+    if args.save_json:
+        with open(args.save_json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# app читает настройки при импорте: состояние - в памяти, без файлов на диске
+os.environ.setdefault('STATE_BACKEND', 'memory')
+os.environ.setdefault('SEEN_STORE_PATH', '')
+os.environ.setdefault('CAPTURE_PATH', '')
+os.environ.setdefault('MONITOR_SNAPSHOT_PATH', '')
+os.environ.setdefault('CATEGORIES_FILE', '')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def fresh_state(monkeypatch):
+    """Чистое состояние в памяти: правила, подписки, снимки страниц и эталоны вёрстки"""
+    monkeypatch.setattr(app, 'state', app.MemoryStateBackend())
+    for name, value in (('_rule_engine', None), ('_rules_raw', None), ('_rules_version', None),
+                        ('_rules_checked_at', 0.0), ('_subscriber_index', None),
+                        ('_subscribers_version', None), ('_subscribers_checked_at', 0.0),
+                        ('layout_monitor', app.LayoutMonitor())):
+        monkeypatch.setattr(app, name, value)
+    app.forget_all_pages()
+    yield app.state
+    app.forget_all_pages()
+
+
+class PageServer:
+    """Локальный сервер страниц: pages[path] = html или (status, headers, body)"""
+
+    def __init__(self):
+        self.pages = {}
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests.append((self.path, dict(self.headers)))
+                page = server.pages.get(self.path)
+                if page is None:
+                    status, headers, body = 404, {}, b''
+                elif isinstance(page, tuple):
+                    status, headers, body = page
+                else:
+                    status, headers, body = 200, {'Content-Type': 'text/html; charset=utf-8'}, page.encode('utf-8')
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self._httpd.server_port}'
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+@pytest.fixture
+def page_server():
+    server = PageServer()
+    yield server
+    server.close()
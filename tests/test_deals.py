@@ -0,0 +1,34 @@
+import app
+
+
+def offer(key, score):
+    return {'id': key, 'deal_score': score}
+
+
+def test_select_deals_without_threshold_only_ranks():
+    offers = [offer('a', -0.5), offer('b', 0.2), offer('c', None), offer('d', 0.1)]
+    assert [item['id'] for item in app.select_deals(offers, top_n=0)] == ['b', 'd', 'a', 'c']
+
+
+def test_select_deals_threshold_keeps_unscored_offers():
+    offers = [offer('a', -0.5), offer('b', 0.2), offer('c', None), offer('d', 0.1)]
+    assert [item['id'] for item in app.select_deals(offers, top_n=0, min_score=0.15)] == ['b', 'c']
+
+
+def test_select_deals_top_n():
+    offers = [offer(str(n), n / 10) for n in range(10)]
+    assert [item['id'] for item in app.select_deals(offers, top_n=3)] == ['9', '8', '7']
+
+
+def test_memory_backend_dropped_markers_are_taken_once():
+    backend = app.MemoryStateBackend()
+    backend.mark_dropped({'a': -0.2, 'b': None})
+    assert backend.take_dropped(['a', 'b', 'c']) == {'a': -0.2, 'b': None}
+    assert backend.take_dropped(['a', 'b']) == {}
+
+
+def test_sqlite_backend_dropped_markers_are_taken_once(tmp_path):
+    backend = app.SqliteStateBackend(path=str(tmp_path / 'state.db'))
+    backend.mark_dropped({'a': -0.2, 'b': None})
+    assert backend.take_dropped(['a', 'b', 'c']) == {'a': -0.2, 'b': None}
+    assert backend.take_dropped(['a', 'b']) == {}
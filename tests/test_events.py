@@ -0,0 +1,80 @@
+import pytest
+
+import app
+
+
+@pytest.fixture
+def shared_state(tmp_path, monkeypatch):
+    """Общая база, как у нескольких воркеров gunicorn"""
+    backend = app.SqliteStateBackend(path=str(tmp_path / 'state.db'))
+    monkeypatch.setattr(app, 'state', backend)
+    return backend
+
+
+@pytest.fixture
+def broker(fresh_state, monkeypatch):
+    broker = app.EventBroker(relay_interval=0.05)
+    monkeypatch.setattr(app, 'event_broker', broker)
+    return broker
+
+
+def test_events_reach_clients_of_another_worker(shared_state):
+    # Публикует воркер с арендой, клиенты подключены к другому
+    publisher, viewer = app.EventBroker(relay_interval=0.05), app.EventBroker(relay_interval=0.05)
+    first = publisher.publish('offer', {'id': 'a'})
+    subscriber = viewer.subscribe()
+    second = publisher.publish('price', {'id': 'b'})
+    assert second > first
+    events = viewer.get(subscriber, 2)
+    assert [(event.id, event.kind, event.data) for event in events] == [(second, 'price', {'id': 'b'})]
+    assert [event.id for event in viewer.wait_since(0, 0)] == [first, second]
+
+
+def test_last_event_id_replays_missed_events(broker):
+    ids = [broker.publish('offer', {'n': n}) for n in range(5)]
+    subscriber = broker.subscribe(last_id=ids[2])
+    assert [event.data['n'] for event in broker.get(subscriber, 0)] == [3, 4]
+    assert [event.data['n'] for event in broker.since(ids[0])] == [1, 2, 3, 4]
+
+
+def test_replay_keeps_only_the_latest_history(fresh_state):
+    broker = app.EventBroker(history=3, relay_interval=0.05)
+    for n in range(10):
+        broker.publish('offer', {'n': n})
+    assert [event.data['n'] for event in broker.since(0)] == [7, 8, 9]
+
+
+def test_slow_client_loses_oldest_events(broker, monkeypatch):
+    subscriber = broker.subscribe()
+    subscriber.queue = app.deque(maxlen=2)
+    for n in range(4):
+        broker.publish('offer', {'n': n})
+    broker.pull()
+    assert [event.data['n'] for event in broker.get(subscriber, 0)] == [2, 3]
+    assert subscriber.dropped == 2
+
+
+def test_long_poll_rejects_bad_timeout(broker):
+    client = app.app.test_client()
+    for timeout in ('abc', 'nan', '-1'):
+        assert client.get(f'/events/poll?timeout={timeout}').status_code == 400
+    broker.publish('cycle', {'alerted': 0})
+    data = client.get('/events/poll?since=0&timeout=0').get_json()
+    assert [event['kind'] for event in data['events']] == ['cycle'] and 'retry_after' not in data
+
+
+def test_viewers_over_the_cap_are_served_by_reconnects(broker, monkeypatch):
+    monkeypatch.setattr(app, 'EVENTS_MAX_CLIENTS', 0)
+    client = app.app.test_client()
+    first = broker.publish('offer', {'id': 'a'})
+    second = broker.publish('offer', {'id': 'b'})
+
+    # Новый зритель получает только id, с которого продолжит
+    body = client.get('/events').get_data(as_text=True)
+    assert body == f"retry: {app.EVENTS_BUSY_RETRY * 1000}\n\nid: {second}\n\n"
+    # Переподключившийся - пропущенное
+    body = client.get('/events', headers={'Last-Event-ID': str(first)}).get_data(as_text=True)
+    assert f'id: {second}\nevent: offer\n' in body and f'id: {first}\n' not in body
+
+    data = client.get('/events/poll?since=0&timeout=10').get_json()
+    assert data['retry_after'] == app.EVENTS_BUSY_RETRY and len(data['events']) == 2
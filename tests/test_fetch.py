@@ -0,0 +1,96 @@
+import brotli
+
+import app
+import bench_parse
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def tripped(clock, failures=3, cooldown=30):
+    breaker = app.CircuitBreaker('test', failures=failures, cooldown=cooldown, clock=clock)
+    for _ in range(failures):
+        assert breaker.allow()
+        breaker.failure()
+    return breaker
+
+
+def test_breaker_opens_after_consecutive_failures():
+    clock = Clock()
+    breaker = app.CircuitBreaker('test', failures=3, cooldown=30, clock=clock)
+    breaker.failure()
+    breaker.failure()
+    assert breaker.state == 'closed' and breaker.allow()
+    breaker.failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+
+def test_breaker_half_open_lets_a_single_probe_through():
+    clock = Clock()
+    breaker = tripped(clock)
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+    # Пока проба не вернулась, остальные запросы ждут
+    assert not breaker.allow()
+
+
+def test_breaker_probe_success_closes():
+    clock = Clock()
+    breaker = tripped(clock)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == 'closed'
+    assert breaker.allow() and breaker.allow()
+
+
+def test_breaker_probe_failure_reopens_with_doubled_cooldown():
+    clock = Clock()
+    breaker = tripped(clock)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == 'open'
+    assert breaker.open_until == clock.now + 60
+    clock.now += 59
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+
+
+def test_breaker_forgets_a_probe_that_never_reported():
+    clock = Clock()
+    breaker = tripped(clock)
+    clock.now += 30
+    assert breaker.allow()
+    clock.now += 31
+    assert breaker.allow()
+
+
+def test_breaker_honours_retry_after():
+    clock = Clock()
+    breaker = app.CircuitBreaker('test', failures=5, cooldown=30, clock=clock)
+    breaker.failure(retry_after=120)
+    assert breaker.state == 'open'
+    assert breaker.open_until == clock.now + 120
+
+
+def test_brotli_response_is_decoded(fresh_state, page_server):
+    html = bench_parse.make_chips_page(20)
+    page_server.pages['/chips/186/'] = (200, {'Content-Type': 'text/html; charset=utf-8', 'Content-Encoding': 'br'},
+                                        brotli.compress(html.encode('utf-8')))
+    assert 'br' in app.ACCEPT_ENCODING
+    url = page_server.url + '/chips/186/'
+    with app.fetch(url, 'Black Russia') as response:
+        assert ''.join(app.iter_body(response, 'Black Russia')) == html
+    assert 'br' in page_server.requests[-1][1]['Accept-Encoding']
+    assert app.fast_parse_black_russia(url, 'Black Russia')
@@ -0,0 +1,104 @@
+import threading
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def shared_state(tmp_path, monkeypatch):
+    """Общая база, как у нескольких воркеров gunicorn"""
+    backend = app.SqliteStateBackend(path=str(tmp_path / 'state.db'))
+    monkeypatch.setattr(app, 'state', backend)
+    return backend
+
+
+def blocking():
+    gate = threading.Event()
+    return gate, lambda: gate.wait(5) and {'new_items': 1, 'items': 2}
+
+
+def wait_done(queue, job_id):
+    for _ in range(100):
+        job = queue.get(job_id)
+        if job.finished:
+            return job
+        threading.Event().wait(0.02)
+    raise AssertionError('задача не завершилась')
+
+
+def test_same_name_is_coalesced_until_finished(fresh_state):
+    queue = app.JobQueue(workers=2)
+    gate, func = blocking()
+    job, created = queue.submit('check', func)
+    again, created_again = queue.submit('check', func)
+    assert created and not created_again and again is job
+    assert queue.stats() == {'active': ['check'], 'coalesced': 1}
+    gate.set()
+    assert wait_done(queue, job.id).result == {'new_items': 1, 'items': 2}
+    assert queue.submit('check', func)[1]
+
+
+def test_jobs_are_visible_across_workers(shared_state):
+    first, second = app.JobQueue(workers=1), app.JobQueue(workers=1)
+    gate, func = blocking()
+    job, _ = first.submit('check', func)
+    # Другой воркер видит задачу и не запускает вторую такую же
+    assert second.get(job.id).name == 'check'
+    other, created = second.submit('check', func)
+    assert not created and other.id == job.id
+    gate.set()
+    done = wait_done(second, job.id)
+    assert done.status == 'done' and done.result == {'new_items': 1, 'items': 2}
+    assert [data['id'] for data in second.recent()] == [job.id]
+
+
+def test_failed_job_keeps_its_error(shared_state):
+    queue = app.JobQueue(workers=1)
+
+    def fail():
+        raise RuntimeError('сломалось')
+
+    job, _ = queue.submit('check', fail)
+    done = wait_done(app.JobQueue(workers=1), job.id)
+    assert done.status == 'error' and done.error == 'сломалось'
+
+
+def test_stale_job_is_reported_lost(shared_state):
+    queue = app.JobQueue(workers=1)
+    job = app.Job('test')
+    job.created_at -= app.JOB_STALE_AFTER + 1
+    assert shared_state.claim_job(job.dump(), 0, app.JOB_HISTORY) is None
+    lost = queue.get(job.id)
+    assert lost.status == 'error' and lost.error
+    # Потерянная задача не мешает запустить новую
+    gate, func = blocking()
+    assert queue.submit('test', func)[1]
+    gate.set()
+
+
+def test_test_page_shows_a_job_of_another_worker(shared_state, monkeypatch):
+    first = app.JobQueue(workers=1)
+    item = {'title': 'Вирты <b>', 'price': 100, 'seller_online': True, 'link': 'https://funpay.com/x'}
+    job, _ = first.submit('test', lambda: {'items': [item], 'status': 200, 'error': None})
+    wait_done(first, job.id)
+    monkeypatch.setattr(app, 'job_queue', app.JobQueue(workers=1))
+
+    client = app.app.test_client()
+    response = client.get(f'/test?job={job.id}')
+    assert response.status_code == 200
+    assert 'Найдено 1 товаров' in response.get_data(as_text=True)
+    assert 'Вирты &lt;b&gt;' in response.get_data(as_text=True)
+    assert client.get(f'/jobs/{job.id}').get_json()['result'] == {'items': 1, 'status': 200, 'error': None}
+
+
+def test_manual_check_does_nothing_while_monitoring_is_stopped(fresh_state, monkeypatch):
+    def no_budget(categories):
+        raise AssertionError('бюджет тратить нельзя')
+
+    monkeypatch.setattr(app.scheduler, 'take', no_budget)
+    fresh_state.set_status('monitoring_active', False)
+    with pytest.raises(RuntimeError):
+        app.manual_check_job()
+    # Аренду не взяли - её может получить любой воркер
+    assert fresh_state.acquire_lease('monitor', 'other', 60)
@@ -0,0 +1,57 @@
+import pytest
+
+import app
+import bench_parse
+
+CATEGORY = 'Black Russia'
+
+
+def layout_of(html):
+    layout = app.PageLayout()
+    list(app.iter_cards_stream([html], strict=True, layout=layout))
+    return layout
+
+
+@pytest.fixture
+def monitor(fresh_state):
+    monitor = app.LayoutMonitor()
+    assert not monitor.observe(CATEGORY, layout_of(bench_parse.make_chips_page(40)))
+    assert monitor.strict(CATEGORY)
+    return monitor
+
+
+def test_same_layout_stays_strict(monitor):
+    assert not monitor.observe(CATEGORY, layout_of(bench_parse.make_chips_page(40, seed=7)))
+    assert monitor.strict(CATEGORY)
+    assert monitor.similarity[CATEGORY] > 0.95
+
+
+def test_renamed_field_is_drift_and_recovers(monitor):
+    drifted = bench_parse.make_chips_page(40).replace('tc-desc-text', 'tc-desc-body')
+    assert monitor.observe(CATEGORY, layout_of(drifted))
+    assert not monitor.strict(CATEGORY)
+    assert monitor.observe(CATEGORY, layout_of(bench_parse.make_chips_page(40, seed=7)))
+    assert monitor.strict(CATEGORY)
+
+
+def test_empty_page_is_no_signal(monitor):
+    assert not monitor.observe(CATEGORY, app.PageLayout())
+    assert monitor.strict(CATEGORY)
+    assert CATEGORY not in monitor.similarity
+
+
+def test_few_changed_cards_are_no_signal(monitor):
+    layout = layout_of(bench_parse.make_chips_page(2).replace('tc-desc-text', 'tc-desc-body'))
+    layout.skipped = 38
+    assert not monitor.observe(CATEGORY, layout)
+    assert monitor.strict(CATEGORY)
+
+
+def test_layout_key_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(app.PageLayout, '_keys', {})
+    monkeypatch.setattr(app.PageLayout, '_keys_max', 10)
+    layout = app.PageLayout()
+    layout.add_tag('div', [f'offer-{n}x' for n in range(25)])
+    assert len(app.PageLayout._keys) <= 10
+    # Счёт по ключам от сброса кэша не зависит: цифры сглажены
+    assert layout.classes == {'div.offer-#x': 25}
@@ -0,0 +1,73 @@
+import threading
+import time
+
+import pytest
+
+import app
+
+
+class Crash(BaseException):
+    """Исключение, которое цикл мониторинга не глотает"""
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@pytest.fixture
+def supervisor(fresh_state, monkeypatch):
+    monkeypatch.setattr(app, 'MONITOR_WATCHDOG_INTERVAL', 0.05)
+    monkeypatch.setattr(threading, 'excepthook', lambda args: None)
+    supervisor = app.MonitorSupervisor()
+    yield supervisor
+    supervisor.shutdown()
+
+
+def test_watchdog_restarts_a_dead_monitor_thread(supervisor, monkeypatch):
+    calls = []
+
+    def check(categories=None):
+        calls.append(threading.current_thread())
+        if len(calls) == 1:
+            raise Crash()
+        return 0
+
+    monkeypatch.setattr(app, 'check_new_items', check)
+    assert supervisor.start()
+    assert wait_for(lambda: len(calls) >= 2)
+    assert supervisor.restarts == 1
+    assert 'Crash' in supervisor.last_error
+    assert calls[0] is not calls[1]
+    stats = supervisor.stats()
+    assert stats['thread_alive'] and stats['healthy']
+
+
+def test_start_is_idempotent_and_stop_is_persisted(supervisor, monkeypatch):
+    monkeypatch.setattr(app, 'check_new_items', lambda categories=None: 0)
+    assert supervisor.start()
+    thread = supervisor._thread
+    assert not supervisor.start()
+    assert supervisor._thread is thread
+    supervisor.stop()
+    assert app.state.get_status('monitoring_active') is False
+    assert wait_for(lambda: not thread.is_alive())
+    # Остановленный мониторинг сторож не поднимает
+    time.sleep(0.2)
+    assert supervisor.restarts == 0 and not supervisor._alive()
+    assert supervisor.stats()['healthy']
+
+
+def test_monitor_stops_when_another_worker_stops_it(supervisor, monkeypatch):
+    monkeypatch.setattr(app, 'check_new_items', lambda categories=None: 0)
+    monkeypatch.setattr(app, 'POLL_INTERVAL', 0.05)
+    # Аренда у другого воркера: этот только ждёт и сверяет флаг
+    app.state.acquire_lease('monitor', 'other', 60)
+    assert supervisor.start()
+    app.state.set_status('monitoring_active', False)
+    assert wait_for(lambda: not supervisor._alive())
+    assert not supervisor.active
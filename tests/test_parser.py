@@ -0,0 +1,70 @@
+import app
+import bench_parse
+
+
+def fields(records):
+    """Поля карточек без отпечатка: у разборщиков он снимается с разной разметки"""
+    return [record._replace(tag=None, fingerprint=None) for record in records]
+
+
+def chunks(html, size=997):
+    return [html[start:start + size] for start in range(0, len(html), size)]
+
+
+def test_strict_stream_matches_soup():
+    html = bench_parse.make_chips_page(60)
+    soup = fields(app.iter_cards_soup(html))
+    assert len(soup) == 60
+    assert fields(app.iter_cards_stream(chunks(html), strict=True)) == soup
+
+
+def test_sliced_matches_soup_and_skips_known_cards():
+    html = bench_parse.make_chips_page(60)
+    layout = app.PageLayout()
+    records = list(app.iter_cards_sliced(html, {}, layout))
+    assert fields(records) == fields(app.iter_cards_soup(html))
+
+    known = {record.fingerprint: None for record in records}
+    again = app.PageLayout()
+    assert [record.fingerprint for record in app.iter_cards_sliced(html, known, again)] == list(known)
+    assert (again.cards, again.skipped) == (0, 60)
+
+
+def test_sliced_card_ends_at_its_closing_tag():
+    html = bench_parse.make_chips_page(5)
+    records = list(app.iter_cards_sliced(html, {}))
+    # Подвал и разметка после последней карточки не входят в её отпечаток
+    footer = html.replace('<footer class="footer"><p>© FunPay</p></footer>', '<footer>другой подвал</footer>')
+    assert footer != html
+    assert [record.fingerprint for record in app.iter_cards_sliced(footer, {})] == \
+        [record.fingerprint for record in records]
+
+
+def test_sliced_card_end_counts_nested_tags():
+    html = ('<div class="tc-item"><div class="tc-desc"><div class="tc-desc-text">Вирты</div></div>'
+            '<div class="tc-price">100</div></div><div>после</div>'
+            '<div class="tc-item"><div class="tc-desc-text">Вирты 2</div></div>')
+    first_end = html.index('<div>после')
+    assert app._card_end(html, 0, html.index('<div class="tc-item">', 1)) == first_end
+
+
+def test_stream_matches_soup_at_any_chunk_size():
+    html = bench_parse.make_chips_page(60)
+    soup = fields(app.iter_cards_soup(html))
+    for size in (7, 997, len(html)):
+        assert fields(app.iter_cards_stream(chunks(html, size))) == soup
+
+
+def test_stream_keeps_soup_fallbacks_for_unusual_cards():
+    html = ('<div class="tc-item"><span>Вирты без класса</span><div class="tc-price">1 500 ₽</div></div>'
+            '<a class="tc-item offer" href="/chips/offer?id=1"><div class="tc-desc-text">BR &amp; кк</div>'
+            '<div class="media-user-status">Онлайн</div></a>')
+    assert fields(app.iter_cards_stream(chunks(html, 5))) == fields(app.iter_cards_soup(html))
+
+
+def test_parse_page_gives_the_same_items_in_both_modes(fresh_state, page_server):
+    page_server.pages['/chips/186/'] = bench_parse.make_chips_page(60)
+    url = page_server.url + '/chips/186/'
+    soup = app.fast_parse_black_russia(url, 'Black Russia', mode='soup')
+    assert soup
+    assert app.fast_parse_black_russia(url, 'Black Russia', mode='stream') == soup
@@ -0,0 +1,74 @@
+import app
+
+
+def engine(*rules):
+    return app.RuleEngine([app.normalize_rule(dict(rule, id=index)) for index, rule in enumerate(rules, 1)])
+
+
+def item(title, price=100, category='A', **extra):
+    return dict({'title': title, 'price': price, 'category': category}, **extra)
+
+
+def test_contained_words_finds_every_nested_keyword():
+    trie = app._keyword_trie(['br', 'black russia', 'russia', 'black russia br'])
+    assert app._contained_words(trie, 'black russia br') == {'br', 'black russia', 'russia', 'black russia br'}
+    assert app._contained_words(trie, 'russ') == set()
+
+
+def test_longest_match_still_fires_rules_of_shorter_keywords():
+    # В позиции 0 выражение выбирает самое длинное слово - правила вложенных
+    # слов должны сработать через расширение
+    rules = engine({'keywords': 'black russia'}, {'keywords': 'black russia gold'}, {'keywords': 'russia'})
+    assert rules.match(item('Black Russia Gold 100кк')) == [1, 2, 3]
+    assert rules.match(item('black russia')) == [1, 3]
+    assert rules.match(item('blackrussia')) == [3]
+    assert rules.match(item('black rus')) == []
+
+
+def test_keywords_matching_at_overlapping_positions():
+    rules = engine({'keywords': 'кк'}, {'keywords': '100 кк'}, {'keywords': '00 к'})
+    assert rules.match(item('продам 100 кк')) == [1, 2, 3]
+    assert rules.match(item('продам 5 кк')) == [1]
+
+
+def test_keyword_with_trailing_space_is_part_of_the_word():
+    rules = engine({'keywords': ['br ']})
+    assert rules.match(item('BR вирты')) == [1]
+    assert rules.match(item('brother')) == []
+
+
+def test_numeric_conditions_apply_to_keyword_candidates():
+    rules = engine({'keywords': 'вирты', 'price_min': 50, 'price_max': 500},
+                   {'keywords': 'вирты', 'unit_price_max': 100})
+    assert rules.match(item('вирты', price=100, unit_price=150)) == [1]
+    assert rules.match(item('вирты', price=1000, unit_price=50)) == [2]
+    assert rules.match(item('вирты', price=10)) == []
+
+
+def test_rules_without_keywords_are_bucketed_by_category_and_price_ceiling():
+    rules = engine({'price_max': 100}, {'price_max': 1000, 'categories': 'A'}, {'price_max': 10, 'categories': 'B'})
+    assert rules.match(item('что угодно', price=50, category='A')) == [1, 2]
+    assert rules.match(item('что угодно', price=500, category='A')) == [2]
+    assert rules.match(item('что угодно', price=5, category='B')) == [1, 3]
+    assert rules.match(item('что угодно', price=50, category='C')) == [1]
+
+
+def test_unknown_rating_passes_only_in_partial_mode():
+    rules = engine({'keywords': 'вирты', 'min_rating': 4.5})
+    assert rules.match(item('вирты')) == []
+    assert rules.match(item('вирты'), partial=True) == [1]
+    assert rules.match(item('вирты', seller_rating=4.0), partial=True) == []
+
+
+def test_disabled_rules_are_skipped():
+    rules = engine({'keywords': 'вирты', 'enabled': False}, {'keywords': 'вирты'})
+    assert rules.match(item('вирты')) == [2]
+
+
+def test_changed_categories():
+    old = [app.normalize_rule({'id': 1, 'keywords': 'a', 'categories': 'A'}),
+           app.normalize_rule({'id': 2, 'keywords': 'b', 'categories': 'B'})]
+    new = [old[0], app.normalize_rule({'id': 3, 'keywords': 'c', 'categories': 'C'})]
+    assert app.changed_categories(old, new) == {'B', 'C'}
+    assert app.changed_categories(old, old) == set()
+    assert app.changed_categories(old, old + [app.normalize_rule({'id': 4, 'keywords': 'd'})]) is None
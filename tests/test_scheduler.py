@@ -0,0 +1,70 @@
+import app
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+CATEGORY = app.Category('https://funpay.com/chips/186/', 'Black Russia')
+
+
+def result(status=200, changed=(), not_modified=False):
+    return app.PageResult([], status, not_modified, list(changed))
+
+
+def test_backoff_grows_exponentially_on_throttling():
+    clock = Clock()
+    scheduler = app.PollScheduler([CATEGORY], clock=clock)
+    for errors in range(1, 4):
+        scheduler.record(CATEGORY, result(429))
+        delay = scheduler._slots[CATEGORY]['next'] - clock.now
+        full = min(app.POLL_INTERVAL * 2 ** errors, app.POLL_MAX_BACKOFF)
+        # Случайный разброс - от половины до полной паузы
+        assert full * 0.5 <= delay <= full
+    assert scheduler._slots[CATEGORY]['errors'] == 3
+
+
+def test_backoff_is_capped():
+    clock = Clock()
+    scheduler = app.PollScheduler([CATEGORY], clock=clock)
+    for _ in range(20):
+        scheduler.record(CATEGORY, None)
+    assert scheduler._slots[CATEGORY]['next'] - clock.now <= app.POLL_MAX_BACKOFF
+
+
+def test_success_resets_backoff():
+    clock = Clock()
+    scheduler = app.PollScheduler([CATEGORY], clock=clock)
+    scheduler.record(CATEGORY, result(503))
+    scheduler.record(CATEGORY, result(503))
+    scheduler.record(CATEGORY, result(200))
+    slot = scheduler._slots[CATEGORY]
+    assert slot['errors'] == 0
+    assert slot['next'] - clock.now <= slot['interval'] * 1.1
+
+
+def test_quiet_page_slows_down_and_active_page_speeds_up():
+    clock = Clock()
+    scheduler = app.PollScheduler([CATEGORY], clock=clock)
+    scheduler.record(CATEGORY, result(304, not_modified=True))
+    slow = scheduler._slots[CATEGORY]['interval']
+    assert slow == min(app.POLL_INTERVAL * 1.5, app.POLL_MAX_INTERVAL)
+    scheduler.record(CATEGORY, result(200, changed=[{}] * 4))
+    assert scheduler._slots[CATEGORY]['interval'] == max(slow / 5, app.POLL_MIN_INTERVAL)
+
+
+def test_due_respects_the_request_budget():
+    clock = Clock()
+    categories = [app.Category(f'https://funpay.com/chips/{n}/', str(n)) for n in range(5)]
+    scheduler = app.PollScheduler(categories, budget_per_minute=3, clock=clock)
+    clock.now += 10
+    assert len(scheduler.due()) == 3
+    assert scheduler.due() == []
+    # Бюджет пополняется со временем: 3 запроса в минуту - один за 20 секунд
+    clock.now += 20
+    assert len(scheduler.due()) == 1
+    assert scheduler.take(categories) == []
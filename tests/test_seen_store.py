@@ -0,0 +1,84 @@
+import time
+
+import app
+
+
+def test_seen_store_reports_new_keys_once():
+    store = app.SeenStore(capacity=10, ttl=60)
+    now = time.time()
+    assert store.add('a', now)
+    assert not store.add('a', now + 1)
+    assert 'a' in store
+
+
+def test_seen_store_expires_keys_after_ttl():
+    store = app.SeenStore(capacity=10, ttl=60)
+    now = time.time()
+    store.add('a', now - 100)
+    store.add('b', now - 30)
+    assert store.add('c', now)
+    # 'a' старше ttl и вытеснен, 'b' ещё жив
+    assert store.evicted_ttl == 1
+    assert store.add('a', now)
+    assert not store.add('b', now)
+
+
+def test_seen_store_evicts_least_recently_seen():
+    store = app.SeenStore(capacity=3, ttl=3600)
+    now = time.time()
+    for offset, key in enumerate('abc'):
+        store.add(key, now + offset)
+    # Повторная встреча освежает 'a' - вытесняется 'b'
+    store.add('a', now + 3)
+    store.add('d', now + 4)
+    assert len(store) == 3
+    assert store.evicted_lru == 1
+    assert 'b' not in store
+    assert 'a' in store and 'c' in store and 'd' in store
+
+
+def test_seen_store_restore_skips_expired():
+    now = time.time()
+    store = app.SeenStore(capacity=10, ttl=60)
+    store.restore({'kind': 'lru', 'items': [('old', now - 120), ('fresh', now - 10)]})
+    assert 'fresh' in store
+    assert 'old' not in store
+
+
+def test_bloom_store_reports_new_keys_once():
+    store = app.BloomSeenStore(capacity=1000, ttl=3600)
+    now = time.time()
+    assert store.add('a', now)
+    assert not store.add('a', now + 1)
+    assert 'a' in store and 'b' not in store
+
+
+def test_bloom_store_forgets_keys_after_two_rotations():
+    store = app.BloomSeenStore(capacity=1000, ttl=100)
+    start = store._rotated_at
+    store.add('a', start)
+    store.add('b', start)
+    # Поколение старше ttl/2 уходит в «предыдущее»: ключи ещё помнятся
+    store.add('c', start + 60)
+    assert 'a' in store and 'b' in store
+    # Встреча ключа из предыдущего поколения переносит его в текущее
+    assert not store.add('b', start + 61)
+    store.add('d', start + 120)
+    assert 'a' not in store
+    assert 'b' in store
+    assert store.add('a', start + 121)
+
+
+def test_bloom_store_rotates_when_generation_is_full():
+    # Поколение - capacity/2 ключей; третье поколение вытесняет первое целиком
+    store = app.BloomSeenStore(capacity=20, ttl=3600)
+    now = store._rotated_at
+    for n in range(10):
+        store.add(f'a{n}', now)
+    store.add('b0', now)
+    assert (store._previous_count, store._current_count) == (10, 1)
+    assert store.evictions == 0
+    for n in range(1, 11):
+        store.add(f'b{n}', now)
+    assert store.evictions == 10
+    assert 'a0' not in store and 'b0' in store
@@ -0,0 +1,82 @@
+import threading
+
+import app
+
+
+def backend(tmp_path, **kwargs):
+    return app.SqliteStateBackend(path=str(tmp_path / 'state.db'), **kwargs)
+
+
+def test_keys_are_new_once_across_workers(tmp_path):
+    first, second = backend(tmp_path), backend(tmp_path)
+    assert first.mark_seen_many(['a', 'b']) == {'a', 'b'}
+    assert second.mark_seen_many(['b', 'c']) == {'c'}
+    # Перезапуск воркера: новое соединение видит то же
+    assert backend(tmp_path).mark_seen_many(['a', 'c', 'd']) == {'d'}
+    assert first.seen_count() == 4
+
+
+def test_concurrent_workers_get_each_key_once(tmp_path):
+    keys = [f'key-{n}' for n in range(200)]
+    results = []
+
+    def worker(offset):
+        state = backend(tmp_path)
+        for start in range(0, len(keys), 20):
+            # Воркеры идут по ключам с разных мест, пачки пересекаются
+            batch = keys[(start + offset) % len(keys):][:20]
+            results.append(state.mark_seen_many(batch))
+
+    backend(tmp_path)
+    threads = [threading.Thread(target=worker, args=(offset,)) for offset in (0, 10, 50, 130)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(len(new) for new in results) == len(keys)
+    assert set().union(*results) == set(keys)
+
+
+def test_seen_keys_expire_after_ttl(tmp_path):
+    state = backend(tmp_path, ttl=100)
+    assert state.mark_seen_many(['a'], now=1000) == {'a'}
+    assert state.mark_seen_many(['a'], now=1050) == set()
+    # Повторное появление продлевает срок
+    assert state.mark_seen_many(['a'], now=1120) == set()
+    assert state.mark_seen_many(['a'], now=1221) == {'a'}
+    state.mark_seen_many(['b'], now=1000)
+    state.compact(now=1300)
+    assert state.seen_count() == 1
+
+
+def test_lease_has_a_single_holder(tmp_path):
+    first, second = backend(tmp_path), backend(tmp_path)
+    assert first.acquire_lease('monitor', 'w1', 90, now=1000)
+    assert not second.acquire_lease('monitor', 'w2', 90, now=1010)
+    # Держатель продлевает аренду
+    assert first.acquire_lease('monitor', 'w1', 90, now=1080)
+    assert not second.acquire_lease('monitor', 'w2', 90, now=1100)
+    # Не продлённая аренда истекает
+    assert second.acquire_lease('monitor', 'w2', 90, now=1171)
+    assert not first.acquire_lease('monitor', 'w1', 90, now=1172)
+
+
+def test_released_lease_is_free_at_once(tmp_path):
+    first, second = backend(tmp_path), backend(tmp_path)
+    assert first.acquire_lease('monitor', 'w1', 90, now=1000)
+    # Чужая аренда не отдаётся
+    second.release_lease('monitor', 'w2')
+    assert not second.acquire_lease('monitor', 'w2', 90, now=1001)
+    first.release_lease('monitor', 'w1')
+    assert second.acquire_lease('monitor', 'w2', 90, now=1002)
+
+
+def test_status_and_version_counters_are_shared(tmp_path):
+    first, second = backend(tmp_path), backend(tmp_path)
+    first.set_status('monitoring_active', True)
+    assert second.get_status('monitoring_active') is True
+    first.seed_rules([])
+    version = second.get_status('rules_version')
+    rule_id = second.insert_rule(app.normalize_rule({'keywords': 'вирты'}))
+    assert first.get_status('rules_version') == version + 1
+    assert [rule['id'] for rule in first.load_rules()] == [rule_id]
@@ -0,0 +1,111 @@
+import pytest
+
+import app
+import bench_parse
+
+
+def seed(state, *rules):
+    state.seed_rules([app.normalize_rule(dict(rule, id=index)) for index, rule in enumerate(rules, 1)])
+
+
+def test_rules_reloaded_mid_parse_do_not_freeze_the_snapshot(fresh_state, page_server, monkeypatch):
+    category = app.Category(page_server.url + '/chips/186/', 'Black Russia')
+    page_server.pages['/chips/186/'] = bench_parse.make_chips_page(60)
+    monkeypatch.setattr(app, 'CATEGORIES', [category])
+    seed(fresh_state, {'keywords': 'black russia', 'categories': category.name})
+
+    def poll():
+        return app.parse_page(category.url, category.name, incremental=True)
+
+    before = len(poll().items)
+
+    # Правило добавляют, пока идёт разбор: перезагрузка срабатывает изнутри build_item
+    build_item = app.build_item
+    calls = []
+
+    def racing_build_item(*args, **kwargs):
+        if not calls:
+            app.add_rule({'keywords': 'вирты', 'categories': category.name})
+            app.get_rule_engine()
+        calls.append(1)
+        return build_item(*args, **kwargs)
+
+    app.forget_page(category.url)
+    monkeypatch.setattr(app, 'build_item', racing_build_item)
+    assert len(poll().items) == before
+    monkeypatch.setattr(app, 'build_item', build_item)
+
+    # Снимок со старыми правилами не сохранился - следующий опрос видит новые товары
+    after = len(poll().items)
+    assert after > before
+    assert len(poll().items) == after
+    app.forget_page(category.url)
+    assert len(poll().items) == after
+
+
+def test_subscriptions_are_closed_by_default(fresh_state, monkeypatch):
+    monkeypatch.setattr(app, 'TELEGRAM_CHAT_ID', '1')
+    assert app.SUBSCRIPTIONS_OPEN is False
+    response = app.app.test_client().post('/webhook', json={'message': {'text': '/start', 'chat': {'id': 2}}})
+    assert response.status_code == 403
+    assert '2' not in app.load_subscriptions()
+
+
+def test_patterns_are_admin_only_in_telegram(fresh_state, monkeypatch):
+    monkeypatch.setattr(app, 'TELEGRAM_CHAT_ID', '1')
+    with pytest.raises(ValueError):
+        app.add_rule({'keywords': 'вирты', 'pattern': '(a+)+$'}, chat_id='2')
+    assert app.add_rule({'keywords': 'вирты', 'pattern': 'кк'}, chat_id='1')['chat_id'] is None
+    for _ in range(app.SUBSCRIBER_MAX_RULES):
+        assert app.add_rule({'keywords': 'вирты'}, chat_id='2')['chat_id'] == '2'
+    with pytest.raises(ValueError):
+        app.add_rule({'keywords': 'вирты'}, chat_id='2')
+
+
+def test_web_api_needs_admin_token_for_patterns(fresh_state, monkeypatch):
+    monkeypatch.setattr(app, 'ADMIN_TOKEN', 'secret')
+    client = app.app.test_client()
+    rule = {'keywords': 'вирты', 'pattern': '(a+)+$'}
+    assert client.post('/api/rules', json=rule).status_code == 400
+    assert client.post('/api/rules', json=rule, headers={'X-Admin-Token': 'wrong'}).status_code == 400
+    response = client.post('/api/rules', json=rule, headers={'X-Admin-Token': 'secret'})
+    assert response.status_code == 201
+    assert response.get_json()['pattern'] == '(a+)+$'
+
+    client.post('/rules', data={'keywords': 'вирты', 'pattern': 'кк'})
+    client.post('/rules', data={'keywords': 'вирты', 'pattern': 'кк', 'token': 'wrong'})
+    client.post('/rules', data={'keywords': 'вирты', 'pattern': 'кк', 'token': 'secret'})
+    assert [rule['pattern'] for rule in app.load_rules() if rule['pattern']] == ['(a+)+$', 'кк']
+
+
+def test_web_api_without_admin_token_accepts_no_patterns(fresh_state):
+    assert app.ADMIN_TOKEN == ''
+    response = app.app.test_client().post('/api/rules', json={'keywords': 'вирты', 'pattern': 'кк'},
+                                          headers={'X-Admin-Token': ''})
+    assert response.status_code == 400
+
+
+def test_web_rules_cannot_be_planted_into_a_chat(fresh_state):
+    response = app.app.test_client().post('/api/rules', json={'keywords': 'вирты', 'chat_id': '777'})
+    assert response.status_code == 201
+    assert response.get_json()['chat_id'] is None
+    assert app.rules_for_chat('777') == []
+
+
+def test_subscriber_index_routes_by_rule_owner_and_category(fresh_state, monkeypatch):
+    monkeypatch.setattr(app, 'TELEGRAM_CHAT_ID', '1')
+    monkeypatch.setattr(app, 'CATEGORIES', [app.Category('https://funpay.com/chips/1/', 'A'),
+                                            app.Category('https://funpay.com/chips/2/', 'B')])
+    seed(fresh_state, {'keywords': 'вирты'})
+    mine = app.add_rule({'keywords': 'вирты'}, chat_id='2')['id']
+    other = app.add_rule({'keywords': 'золото'}, chat_id='3')['id']
+    app.save_subscription('2', True, ['A'])
+    app.save_subscription('3', False)
+    with pytest.raises(ValueError):
+        app.save_subscription('2', True, ['нет такой'])
+
+    index = app.get_subscriber_index()
+    assert index.chats_for({'rules': [1, mine], 'category': 'A'}) == {'1', '2'}
+    assert index.chats_for({'rules': [1, mine], 'category': 'B'}) == {'1'}
+    # Отписанный чат ничего не получает
+    assert index.chats_for({'rules': [other], 'category': 'A'}) == set()
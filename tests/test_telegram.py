@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+import app
+
+
+class FakeBot:
+    """Bot, который сначала бросает заданные ошибки, а потом отправляет"""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.sent = []
+        self.attempts = 0
+
+    async def send_message(self, chat_id, text, parse_mode):
+        self.attempts += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((chat_id, text, parse_mode))
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    delays = []
+    sleep = asyncio.sleep
+
+    async def fake_sleep(delay, *args, **kwargs):
+        delays.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(app.asyncio, 'sleep', fake_sleep)
+    return delays
+
+
+def send(bot):
+    dispatcher = app.TelegramDispatcher('token')
+    return dispatcher, asyncio.run(dispatcher._send(bot, '1', 'текст', 'HTML'))
+
+
+def test_network_errors_are_retried(no_sleep):
+    bot = FakeBot(TimedOut(), NetworkError('connection reset'))
+    dispatcher, ok = send(bot)
+    assert ok and bot.sent == [('1', 'текст', 'HTML')]
+    assert (dispatcher.sent, dispatcher.retries, dispatcher.failed) == (1, 2, 0)
+    assert 2 in no_sleep and 4 in no_sleep
+
+
+def test_retry_after_delays_the_chat(no_sleep):
+    bot = FakeBot(RetryAfter(7))
+    dispatcher, ok = send(bot)
+    assert ok and bot.attempts == 2
+    assert any(6 < delay <= 7 for delay in no_sleep)
+
+
+@pytest.mark.parametrize('error', [BadRequest("Can't parse entities"), Forbidden('bot was blocked by the user')])
+def test_rejected_messages_fail_at_once(no_sleep, error):
+    bot = FakeBot(error)
+    dispatcher, ok = send(bot)
+    assert not ok and bot.attempts == 1
+    assert (dispatcher.retries, dispatcher.failed) == (0, 1)
+
+
+def test_gives_up_after_max_attempts(no_sleep):
+    bot = FakeBot(*[TimedOut()] * app.TELEGRAM_MAX_ATTEMPTS)
+    dispatcher, ok = send(bot)
+    assert not ok and bot.attempts == app.TELEGRAM_MAX_ATTEMPTS
+    assert dispatcher.failed == 1
+
+
+def message(chat_id, text, digest=True):
+    return app.OutgoingMessage(chat_id, text, 'HTML', digest, 0.0)
+
+
+def test_digest_groups_by_chat_and_keeps_plain_messages():
+    dispatcher = app.TelegramDispatcher('token')
+    batch = [message('1', 'a'), message('2', 'b'), message('1', 'c'), message('1', 'отчёт', digest=False)]
+    sent = list(dispatcher._coalesce(batch))
+    assert sent[0] == ('1', 'отчёт', 'HTML')
+    assert sent[1][0] == '1' and 'Новых предложений: 2' in sent[1][1] and sent[1][1].endswith('a\n\nc')
+    assert sent[2] == ('2', 'b', 'HTML')
+    assert dispatcher.digests == 1
+
+
+def test_digest_is_split_below_the_message_limit():
+    dispatcher = app.TelegramDispatcher('token')
+    texts = [f'{n} ' + 'x' * 1000 for n in range(10)]
+    sent = list(dispatcher._coalesce([message('1', text) for text in texts]))
+    assert len(sent) > 1
+    assert all(len(text) <= app.TELEGRAM_MAX_MESSAGE for _, text, _ in sent)
+    assert ''.join(text for _, text, _ in sent).count('x' * 1000) == 10
+
+
+def test_offer_message_escapes_title_and_link():
+    item = {'title': 'Вирты <x> & <b>', 'price': 100, 'link': "https://funpay.com/?a='1'&b=<2>",
+            'seller_online': True}
+    text = app.format_offer_message(item)
+    assert 'Вирты &lt;x&gt; &amp; &lt;b&gt;' in text
+    assert "href='https://funpay.com/?a=&#x27;1&#x27;&amp;b=&lt;2&gt;'" in text
+    assert '<x>' not in text